@@ -0,0 +1,86 @@
+import hashlib
+from functools import wraps
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse, JsonResponse
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+IDEMPOTENCY_LOCK_TIMEOUT = 30
+
+_PROCESSING = 'processing'
+_DONE = 'done'
+
+
+def _cache_key(request, scope, key):
+    if request.user.is_authenticated:
+        owner = f"u{request.user.pk}"
+    else:
+        owner = f"s{request.session.session_key}"
+    digest = hashlib.sha256(f"{owner}:{key}".encode('utf-8')).hexdigest()
+    return f"idempotency_{scope}_{digest}"
+
+
+def idempotent(scope):
+    """
+    支援 Idempotency-Key 標頭的 view decorator。
+
+    第一次請求的回應會快取 IDEMPOTENCY_KEY_TTL_SECONDS 秒，重送時直接回放，
+    不再查詢商品或建立訂單；同一個 key 正在處理中時回傳 409。
+    未帶標頭（或匿名且尚無 session）的請求照常處理。
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            key = request.headers.get(IDEMPOTENCY_HEADER)
+            if not key:
+                return view_func(request, *args, **kwargs)
+            if len(key) > 255:
+                return JsonResponse({'error': 'Idempotency-Key too long'}, status=400)
+            if not request.user.is_authenticated and not request.session.session_key:
+                return view_func(request, *args, **kwargs)
+
+            cache_key = _cache_key(request, scope, key)
+            fingerprint = hashlib.sha256(request.body).hexdigest()
+
+            record = cache.get(cache_key)
+            if record is None:
+                # cache.add 為原子操作，併發的重複請求只有一個能取得處理權
+                if not cache.add(cache_key, {'state': _PROCESSING, 'fingerprint': fingerprint},
+                                 IDEMPOTENCY_LOCK_TIMEOUT):
+                    record = cache.get(cache_key)
+
+            if record is not None:
+                if record['fingerprint'] != fingerprint:
+                    return JsonResponse(
+                        {'error': 'Idempotency-Key reused with a different request body'}, status=422
+                    )
+                if record['state'] == _PROCESSING:
+                    return JsonResponse({'error': 'A request with this Idempotency-Key is in progress'}, status=409)
+                response = HttpResponse(
+                    record['content'],
+                    status=record['status'],
+                    content_type=record['content_type'],
+                )
+                response['Idempotent-Replayed'] = 'true'
+                return response
+
+            try:
+                response = view_func(request, *args, **kwargs)
+            except Exception:
+                cache.delete(cache_key)
+                raise
+
+            if response.status_code >= 500 or getattr(response, 'streaming', False):
+                # 伺服器錯誤不保存，允許客戶端以同一個 key 重試
+                cache.delete(cache_key)
+            else:
+                cache.set(cache_key, {
+                    'state': _DONE,
+                    'fingerprint': fingerprint,
+                    'status': response.status_code,
+                    'content': response.content,
+                    'content_type': response.get('Content-Type'),
+                }, settings.IDEMPOTENCY_KEY_TTL_SECONDS)
+            return response
+        return wrapper
+    return decorator
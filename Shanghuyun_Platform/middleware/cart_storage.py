@@ -0,0 +1,14 @@
+class CartStorageMiddleware:
+    """
+    將未登入購物車的 cookie 寫入回應（cookie / cache 儲存後端）
+    只有該請求用到購物車時才會處理
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        storage = getattr(request, '_cart_storage', None)
+        if storage is not None:
+            response = storage.process_response(response)
+        return response
@@ -97,6 +97,7 @@ MIDDLEWARE = [
     "wagtail.contrib.redirects.middleware.RedirectMiddleware",
     "whitenoise.middleware.WhiteNoiseMiddleware",
     "Shanghuyun_Platform.middleware.restrict_wagtail_images.RestrictWagtailImagesAdminMiddleware",
+    "Shanghuyun_Platform.middleware.cart_storage.CartStorageMiddleware",
 ]
 
 ROOT_URLCONF = "Shanghuyun_Platform.urls"
@@ -116,6 +117,7 @@ TEMPLATES = [
                 "django.contrib.auth.context_processors.auth",
                 "django.contrib.messages.context_processors.messages",
                 "wagtail.contrib.settings.context_processors.settings",
+                "apps.cart.context_processors.cart",
             ],
         },
     },
@@ -285,3 +287,46 @@ SECURE_BROWSER_XSS_FILTER = True
 MERCHANT_ID = os.getenv('ECPAY_MERCHANT_ID')
 HASH_KEY = os.getenv('ECPAY_HASH_KEY')
 HASH_IV = os.getenv('ECPAY_HASH_IV')
+# 綠界金流網址，未設定時 DEBUG 使用測試環境、否則使用正式環境
+ECPAY_PAYMENT_URL = os.getenv('ECPAY_PAYMENT_URL', '')
+
+# 訂單庫存保留時間（分鐘），逾期未付款的訂單由 release_expired_reservations 釋放庫存
+# 釋放後訂單仍維持 pending，ATM / 超商等較晚完成的付款仍可入帳（屆時重新扣庫存，庫存不足時記錄警告）
+ORDER_RESERVATION_TTL_MINUTES = int(os.getenv('ORDER_RESERVATION_TTL_MINUTES', 60))
+
+# 訂單付款期限（分鐘）：超過後仍查不到付款的 pending 訂單由 poll_pending_payments 標記為 failed，不再查詢
+# 綠界未指定時 ATM 繳費期限為 3 天、超商代碼 / 條碼為 7 天，預設取保留時間 + 7 天再多留 1 天緩衝
+ORDER_PAYMENT_DEADLINE_MINUTES = int(os.getenv(
+    'ORDER_PAYMENT_DEADLINE_MINUTES', ORDER_RESERVATION_TTL_MINUTES + 8 * 24 * 60
+))
+
+# Idempotency-Key 回應保存秒數（購物車與建立訂單 API）
+# 多台 / 多 process 部署時需設定共用的 CACHES（例如 Redis），才能跨 worker 去除重複請求
+IDEMPOTENCY_KEY_TTL_SECONDS = int(os.getenv('IDEMPOTENCY_KEY_TTL_SECONDS', 24 * 60 * 60))
+
+# 已結束（已付款 / 付款失敗）的訂單超過此天數後由 archive_orders 搬到封存表
+ORDER_ARCHIVE_AFTER_DAYS = int(os.getenv('ORDER_ARCHIVE_AFTER_DAYS', 365))
+
+# 綠界回呼事件處理失敗的重試次數上限，超過後標記為 failed 等待人工處理
+PAYMENT_EVENT_MAX_ATTEMPTS = int(os.getenv('PAYMENT_EVENT_MAX_ATTEMPTS', 5))
+
+# worker 取出事件後超過此秒數仍未完成（例如程序中斷），其他 worker 可重新取出
+PAYMENT_EVENT_CLAIM_TIMEOUT_SECONDS = int(os.getenv('PAYMENT_EVENT_CLAIM_TIMEOUT_SECONDS', 300))
+
+# 批次請款 / 退款時每個商店代號每秒最多送出的 DoAction 次數
+CREDIT_ACTION_RATE_PER_SECOND = float(os.getenv('CREDIT_ACTION_RATE_PER_SECOND', 5))
+
+# 未登入購物車的儲存方式：session（預設，存在資料庫的 session）、cookie（簽章 cookie，大購物車改存快取）、cache
+# cookie / cache 不會寫入資料庫；cache 需設定多台共用的 CACHES
+CART_STORAGE = os.getenv('CART_STORAGE', 'session')
+CART_STORAGE_TTL = int(os.getenv('CART_STORAGE_TTL', 30 * 24 * 60 * 60))
+CART_COOKIE_MAX_BYTES = int(os.getenv('CART_COOKIE_MAX_BYTES', 3000))
+
+# 登入用戶購物車數量 / 版本（cart_count 的 ETag）的快取秒數，購物車異動時於交易提交後更新快取
+# 預設的 LocMem 快取各 process 獨立，其他 process（例如 clean_empty_carts）的異動最多延遲此秒數才生效；
+# 多台 / 多 process 部署時需設定共用的 CACHES（例如 Redis），才能立即反映並拉長此秒數
+CART_STATE_CACHE_SECONDS = int(os.getenv('CART_STATE_CACHE_SECONDS', 60))
+
+# clean_empty_carts 的保留天數：空購物車、久未更新的購物車商品
+CART_RETENTION_DAYS = int(os.getenv('CART_RETENTION_DAYS', 30))
+CART_ITEM_RETENTION_DAYS = int(os.getenv('CART_ITEM_RETENTION_DAYS', 90))
@@ -0,0 +1,71 @@
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .models import ArchivedOrder, ArchivedOrderItem, Order, OrderItem, OrderVendor, StockReservation
+from .services import invalidate_order_history
+
+# 只有狀態已結束的訂單才會封存
+CLOSED_STATUSES = (Order.STATUS_PAID, Order.STATUS_FAILED, Order.STATUS_REFUNDED)
+
+ORDER_ARCHIVE_FIELDS = (
+    'id', 'user_id', 'total_amount', 'status', 'created_at', 'paid_at', 'merchant_trade_no', 'refunded_amount',
+    'stock_shortfall',
+)
+ITEM_ARCHIVE_FIELDS = (
+    'id', 'order_id', 'product_id', 'quantity', 'price', 'product_name', 'vendor_name', 'image_url',
+)
+
+
+def archive_cutoff(days=None):
+    """早於此時間建立的已結束訂單會被封存"""
+    if days is None:
+        days = settings.ORDER_ARCHIVE_AFTER_DAYS
+    return timezone.now() - timedelta(days=days)
+
+
+def archivable_orders(cutoff):
+    return Order.objects.filter(status__in=CLOSED_STATUSES, created_at__lt=cutoff)
+
+
+def _archive_batch(order_ids):
+    with transaction.atomic():
+        orders = list(
+            Order.objects.filter(pk__in=order_ids, status__in=CLOSED_STATUSES)
+            .values(*ORDER_ARCHIVE_FIELDS)
+        )
+        ids = [order['id'] for order in orders]
+        if not ids:
+            return 0
+
+        ArchivedOrder.objects.bulk_create([ArchivedOrder(**order) for order in orders])
+        ArchivedOrderItem.objects.bulk_create([
+            ArchivedOrderItem(**item)
+            for item in OrderItem.objects.filter(order_id__in=ids).values(*ITEM_ARCHIVE_FIELDS)
+        ])
+
+        # 先刪除子表，讓 Order 的 cascade 不需再逐筆收集
+        StockReservation.objects.filter(order_item__order_id__in=ids).delete()
+        OrderVendor.objects.filter(order_id__in=ids).delete()
+        OrderItem.objects.filter(order_id__in=ids).delete()
+        Order.objects.filter(pk__in=ids).delete()
+
+        user_ids = {order['user_id'] for order in orders}
+        transaction.on_commit(lambda: invalidate_order_history(user_ids))
+    return len(ids)
+
+
+def archive_orders(days=None, batch_size=500):
+    """
+    將超過 days 天（預設 ORDER_ARCHIVE_AFTER_DAYS）的已結束訂單分批搬到封存表，
+    每批一個短交易，回傳封存筆數。
+    """
+    cutoff = archive_cutoff(days)
+    total = 0
+    while True:
+        batch = list(
+            archivable_orders(cutoff).order_by('pk').values_list('pk', flat=True)[:batch_size]
+        )
+        if not batch:
+            return total
+        total += _archive_batch(batch)
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from api.v1.order.archive import archive_cutoff, archivable_orders, archive_orders
+
+
+class Command(BaseCommand):
+    help = '將超過指定天數的已結束訂單搬到封存表'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=settings.ORDER_ARCHIVE_AFTER_DAYS,
+            help=f'封存超過多少天的訂單（默認 {settings.ORDER_ARCHIVE_AFTER_DAYS} 天）'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='每批搬移的訂單數（默認 500）'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='僅顯示將要封存的訂單數，不實際執行',
+        )
+
+    def handle(self, *args, **options):
+        days = options['days']
+
+        if options['dry_run']:
+            count = archivable_orders(archive_cutoff(days)).count()
+            self.stdout.write(self.style.WARNING(f'預覽模式：共有 {count} 筆訂單可封存'))
+            return
+
+        count = archive_orders(days=days, batch_size=options['batch_size'])
+        if count > 0:
+            self.stdout.write(
+                self.style.SUCCESS(f'成功封存了 {count} 筆訂單')
+            )
+        else:
+            self.stdout.write(
+                self.style.WARNING('沒有找到需要封存的訂單')
+            )
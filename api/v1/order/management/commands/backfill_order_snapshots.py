@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Prefetch
+from wagtail.images.models import Image
+from api.v1.order.models import SNAPSHOT_IMAGE_FILTER, Order, OrderItem, build_item_name
+
+
+class Command(BaseCommand):
+    help = '為舊訂單補上明細商品快照與綠界 ItemName'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='每批處理的筆數（默認 500）'
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        items = 0
+        last_pk = 0
+        while True:
+            batch = list(
+                OrderItem.objects.filter(pk__gt=last_pk, product_name='', product__isnull=False)
+                .select_related('product__vendor')
+                .prefetch_related(Prefetch('product__image', queryset=Image.objects.prefetch_renditions(SNAPSHOT_IMAGE_FILTER)))
+                .order_by('pk')[:batch_size]
+            )
+            if not batch:
+                break
+            for item in batch:
+                for field, value in OrderItem.snapshot(item.product).items():
+                    setattr(item, field, value)
+            OrderItem.objects.bulk_update(batch, ['product_name', 'vendor_name', 'image_url'])
+            items += len(batch)
+            last_pk = batch[-1].pk
+
+        orders = 0
+        last_pk = 0
+        while True:
+            batch = list(
+                Order.objects.filter(pk__gt=last_pk, item_name='')
+                .only('pk', 'item_name')
+                .prefetch_related(Prefetch('items', queryset=OrderItem.objects.only('order_id', 'product_name', 'quantity')))
+                .order_by('pk')[:batch_size]
+            )
+            if not batch:
+                break
+            for order in batch:
+                order.item_name = build_item_name(
+                    (item.product_name, item.quantity) for item in order.items.all()
+                )
+            # 以 bulk_update 寫入，不經過 Order.save 的狀態處理
+            Order.objects.bulk_update(batch, ['item_name'])
+            orders += len(batch)
+            last_pk = batch[-1].pk
+
+        self.stdout.write(
+            self.style.SUCCESS(f'成功補上 {items} 筆明細快照與 {orders} 筆訂單的 ItemName')
+        )
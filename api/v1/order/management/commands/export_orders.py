@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+from api.v1.account.models import User
+from api.v1.order.export import export_archived_lines, export_lines, iter_csv, parse_export_range
+
+
+class Command(BaseCommand):
+    help = '串流匯出訂單明細 CSV（可指定商家帳號，套用與後台相同的可見範圍）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', help='起始日期 YYYY-MM-DD（默認 30 天前）')
+        parser.add_argument('--end', help='結束日期 YYYY-MM-DD，當天包含在內（默認今天）')
+        parser.add_argument('--user', help='以此帳號 email 的權限匯出（默認為全部訂單）')
+        parser.add_argument('--output', help='輸出檔案路徑（默認輸出到 stdout）')
+
+    def handle(self, *args, **options):
+        try:
+            start, end = parse_export_range(options['start'], options['end'])
+        except ValueError as e:
+            raise CommandError(f'日期格式錯誤: {e}')
+
+        if options['user']:
+            try:
+                user = User.objects.get(email=options['user'])
+            except User.DoesNotExist:
+                raise CommandError(f'找不到帳號 {options["user"]}')
+        else:
+            user = User(is_superuser=True, is_staff=True)
+
+        rows = iter_csv(export_archived_lines(user, start, end), export_lines(user, start, end))
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8', newline='') as f:
+                for row in rows:
+                    f.write(row)
+            self.stdout.write(self.style.SUCCESS(f'已匯出到 {options["output"]}'))
+        else:
+            for row in rows:
+                self.stdout.write(row, ending='')
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from api.v1.order.models import Order, OrderVendor
+
+
+class Command(BaseCommand):
+    help = '依訂單明細重建訂單與商家的對應索引（OrderVendor）'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='每批處理的訂單數（默認 1000）'
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        last_pk = 0
+        orders = 0
+        links = 0
+
+        while True:
+            order_ids = list(
+                Order.objects.filter(pk__gt=last_pk)
+                .order_by('pk')
+                .values_list('pk', flat=True)[:batch_size]
+            )
+            if not order_ids:
+                break
+            links += OrderVendor.rebuild(order_ids)
+            orders += len(order_ids)
+            last_pk = order_ids[-1]
+
+        self.stdout.write(
+            self.style.SUCCESS(f'成功重建了 {orders} 筆訂單的 {links} 筆商家索引')
+        )
@@ -0,0 +1,44 @@
+import time
+from django.core.management.base import BaseCommand
+from api.v1.order.services import release_expired_reservations
+
+
+class Command(BaseCommand):
+    help = '釋放逾期未付款訂單的庫存保留'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='每批釋放的保留筆數（默認 500）'
+        )
+        parser.add_argument(
+            '--loop',
+            action='store_true',
+            help='持續執行，作為背景 worker'
+        )
+        parser.add_argument(
+            '--interval',
+            type=int,
+            default=60,
+            help='--loop 模式下每輪間隔秒數（默認 60）'
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        while True:
+            released = release_expired_reservations(batch_size=batch_size)
+            if released:
+                self.stdout.write(
+                    self.style.SUCCESS(f'成功釋放了 {released} 筆逾期庫存保留')
+                )
+            elif not options['loop']:
+                self.stdout.write(
+                    self.style.WARNING('沒有找到需要釋放的庫存保留')
+                )
+
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -1,85 +1,173 @@
-from django.db import models
+from collections import defaultdict
+import logging
+from django.db import models, transaction
+from django.utils import timezone
+from django.utils.crypto import get_random_string
 from api.v1.product.models import Product
 from api.v1.account.models import User
-import uuid
+from api.v1.vendor.models import Vendor
+
+logger = logging.getLogger(__name__)
+
+
+def generate_merchant_trade_no():
+    """
+    產生綠界訂單編號（20 碼英數字）：
+    15 碼時間（yymmddHHMMSS + 毫秒）確保依時間排序，後接 5 碼隨機字元避免同毫秒碰撞。
+    """
+    now = timezone.localtime(timezone.now())
+    return f"{now:%y%m%d%H%M%S}{now.microsecond // 1000:03d}" + get_random_string(
+        5, allowed_chars="ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+    )
+
+
+# 綠界 ItemName 欄位長度上限
+ITEM_NAME_MAX_LENGTH = 200
+# 訂單明細快照的商品圖片規格
+SNAPSHOT_IMAGE_FILTER = "fill-80x80"
+
+
+def build_item_name(lines):
+    """
+    依 [(商品名稱, 數量), ...] 組成綠界 ItemName（以 # 分隔），超過長度上限時截斷。
+    """
+    item_name = "#".join(f"{name}*{quantity}" for name, quantity in lines)
+    if len(item_name) > ITEM_NAME_MAX_LENGTH:
+        item_name = item_name[:ITEM_NAME_MAX_LENGTH - 3] + "..."
+    return item_name
+
 
 class Order(models.Model):
     STATUS_PENDING = "pending"
     STATUS_PAID = "paid"
     STATUS_FAILED = "failed"
+    STATUS_REFUNDED = "refunded"
 
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     total_amount = models.DecimalField(max_digits=10, decimal_places=2)
-    status = models.CharField(max_length=20, default=STATUS_PENDING)  # pending / paid / failed
+    status = models.CharField(max_length=20, default=STATUS_PENDING)  # pending / paid / failed / refunded
     created_at = models.DateTimeField(auto_now_add=True)
     paid_at = models.DateTimeField(null=True, blank=True)  # 付款時間
     merchant_trade_no = models.CharField(max_length=20, blank=True, unique=True)
+    item_name = models.CharField(max_length=ITEM_NAME_MAX_LENGTH, blank=True)  # 建單時預先組好的綠界 ItemName
+    payment_checked_at = models.DateTimeField(null=True, blank=True)  # 最後一次主動向綠界查詢付款狀態的時間
+    refunded_amount = models.DecimalField(max_digits=10, decimal_places=2, default=0)  # 已退款金額（可部分退款）
+    # 庫存保留已釋放後才付款且庫存不足（超賣），需人工安排補貨或退款
+    stock_shortfall = models.BooleanField(default=False)
+
+    _loaded_status = None
+    is_archived = False
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "created_at"], name="order_status_created_idx"),
+            models.Index(fields=["created_at"], name="order_created_idx"),
+        ]
 
     def get_total_items_count(self):
         """獲取訂單中商品總數量"""
         return sum(item.quantity for item in self.items.all())
     
+    def get_item_name(self):
+        """綠界 ItemName，舊訂單沒有預先組好時才由明細快照組出"""
+        if self.item_name:
+            return self.item_name
+        return build_item_name(self.items.values_list("product_name", "quantity"))
+
     def recalculate_total(self):
         """重新計算訂單總金額"""
         total = sum(item.get_total() for item in self.items.all())
         self.total_amount = total
         return total
 
+    def apply_sales_delta(self, sign):
+        """依訂單明細對商品銷售數量加減（sign 為 1 或 -1），單一 UPDATE 完成"""
+        quantities = defaultdict(int)
+        for product_id, quantity in self.items.values_list('product_id', 'quantity'):
+            quantities[product_id] += sign * quantity
+        Product.apply_sales_delta(quantities)
+
     def update_status(self, new_status):
-        """更新訂單狀態並處理相關邏輯"""
-        old_status = self.status
+        """更新訂單狀態並處理相關邏輯（銷售統計由 save 依狀態變更處理）"""
         self.status = new_status
-        
-        # 如果從未付款狀態變為已付款，更新商品銷售統計
-        if old_status != self.STATUS_PAID and new_status == self.STATUS_PAID:
-            for item in self.items.all():
-                item.product.update_sales_count()
-        
-        # 如果從已付款狀態變為其他狀態，需要重新計算銷售統計
-        elif old_status == self.STATUS_PAID and new_status != self.STATUS_PAID:
-            for item in self.items.all():
-                item.product.update_sales_count()
-        
         self.save()
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # 記住載入時的狀態，save 時不需重新讀取即可判斷狀態變更
+        if 'status' in field_names:
+            instance._loaded_status = instance.status
+        return instance
+
+    def _previous_status(self):
+        if self._loaded_status is not None:
+            return self._loaded_status
+        # status 欄位被 defer 時才回資料庫讀取
+        return Order.objects.filter(pk=self.pk).values_list('status', flat=True).first()
+
     def save(self, *args, **kwargs):
-        # 檢查狀態是否有變更
-        if self.pk:  # 如果是更新現有訂單
-            old_order = Order.objects.filter(pk=self.pk).first()
-            if old_order and old_order.status != self.status:
-                # 狀態有變更，處理銷售統計
-                if old_order.status != self.STATUS_PAID and self.status == self.STATUS_PAID:
+        # 新訂單在寫入前就產生 merchant_trade_no，只需一次 INSERT
+        if not self.merchant_trade_no:
+            self.merchant_trade_no = generate_merchant_trade_no()
+
+        sales_sign = 0
+        status_changed = False
+        if self.pk and not self._state.adding:
+            old_status = self._previous_status()
+            if old_status != self.status:
+                status_changed = True
+                if old_status != self.STATUS_PAID and self.status == self.STATUS_PAID:
                     # 從未付款變為已付款，設置付款時間並增加銷售統計
-                    from django.utils import timezone
                     if not self.paid_at:
                         self.paid_at = timezone.now()
-                    super().save(*args, **kwargs)  # 先保存訂單狀態
-                    for item in self.items.all():
-                        item.product.update_sales_count()
-                    return
-                elif old_order.status == self.STATUS_PAID and self.status != self.STATUS_PAID:
-                    # 從已付款變為其他狀態，清除付款時間並重新計算銷售統計
+                    sales_sign = 1
+                elif old_status == self.STATUS_PAID and self.status != self.STATUS_PAID:
+                    # 從已付款變為其他狀態，清除付款時間並扣回銷售統計
                     self.paid_at = None
-                    super().save(*args, **kwargs)
-                    for item in self.items.all():
-                        item.product.update_sales_count()
-                    return
-        
-        # 如果還沒有 merchant_trade_no，先存一次產生 id
-        if not self.merchant_trade_no:
-            super().save(*args, **kwargs)  # 先存一次，產生 self.id
-            self.merchant_trade_no = f"{self.id}{uuid.uuid4().hex[:6].upper()}"
-            kwargs['force_insert'] = False  # 避免重複插入
-        super().save(*args, **kwargs)  # 再存一次更新 merchant_trade_no
-        
+                    sales_sign = -1
+
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if sales_sign:
+                self.apply_sales_delta(sales_sign)
+            if status_changed:
+                # 同步商家訂單索引的狀態
+                self.vendor_links.update(status=self.status)
+        self._loaded_status = self.status
+
     def __str__(self):
         return f"Order {self.id} by {self.user.email}"
 
 class OrderItem(models.Model):
     order = models.ForeignKey(Order, related_name="items", on_delete=models.CASCADE)
-    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    # 商品刪除後保留明細，顯示時使用下方的快照欄位
+    product = models.ForeignKey(Product, null=True, on_delete=models.SET_NULL)
     quantity = models.PositiveIntegerField(default=1)
     price = models.DecimalField(max_digits=10, decimal_places=2)
+    # 建單當下的商品快照，訂單頁面與結帳不需再 join Product / Vendor / Image
+    product_name = models.CharField(max_length=100, blank=True)
+    vendor_name = models.CharField(max_length=100, blank=True)
+    image_url = models.CharField(max_length=255, blank=True)
+
+    @classmethod
+    def snapshot(cls, product):
+        """
+        取得商品快照欄位（product 需已載入 vendor，image 需已 prefetch_renditions(SNAPSHOT_IMAGE_FILTER)）。
+        縮圖可能需要查詢或產生圖檔，應在建單交易之外呼叫。
+        圖片縮圖無法產生時（例如原始檔遺失）留空，不影響建單。
+        """
+        image_url = ""
+        if product.image_id:
+            try:
+                image_url = product.image.get_rendition(SNAPSHOT_IMAGE_FILTER).url
+            except Exception:
+                logger.warning("Cannot render snapshot image for product %s", product.pk, exc_info=True)
+        return {
+            "product_name": product.name,
+            "vendor_name": product.vendor.name if product.vendor_id else "",
+            "image_url": image_url,
+        }
 
     def get_total(self):
         """計算該項目的總價 (數量 x 單價)"""
@@ -96,11 +184,134 @@ class OrderItem(models.Model):
         # self.product.update_sales_count()
 
     def delete(self, *args, **kwargs):
-        product = self.product
+        from .services import invalidate_order_history
+        product_id = self.product_id
+        quantity = self.quantity
         super().delete(*args, **kwargs)
         # 如果該訂單已付款，需要減少銷售統計
-        if self.order.status == Order.STATUS_PAID:
-            product.update_sales_count()
+        if product_id and self.order.status == Order.STATUS_PAID:
+            Product.apply_sales_delta({product_id: -quantity})
+        invalidate_order_history([self.order.user_id])
+
+    def __str__(self):
+        return f"{self.product_name} x {self.quantity}"
+
+
+class OrderVendor(models.Model):
+    """
+    訂單與商家的對應索引（反正規化），商家後台以 (vendor, status, created_at) 索引直接查詢，
+    不需再經過 OrderItem -> Product -> Vendor 的多表 join 與 distinct。
+    status / created_at 為訂單欄位的副本，由 Order.save 及批次狀態更新同步。
+    """
+    order = models.ForeignKey(Order, related_name="vendor_links", on_delete=models.CASCADE)
+    vendor = models.ForeignKey(Vendor, related_name="order_links", on_delete=models.CASCADE)
+    status = models.CharField(max_length=20)
+    created_at = models.DateTimeField()
+
+    class Meta:
+        unique_together = ("order", "vendor")
+        indexes = [
+            models.Index(fields=["vendor", "status", "created_at"], name="order_vendor_status_idx"),
+        ]
+
+    def __str__(self):
+        return f"Order {self.order_id} / Vendor {self.vendor_id}"
+
+    @classmethod
+    def rebuild(cls, order_ids):
+        """
+        依訂單明細重建指定訂單的商家索引，回傳建立筆數。
+        商品已刪除的明細（product 為 NULL）無法得知商家，略過不建立。
+        """
+        rows = (
+            OrderItem.objects.filter(order_id__in=order_ids, product__isnull=False)
+            .values_list("order_id", "product__vendor_id", "order__status", "order__created_at")
+            .distinct()
+        )
+        links = [
+            cls(order_id=order_id, vendor_id=vendor_id, status=status, created_at=created_at)
+            for order_id, vendor_id, status, created_at in rows
+        ]
+        with transaction.atomic():
+            cls.objects.filter(order_id__in=order_ids).delete()
+            cls.objects.bulk_create(links)
+        return len(links)
+
+
+class StockReservation(models.Model):
+    """訂單明細的庫存保留，逾期未付款由 release_expired_reservations 釋放"""
+    STATUS_HELD = "held"
+    STATUS_RELEASED = "released"
+    STATUS_CONSUMED = "consumed"
+
+    order_item = models.OneToOneField(OrderItem, related_name="reservation", on_delete=models.CASCADE)
+    product = models.ForeignKey(Product, related_name="+", on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField()
+    status = models.CharField(max_length=10, default=STATUS_HELD)  # held / released / consumed
+    expires_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    released_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # 「已逾期且仍保留中」的查詢只掃描 held 的部分
+            models.Index(
+                fields=["expires_at"],
+                condition=models.Q(status="held"),
+                name="order_resv_held_expires_idx",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id} x {self.quantity} ({self.status})"
+
+
+class ArchivedOrder(models.Model):
+    """
+    已封存的舊訂單（冷資料），由 archive_orders 從 Order 搬移過來，保留原本的 id。
+    欄位名稱與 Order 相同，模板可直接共用。
+    """
+    id = models.BigIntegerField(primary_key=True)
+    user = models.ForeignKey(User, related_name="+", on_delete=models.CASCADE)
+    total_amount = models.DecimalField(max_digits=10, decimal_places=2)
+    status = models.CharField(max_length=20)
+    created_at = models.DateTimeField()
+    paid_at = models.DateTimeField(null=True, blank=True)
+    merchant_trade_no = models.CharField(max_length=20, unique=True)
+    refunded_amount = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    stock_shortfall = models.BooleanField(default=False)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    is_archived = True
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "created_at"], name="order_archived_user_idx"),
+            models.Index(fields=["status", "created_at"], name="order_archived_status_idx"),
+        ]
+
+    def __str__(self):
+        return f"Archived order {self.id} by {self.user.email}"
+
+
+class ArchivedOrderItem(models.Model):
+    """已封存訂單的明細"""
+    id = models.BigIntegerField(primary_key=True)
+    order = models.ForeignKey(ArchivedOrder, related_name="items", on_delete=models.CASCADE)
+    product = models.ForeignKey(Product, null=True, related_name="+", on_delete=models.SET_NULL)
+    quantity = models.PositiveIntegerField()
+    price = models.DecimalField(max_digits=10, decimal_places=2)
+    product_name = models.CharField(max_length=100, blank=True)
+    vendor_name = models.CharField(max_length=100, blank=True)
+    image_url = models.CharField(max_length=255, blank=True)
+
+    def get_total(self):
+        """計算該項目的總價 (數量 x 單價)"""
+        return self.quantity * self.price
+
+    @property
+    def total(self):
+        return self.get_total()
 
     def __str__(self):
-        return f"{self.product.name} x {self.quantity}"
+        return f"{self.product_name} x {self.quantity}"
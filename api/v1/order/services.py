@@ -0,0 +1,455 @@
+from collections import OrderedDict, defaultdict
+from datetime import timedelta
+import logging
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Case, DecimalField, F, PositiveIntegerField, Prefetch, Value, When
+from django.utils import timezone
+from django.utils.crypto import get_random_string
+from wagtail.images.models import Image
+from api.v1.product.models import Product
+from .models import SNAPSHOT_IMAGE_FILTER, Order, OrderItem, OrderVendor, StockReservation, build_item_name
+
+logger = logging.getLogger(__name__)
+
+
+class OrderLineError(Exception):
+    """訂單明細無效（商品不存在、數量錯誤等）"""
+
+
+class InsufficientStockError(Exception):
+    """一或多個明細庫存不足，failures 為失敗明細清單"""
+
+    def __init__(self, failures):
+        self.failures = failures
+        super().__init__(
+            "; ".join(
+                f"Insufficient stock for {f['name']}. Available: {f['available']}, Requested: {f['requested']}"
+                for f in failures
+            )
+        )
+
+
+def normalize_lines(items_data):
+    """
+    將前端送來的明細整理為 {product_id: quantity}，同商品合併數量。
+    """
+    lines = OrderedDict()
+    for item in items_data:
+        try:
+            product_id = int(item.get("product_id", 0))
+            quantity = int(item.get("quantity", 1))
+        except (AttributeError, ValueError, TypeError):
+            raise OrderLineError(f"Invalid product data: {item}")
+
+        if quantity <= 0:
+            raise OrderLineError(f"Invalid quantity for product {product_id}")
+
+        lines[product_id] = lines.get(product_id, 0) + quantity
+    return lines
+
+
+def _reserve_stock(lines):
+    """
+    以條件式 F() 更新扣庫存（stock >= qty），回傳扣減失敗的商品 id。
+    """
+    failed_ids = []
+    for product_id, quantity in lines.items():
+        updated = Product.objects.filter(
+            pk=product_id, stock__gte=quantity
+        ).update(stock=F("stock") - quantity)
+        if not updated:
+            failed_ids.append(product_id)
+    return failed_ids
+
+
+def _stock_failures(products, lines, failed_ids):
+    current = Product.objects.filter(pk__in=failed_ids).values_list("pk", "stock")
+    available = dict(current)
+    return [
+        {
+            "product_id": product_id,
+            "name": products[product_id].name,
+            "available": available.get(product_id, 0),
+            "requested": lines[product_id],
+        }
+        for product_id in failed_ids
+    ]
+
+
+def create_order(user, items_data):
+    """
+    建立訂單：一次載入所有商品並在交易外備妥商品快照，再於同一個交易內條件式扣庫存、bulk_create 明細。
+
+    回傳 (order, order_items)；庫存不足時拋出 InsufficientStockError 並整筆回滾。
+    """
+    lines = normalize_lines(items_data)
+    if not lines:
+        raise OrderLineError("No items provided")
+
+    # 快照縮圖一次預先載入；缺少的縮圖在下方交易外產生，不在持有寫入鎖時查詢或產生圖檔
+    products = (
+        Product.objects.filter(is_active=True)
+        .select_related("vendor")
+        .prefetch_related(Prefetch("image", queryset=Image.objects.prefetch_renditions(SNAPSHOT_IMAGE_FILTER)))
+        .in_bulk(list(lines))
+    )
+    missing = [product_id for product_id in lines if product_id not in products]
+    if missing:
+        raise OrderLineError(f"Product not found: {', '.join(map(str, missing))}")
+
+    # 先以已載入的庫存快速檢查，避免明顯失敗時還開交易
+    failures = [
+        {
+            "product_id": product_id,
+            "name": products[product_id].name,
+            "available": products[product_id].stock,
+            "requested": quantity,
+        }
+        for product_id, quantity in lines.items()
+        if products[product_id].stock < quantity
+    ]
+    if failures:
+        raise InsufficientStockError(failures)
+
+    total_amount = sum(products[pid].price * qty for pid, qty in lines.items())
+    item_name = build_item_name((products[pid].name, qty) for pid, qty in lines.items())
+    snapshots = {pid: OrderItem.snapshot(products[pid]) for pid in lines}
+
+    with transaction.atomic():
+        failed_ids = _reserve_stock(lines)
+        if failed_ids:
+            # 併發下單搶走庫存：整筆回滾並回報失敗明細
+            raise InsufficientStockError(_stock_failures(products, lines, failed_ids))
+
+        order = Order.objects.create(user=user, total_amount=total_amount, item_name=item_name)
+
+        order_items = OrderItem.objects.bulk_create([
+            OrderItem(
+                order=order,
+                product=products[product_id],
+                quantity=quantity,
+                price=products[product_id].price,
+                **snapshots[product_id],
+            )
+            for product_id, quantity in lines.items()
+        ])
+
+        OrderVendor.objects.bulk_create([
+            OrderVendor(order=order, vendor_id=vendor_id, status=order.status, created_at=order.created_at)
+            for vendor_id in {products[product_id].vendor_id for product_id in lines}
+        ])
+
+        expires_at = timezone.now() + timedelta(minutes=settings.ORDER_RESERVATION_TTL_MINUTES)
+        StockReservation.objects.bulk_create([
+            StockReservation(
+                order_item=oi,
+                product_id=oi.product_id,
+                quantity=oi.quantity,
+                expires_at=expires_at,
+            )
+            for oi in order_items
+        ])
+
+    return order, order_items
+
+
+def _restock(quantities):
+    """
+    依 {product_id: quantity} 把庫存加回去，單一 UPDATE 完成。
+    """
+    if not quantities:
+        return
+    delta = Case(
+        *[When(pk=product_id, then=Value(qty)) for product_id, qty in quantities.items()],
+        default=Value(0),
+        output_field=PositiveIntegerField(),
+    )
+    Product.objects.filter(pk__in=list(quantities)).update(stock=F("stock") + delta)
+
+
+def _release(reservations):
+    """
+    釋放保留中的庫存並歸還商品庫存，回傳釋放筆數。
+    """
+    with transaction.atomic():
+        rows = list(
+            reservations.select_for_update()
+            .filter(status=StockReservation.STATUS_HELD)
+            .values_list("pk", "product_id", "quantity")
+        )
+        if not rows:
+            return 0
+
+        StockReservation.objects.filter(pk__in=[row[0] for row in rows]).update(
+            status=StockReservation.STATUS_RELEASED,
+            released_at=timezone.now(),
+        )
+
+        quantities = defaultdict(int)
+        for _, product_id, quantity in rows:
+            quantities[product_id] += quantity
+        _restock(quantities)
+
+    return len(rows)
+
+
+def release_order_reservations(order):
+    """立即釋放訂單的庫存保留（例如付款失敗時）"""
+    return _release(StockReservation.objects.filter(order_item__order=order))
+
+
+def renew_order_reservations(order):
+    """
+    結帳前重新保留已釋放的庫存（保留逾期後買家才再次前往付款），並重新計算保留期限。
+
+    以條件式 F() 更新重新扣庫存，任一商品庫存不足時整筆回滾並回傳 False，訂單不應再送去付款。
+    """
+    with transaction.atomic():
+        released = list(
+            StockReservation.objects.select_for_update()
+            .filter(order_item__order=order, status=StockReservation.STATUS_RELEASED)
+            .values_list("pk", "product_id", "quantity")
+        )
+        if not released:
+            return True
+
+        quantities = defaultdict(int)
+        for _, product_id, quantity in released:
+            quantities[product_id] += quantity
+        if _reserve_stock(quantities):
+            transaction.set_rollback(True)
+            return False
+
+        StockReservation.objects.filter(pk__in=[row[0] for row in released]).update(
+            status=StockReservation.STATUS_HELD,
+            released_at=None,
+            expires_at=timezone.now() + timedelta(minutes=settings.ORDER_RESERVATION_TTL_MINUTES),
+        )
+    return True
+
+
+def release_expired_reservations(batch_size=500, now=None):
+    """
+    分批釋放已逾期的庫存保留，每批一個短交易，回傳總釋放筆數。
+
+    只歸還庫存，訂單維持 pending：ATM / 超商付款可能在數天後才完成，
+    付款失敗與否仍以綠界通知或 poll_pending_orders 的查詢結果為準。
+    買家再次結帳時由 renew_order_reservations 重新保留，庫存不足則拒絕付款。
+    """
+    now = now or timezone.now()
+    total = 0
+    while True:
+        batch = list(
+            StockReservation.objects.filter(
+                status=StockReservation.STATUS_HELD,
+                expires_at__lte=now,
+            ).order_by("expires_at").values_list("pk", flat=True)[:batch_size]
+        )
+        if not batch:
+            return total
+        total += _release(StockReservation.objects.filter(pk__in=batch))
+
+
+def _consume(reservations):
+    """
+    保留轉為正式扣庫存。
+
+    若保留已被釋放（付款晚於保留期限），重新以條件式更新扣庫存；
+    庫存不足時（已被其他訂單買走）將訂單標記為 stock_shortfall，交由人工補貨或退款。
+    """
+    with transaction.atomic():
+        reservations.filter(status=StockReservation.STATUS_HELD).update(
+            status=StockReservation.STATUS_CONSUMED
+        )
+
+        released = list(
+            reservations.select_for_update()
+            .filter(status=StockReservation.STATUS_RELEASED)
+            .values_list("pk", "product_id", "quantity", "order_item__order_id")
+        )
+        shortfall_order_ids = set()
+        for _, product_id, quantity, order_id in released:
+            updated = Product.objects.filter(
+                pk=product_id, stock__gte=quantity
+            ).update(stock=F("stock") - quantity)
+            if not updated:
+                logger.warning(
+                    "Order %s paid after reservation expired; product %s oversold by %s",
+                    order_id, product_id, quantity,
+                )
+                shortfall_order_ids.add(order_id)
+        if shortfall_order_ids:
+            Order.objects.filter(pk__in=shortfall_order_ids).update(stock_shortfall=True)
+        if released:
+            StockReservation.objects.filter(pk__in=[row[0] for row in released]).update(
+                status=StockReservation.STATUS_CONSUMED
+            )
+
+
+def consume_order_reservations(order):
+    """訂單付款完成：保留轉為正式扣庫存"""
+    _consume(StockReservation.objects.filter(order_item__order=order))
+
+
+# 可轉為已付款的狀態：已付款（重複通知）與已退款（遲到或重送的通知）都不可再轉回 paid
+PAYABLE_STATUSES = (Order.STATUS_PENDING, Order.STATUS_FAILED)
+
+
+def mark_order_paid(merchant_trade_no, paid_at=None):
+    """
+    綠界付款成功通知：以單一條件式 UPDATE（status 為 pending / failed）轉為已付款。
+
+    只有實際變更了資料列才執行銷售統計、商家索引與庫存保留等後續處理並回傳訂單；
+    重複通知（已付款）、已退款訂單的遲到通知或查無訂單時回傳 None，
+    只花費一次以 merchant_trade_no 索引的 UPDATE。
+    """
+    with transaction.atomic():
+        updated = Order.objects.filter(
+            merchant_trade_no=merchant_trade_no, status__in=PAYABLE_STATUSES
+        ).update(status=Order.STATUS_PAID, paid_at=paid_at or timezone.now())
+        if not updated:
+            return None
+
+        order = Order.objects.get(merchant_trade_no=merchant_trade_no)
+        order.apply_sales_delta(1)
+        order.vendor_links.update(status=Order.STATUS_PAID)
+        consume_order_reservations(order)
+        transaction.on_commit(lambda: invalidate_order_history([order.user_id]))
+    return order
+
+
+def mark_order_failed(merchant_trade_no):
+    """
+    綠界付款失敗通知：只把仍在 pending 的訂單轉為 failed（不會覆蓋已付款的訂單），
+    實際變更時才歸還保留的庫存並回傳訂單，否則回傳 None。
+    """
+    with transaction.atomic():
+        updated = Order.objects.filter(
+            merchant_trade_no=merchant_trade_no, status=Order.STATUS_PENDING
+        ).update(status=Order.STATUS_FAILED)
+        if not updated:
+            return None
+
+        order = Order.objects.get(merchant_trade_no=merchant_trade_no)
+        order.vendor_links.update(status=Order.STATUS_FAILED)
+        release_order_reservations(order)
+        transaction.on_commit(lambda: invalidate_order_history([order.user_id]))
+    return order
+
+
+def mark_orders_paid(merchant_trade_nos, paid_at=None):
+    """
+    批次版 mark_order_paid（例如主動查詢綠界的結果）：
+    鎖定 pending / failed 的訂單後以一次 UPDATE 轉為已付款，銷售統計、商家索引與庫存保留也各以一次批次更新處理。
+    回傳實際轉換的訂單 id。
+    """
+    with transaction.atomic():
+        rows = list(
+            Order.objects.select_for_update()
+            .filter(merchant_trade_no__in=list(merchant_trade_nos), status__in=PAYABLE_STATUSES)
+            .values_list("pk", "user_id")
+        )
+        if not rows:
+            return []
+        order_ids = [pk for pk, _ in rows]
+
+        Order.objects.filter(pk__in=order_ids).update(
+            status=Order.STATUS_PAID, paid_at=paid_at or timezone.now()
+        )
+        quantities = defaultdict(int)
+        for product_id, quantity in OrderItem.objects.filter(order_id__in=order_ids).values_list(
+            "product_id", "quantity"
+        ):
+            if product_id:
+                quantities[product_id] += quantity
+        Product.apply_sales_delta(quantities)
+        OrderVendor.objects.filter(order_id__in=order_ids).update(status=Order.STATUS_PAID)
+        _consume(StockReservation.objects.filter(order_item__order_id__in=order_ids))
+
+        user_ids = {user_id for _, user_id in rows}
+        transaction.on_commit(lambda: invalidate_order_history(user_ids))
+    return order_ids
+
+
+def mark_orders_failed(merchant_trade_nos):
+    """批次版 mark_order_failed：只轉換仍在 pending 的訂單並歸還庫存保留，回傳實際轉換的訂單 id"""
+    with transaction.atomic():
+        rows = list(
+            Order.objects.select_for_update()
+            .filter(merchant_trade_no__in=list(merchant_trade_nos), status=Order.STATUS_PENDING)
+            .values_list("pk", "user_id")
+        )
+        if not rows:
+            return []
+        order_ids = [pk for pk, _ in rows]
+
+        Order.objects.filter(pk__in=order_ids).update(status=Order.STATUS_FAILED)
+        OrderVendor.objects.filter(order_id__in=order_ids).update(status=Order.STATUS_FAILED)
+        _release(StockReservation.objects.filter(order_item__order_id__in=order_ids))
+
+        user_ids = {user_id for _, user_id in rows}
+        transaction.on_commit(lambda: invalidate_order_history(user_ids))
+    return order_ids
+
+
+def apply_order_refunds(refunds):
+    """
+    批次記錄綠界已完成的退款（refunds 為 {merchant_trade_no: 退款金額}）：
+    以一次 UPDATE 累加 refunded_amount，累計退款達訂單金額的已付款訂單轉為 refunded，
+    銷售統計與商家索引各以一次批次更新處理。回傳轉為 refunded 的訂單 id。
+    """
+    with transaction.atomic():
+        rows = list(
+            Order.objects.select_for_update()
+            .filter(merchant_trade_no__in=list(refunds))
+            .values_list("pk", "user_id")
+        )
+        if not rows:
+            return []
+        locked_ids = [pk for pk, _ in rows]
+
+        Order.objects.filter(pk__in=locked_ids).update(refunded_amount=F("refunded_amount") + Case(
+            *[When(merchant_trade_no=no, then=Value(amount)) for no, amount in refunds.items()],
+            default=Value(0),
+            output_field=DecimalField(max_digits=10, decimal_places=2),
+        ))
+        order_ids = list(
+            Order.objects.filter(
+                pk__in=locked_ids, status=Order.STATUS_PAID, refunded_amount__gte=F("total_amount")
+            ).values_list("pk", flat=True)
+        )
+        if order_ids:
+            Order.objects.filter(pk__in=order_ids).update(status=Order.STATUS_REFUNDED)
+            quantities = defaultdict(int)
+            for product_id, quantity in OrderItem.objects.filter(order_id__in=order_ids).values_list(
+                "product_id", "quantity"
+            ):
+                if product_id:
+                    quantities[product_id] -= quantity
+            Product.apply_sales_delta(quantities)
+            OrderVendor.objects.filter(order_id__in=order_ids).update(status=Order.STATUS_REFUNDED)
+
+        user_ids = {user_id for _, user_id in rows}
+        transaction.on_commit(lambda: invalidate_order_history(user_ids))
+    return order_ids
+
+
+def _order_history_version_key(user_id):
+    return f"order_history_version_{user_id}"
+
+
+def order_history_cache_key(user_id, status, page, archived=False):
+    """訂單紀錄快取鍵，包含使用者的版本號，訂單變更時更換版本即失效"""
+    version = cache.get_or_set(_order_history_version_key(user_id), get_random_string(8), None)
+    scope = "all" if archived else "hot"
+    return f"order_history_{user_id}_v{version}_{scope}_{status}_{page}"
+
+
+def invalidate_order_history(user_ids):
+    """使指定使用者的訂單紀錄快取失效（queryset.update 不會觸發 signal，需自行呼叫）"""
+    cache.set_many(
+        {_order_history_version_key(user_id): get_random_string(8) for user_id in user_ids},
+        None,
+    )
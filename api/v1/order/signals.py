@@ -0,0 +1,11 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import Order
+from .services import invalidate_order_history
+
+
+@receiver(post_save, sender=Order)
+@receiver(post_delete, sender=Order)
+def invalidate_history_on_order_change(sender, instance, **kwargs):
+    invalidate_order_history([instance.user_id])
+
@@ -0,0 +1,586 @@
+from datetime import timedelta
+import json
+from unittest import mock
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth import get_user_model
+from django.utils import timezone
+from api.v1.vendor.models import Vendor, VendorCategory
+from api.v1.product.models import Product
+from api.v1.order.models import ArchivedOrder, Order, OrderItem, OrderVendor, StockReservation
+from api.v1.order import archive, export, services
+from api.v1.order.views import _order_history_payload
+from api.v1.payment.ecpay_payment_sdk import generate_check_mac_value
+from api.v1.payment.models import PaymentEvent
+from api.v1.payment.services import process_payment_events
+
+User = get_user_model()
+
+
+class OrderServiceTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            email='buyer@example.com',
+            password='testpass123'
+        )
+        vendor_user = User.objects.create_user(
+            email='vendor@example.com',
+            password='testpass123'
+        )
+        category = VendorCategory.objects.create(
+            name='測試分類',
+            slug='test-category'
+        )
+        self.vendor = Vendor.objects.create(
+            user=vendor_user,
+            name='測試小農',
+            category=category
+        )
+        self.apple = Product.objects.create(
+            vendor=self.vendor, name='蘋果', price=100, stock=10
+        )
+        self.pear = Product.objects.create(
+            vendor=self.vendor, name='梨子', price=50, stock=1
+        )
+
+
+class CreateOrderServiceTest(OrderServiceTestCase):
+    def test_lines_keep_product_snapshot(self):
+        """測試明細保存商品快照，商品刪除後明細仍保留"""
+        order, _ = services.create_order(self.user, [
+            {'product_id': self.apple.id, 'quantity': 2},
+            {'product_id': self.pear.id, 'quantity': 1},
+        ])
+        self.assertEqual(order.item_name, '蘋果*2#梨子*1')
+
+        self.pear.delete()
+        item = OrderItem.objects.get(order=order, product_name='梨子')
+        self.assertIsNone(item.product_id)
+        self.assertEqual(item.vendor_name, '測試小農')
+        self.assertEqual(order.get_item_name(), '蘋果*2#梨子*1')
+
+    def test_snapshot_built_outside_transaction(self):
+        """測試商品快照（含縮圖）在扣庫存的交易之外產生"""
+        depths = []
+        snapshot = OrderItem.snapshot
+
+        def record_depth(product):
+            depths.append(len(connection.atomic_blocks))
+            return snapshot(product)
+
+        outer = len(connection.atomic_blocks)
+        with mock.patch.object(OrderItem, 'snapshot', side_effect=record_depth):
+            services.create_order(self.user, [
+                {'product_id': self.apple.id, 'quantity': 1},
+                {'product_id': self.pear.id, 'quantity': 1},
+            ])
+        self.assertEqual(depths, [outer, outer])
+
+    def test_create_order_decrements_stock(self):
+        """測試建立訂單並扣除庫存"""
+        order, items = services.create_order(self.user, [
+            {'product_id': self.apple.id, 'quantity': 2},
+            {'product_id': self.pear.id, 'quantity': 1},
+        ])
+
+        self.assertEqual(order.total_amount, 250)
+        self.assertEqual(len(items), 2)
+        self.apple.refresh_from_db()
+        self.pear.refresh_from_db()
+        self.assertEqual(self.apple.stock, 8)
+        self.assertEqual(self.pear.stock, 0)
+
+    def test_duplicate_lines_are_merged(self):
+        """測試同商品多筆明細合併數量"""
+        order, items = services.create_order(self.user, [
+            {'product_id': self.apple.id, 'quantity': 1},
+            {'product_id': self.apple.id, 'quantity': 2},
+        ])
+        self.assertEqual(len(items), 1)
+        self.assertEqual(items[0].quantity, 3)
+
+    def test_insufficient_stock_reports_failed_lines(self):
+        """測試庫存不足時回報失敗明細且不建立訂單"""
+        with self.assertRaises(services.InsufficientStockError) as ctx:
+            services.create_order(self.user, [
+                {'product_id': self.apple.id, 'quantity': 2},
+                {'product_id': self.pear.id, 'quantity': 5},
+            ])
+
+        failures = ctx.exception.failures
+        self.assertEqual([f['product_id'] for f in failures], [self.pear.id])
+        self.assertEqual(failures[0]['available'], 1)
+        self.assertFalse(Order.objects.exists())
+        self.apple.refresh_from_db()
+        self.assertEqual(self.apple.stock, 10)
+
+    def test_concurrent_stock_loss_rolls_back(self):
+        """測試扣庫存時被搶走庫存會整筆回滾"""
+        lines = services.normalize_lines([
+            {'product_id': self.apple.id, 'quantity': 2},
+            {'product_id': self.pear.id, 'quantity': 1},
+        ])
+        # 模擬另一筆訂單在檢查後搶走庫存
+        original = services._reserve_stock
+
+        def racing_reserve(lines):
+            Product.objects.filter(pk=self.pear.pk).update(stock=0)
+            return original(lines)
+
+        services._reserve_stock = racing_reserve
+        try:
+            with self.assertRaises(services.InsufficientStockError):
+                services.create_order(self.user, [
+                    {'product_id': pid, 'quantity': qty} for pid, qty in lines.items()
+                ])
+        finally:
+            services._reserve_stock = original
+
+        self.assertFalse(OrderItem.objects.exists())
+
+    def test_inactive_product_rejected(self):
+        """測試下架商品無法下單"""
+        self.apple.is_active = False
+        self.apple.save()
+        with self.assertRaises(services.OrderLineError):
+            services.create_order(self.user, [{'product_id': self.apple.id, 'quantity': 1}])
+
+
+class StockReservationTest(OrderServiceTestCase):
+    def _create(self):
+        order, _ = services.create_order(self.user, [
+            {'product_id': self.apple.id, 'quantity': 3},
+        ])
+        return order
+
+    def test_create_order_holds_stock(self):
+        """測試建立訂單時產生庫存保留"""
+        order = self._create()
+        reservation = StockReservation.objects.get(order_item__order=order)
+        self.assertEqual(reservation.status, StockReservation.STATUS_HELD)
+        self.assertEqual(reservation.quantity, 3)
+
+    def test_release_expired_reservations(self):
+        """測試逾期保留釋放庫存，訂單維持未付款等待較晚完成的付款"""
+        order = self._create()
+        released = services.release_expired_reservations(
+            now=timezone.now() + timedelta(days=1)
+        )
+
+        self.assertEqual(released, 1)
+        self.apple.refresh_from_db()
+        self.assertEqual(self.apple.stock, 10)
+        order.refresh_from_db()
+        self.assertEqual(order.status, Order.STATUS_PENDING)
+        # 重複執行不會重複歸還
+        self.assertEqual(services.release_expired_reservations(
+            now=timezone.now() + timedelta(days=1)
+        ), 0)
+        self.apple.refresh_from_db()
+        self.assertEqual(self.apple.stock, 10)
+
+    def test_unexpired_reservations_are_kept(self):
+        """測試未逾期的保留不會被釋放"""
+        self._create()
+        self.assertEqual(services.release_expired_reservations(), 0)
+
+    def test_consume_after_release_rededucts_stock(self):
+        """測試保留釋放後才付款會重新扣庫存"""
+        order = self._create()
+        services.release_order_reservations(order)
+        services.consume_order_reservations(order)
+
+        self.apple.refresh_from_db()
+        self.assertEqual(self.apple.stock, 7)
+        self.assertEqual(
+            StockReservation.objects.get(order_item__order=order).status,
+            StockReservation.STATUS_CONSUMED,
+        )
+
+
+    def test_checkout_renews_released_reservation(self):
+        """測試保留釋放後再次結帳會重新保留庫存"""
+        order = self._create()
+        services.release_order_reservations(order)
+
+        self.assertTrue(services.renew_order_reservations(order))
+        self.apple.refresh_from_db()
+        self.assertEqual(self.apple.stock, 7)
+        reservation = StockReservation.objects.get(order_item__order=order)
+        self.assertEqual(reservation.status, StockReservation.STATUS_HELD)
+        self.assertGreater(reservation.expires_at, timezone.now())
+
+    def test_checkout_refused_when_released_stock_sold(self):
+        """測試保留釋放後庫存已被買走時拒絕結帳，不會超賣"""
+        order = self._create()
+        services.release_order_reservations(order)
+        Product.objects.filter(pk=self.apple.pk).update(stock=1)
+
+        self.assertFalse(services.renew_order_reservations(order))
+        response = self.client.get(f'/api/v1/payment/checkout/{order.pk}/')
+        self.assertEqual(response.status_code, 409)
+        self.apple.refresh_from_db()
+        self.assertEqual(self.apple.stock, 1)
+        self.assertEqual(
+            StockReservation.objects.get(order_item__order=order).status,
+            StockReservation.STATUS_RELEASED,
+        )
+
+    def test_late_payment_shortfall_flags_order(self):
+        """測試保留釋放後才付款且庫存不足時標記訂單待人工處理"""
+        order = self._create()
+        services.release_order_reservations(order)
+        Product.objects.filter(pk=self.apple.pk).update(stock=0)
+
+        services.mark_order_paid(order.merchant_trade_no)
+        order.refresh_from_db()
+        self.assertEqual(order.status, Order.STATUS_PAID)
+        self.assertTrue(order.stock_shortfall)
+
+
+class SalesCountTest(OrderServiceTestCase):
+    def test_paid_transition_applies_delta(self):
+        """測試付款與取消付款以增減方式更新銷售數量"""
+        order, _ = services.create_order(self.user, [
+            {'product_id': self.apple.id, 'quantity': 2},
+            {'product_id': self.pear.id, 'quantity': 1},
+        ])
+        order.update_status(Order.STATUS_PAID)
+        self.apple.refresh_from_db()
+        self.pear.refresh_from_db()
+        self.assertEqual(self.apple.sales_count, 2)
+        self.assertEqual(self.pear.sales_count, 1)
+
+        order.update_status(Order.STATUS_FAILED)
+        self.apple.refresh_from_db()
+        self.assertEqual(self.apple.sales_count, 0)
+
+    def test_recalculate_sales_counts(self):
+        """測試重新計算銷售數量修正偏差"""
+        order, _ = services.create_order(self.user, [
+            {'product_id': self.apple.id, 'quantity': 2},
+        ])
+        order.update_status(Order.STATUS_PAID)
+        Product.objects.filter(pk=self.apple.pk).update(sales_count=99)
+
+        changes = Product.recalculate_sales_counts()
+
+        self.assertEqual([(p.pk, old, new) for p, old, new in changes], [(self.apple.pk, 99, 2)])
+        self.apple.refresh_from_db()
+        self.assertEqual(self.apple.sales_count, 2)
+
+
+class OrderSaveTest(OrderServiceTestCase):
+    def _writes(self, queries):
+        return [q['sql'] for q in queries if q['sql'].startswith(('INSERT', 'UPDATE'))]
+
+    def test_create_is_single_insert(self):
+        """測試新訂單只寫入一次且已帶有訂單編號"""
+        with CaptureQueriesContext(connection) as ctx:
+            order = Order.objects.create(user=self.user, total_amount=100)
+
+        self.assertEqual(len(self._writes(ctx.captured_queries)), 1)
+        self.assertTrue(order.merchant_trade_no.isalnum())
+        self.assertLessEqual(len(order.merchant_trade_no), 20)
+
+    def test_status_change_needs_no_reread(self):
+        """測試狀態變更不需重新讀取舊訂單"""
+        order = Order.objects.create(user=self.user, total_amount=100)
+        order = Order.objects.get(pk=order.pk)
+        order.status = Order.STATUS_PAID
+
+        with CaptureQueriesContext(connection) as ctx:
+            order.save()
+
+        selects = [q['sql'] for q in ctx.captured_queries if f'FROM "{Order._meta.db_table}"' in q['sql'] and q['sql'].startswith('SELECT')]
+        self.assertEqual(selects, [])
+        self.assertIsNotNone(order.paid_at)
+
+
+class OrderHistoryTest(OrderServiceTestCase):
+    def test_history_payload_queries(self):
+        """測試訂單紀錄統計與明細查詢數固定"""
+        services.create_order(self.user, [
+            {'product_id': self.apple.id, 'quantity': 1},
+            {'product_id': self.pear.id, 'quantity': 1},
+        ])
+        for _ in range(2):
+            services.create_order(self.user, [{'product_id': self.apple.id, 'quantity': 1}])
+
+        # 聚合統計、當頁訂單、明細各一次，商品資料來自明細快照
+        with self.assertNumQueries(3):
+            payload = _order_history_payload(self.user, None, 1)
+            names = [item.product_name for order in payload['orders'] for item in order.items.all()]
+
+        self.assertEqual(payload['total_orders'], 3)
+        self.assertEqual(payload['pending_orders'], 3)
+        self.assertEqual(len(names), 4)
+
+    def test_history_cache_invalidated_on_order_change(self):
+        """測試訂單變更後訂單紀錄快取失效"""
+        key = services.order_history_cache_key(self.user.pk, 'all', 1)
+        self.assertEqual(key, services.order_history_cache_key(self.user.pk, 'all', 1))
+        Order.objects.create(user=self.user, total_amount=100)
+        self.assertNotEqual(key, services.order_history_cache_key(self.user.pk, 'all', 1))
+
+
+class CreateOrderIdempotencyTest(OrderServiceTestCase):
+    def test_retry_does_not_duplicate_order(self):
+        """測試重送建立訂單不會產生重複訂單或重複扣庫存"""
+        cache.clear()
+        self.client.force_login(self.user)
+        body = json.dumps({'items': [{'product_id': self.apple.id, 'quantity': 2}]})
+
+        first = self.client.post('/api/v1/order/create/', data=body, content_type='application/json',
+                                 headers={'Idempotency-Key': 'checkout-1'})
+        second = self.client.post('/api/v1/order/create/', data=body, content_type='application/json',
+                                  headers={'Idempotency-Key': 'checkout-1'})
+
+        self.assertEqual(first.json()['order_id'], second.json()['order_id'])
+        self.assertEqual(Order.objects.count(), 1)
+        self.apple.refresh_from_db()
+        self.assertEqual(self.apple.stock, 8)
+
+
+class OrderVendorIndexTest(OrderServiceTestCase):
+    def test_links_written_and_synced(self):
+        """測試建立訂單時寫入商家索引，並隨訂單狀態同步"""
+        other_user = User.objects.create_user(email='other@example.com', password='testpass123')
+        other_vendor = Vendor.objects.create(user=other_user, name='其他小農')
+        banana = Product.objects.create(vendor=other_vendor, name='香蕉', price=30, stock=5)
+
+        order, _ = services.create_order(self.user, [
+            {'product_id': self.apple.id, 'quantity': 1},
+            {'product_id': self.pear.id, 'quantity': 1},
+            {'product_id': banana.id, 'quantity': 1},
+        ])
+        links = OrderVendor.objects.filter(order=order)
+        self.assertEqual(sorted(links.values_list('vendor_id', flat=True)), sorted([self.vendor.id, other_vendor.id]))
+
+        order.update_status(Order.STATUS_PAID)
+        self.assertEqual(set(links.values_list('status', flat=True)), {Order.STATUS_PAID})
+        self.assertEqual(
+            list(Order.objects.filter(vendor_links__vendor__user=other_user, vendor_links__status=Order.STATUS_PAID)),
+            [order],
+        )
+
+    def test_rebuild(self):
+        """測試重建商家索引"""
+        order, _ = services.create_order(self.user, [{'product_id': self.apple.id, 'quantity': 1}])
+        OrderVendor.objects.all().delete()
+        self.assertEqual(OrderVendor.rebuild([order.pk]), 1)
+        self.assertTrue(OrderVendor.objects.filter(order=order, vendor=self.vendor).exists())
+
+    def test_rebuild_skips_deleted_products(self):
+        """測試明細商品已刪除時重建不會失敗，只建立仍可得知商家的索引"""
+        other_user = User.objects.create_user(email='other@example.com', password='testpass123')
+        other_vendor = Vendor.objects.create(user=other_user, name='其他小農')
+        banana = Product.objects.create(vendor=other_vendor, name='香蕉', price=30, stock=5)
+        order, _ = services.create_order(self.user, [
+            {'product_id': self.apple.id, 'quantity': 1},
+            {'product_id': banana.id, 'quantity': 1},
+        ])
+        banana.delete()
+
+        self.assertEqual(OrderVendor.rebuild([order.pk]), 1)
+        self.assertEqual(list(OrderVendor.objects.filter(order=order).values_list('vendor_id', flat=True)), [self.vendor.id])
+
+
+class OrderExportTest(OrderServiceTestCase):
+    def test_vendor_export_is_scoped(self):
+        """測試商家匯出只包含自己商品的已付款訂單明細"""
+        other_user = User.objects.create_user(email='other@example.com', password='testpass123')
+        other_vendor = Vendor.objects.create(user=other_user, name='其他小農')
+        banana = Product.objects.create(vendor=other_vendor, name='香蕉', price=30, stock=5)
+
+        paid, _ = services.create_order(self.user, [
+            {'product_id': self.apple.id, 'quantity': 1},
+            {'product_id': banana.id, 'quantity': 2},
+        ])
+        paid.update_status(Order.STATUS_PAID)
+        services.create_order(self.user, [{'product_id': banana.id, 'quantity': 1}])
+
+        self.client.force_login(other_user)
+        response = self.client.get('/api/v1/order/export/')
+        self.assertTrue(response.streaming)
+        rows = b''.join(response.streaming_content).decode('utf-8-sig').splitlines()
+
+        self.assertEqual(len(rows), 2)
+        self.assertIn('香蕉', rows[1])
+        self.assertIn(paid.merchant_trade_no, rows[1])
+
+    def test_vendor_scope_uses_order_vendor_index(self):
+        """測試商家範圍直接以 vendor_id 查詢 OrderVendor，不再 join Vendor"""
+        vendor_user = self.vendor.user
+        for sql in (
+            str(export.scoped_orders(vendor_user).query),
+            str(export.export_lines(vendor_user, timezone.now() - timedelta(days=1), timezone.now()).query),
+        ):
+            self.assertNotIn('vendor_vendor', sql)
+            self.assertIn('order_ordervendor', sql)
+
+    def test_customer_cannot_export(self):
+        """測試一般顧客無法匯出"""
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get('/api/v1/order/export/').status_code, 403)
+
+
+class ArchiveOrdersTest(OrderServiceTestCase):
+    def _old_order(self, status, days=400, quantity=1):
+        order, _ = services.create_order(self.user, [{'product_id': self.apple.id, 'quantity': quantity}])
+        order.update_status(status)
+        Order.objects.filter(pk=order.pk).update(created_at=timezone.now() - timedelta(days=days))
+        return order
+
+    def test_archive_moves_closed_old_orders(self):
+        """測試只封存超過期限且已結束的訂單，銷售數量不受影響"""
+        paid = self._old_order(Order.STATUS_PAID, quantity=2)
+        pending = self._old_order(Order.STATUS_PENDING)
+        recent = self._old_order(Order.STATUS_PAID, days=1)
+
+        self.assertEqual(archive.archive_orders(days=365, batch_size=1), 1)
+
+        self.assertFalse(Order.objects.filter(pk=paid.pk).exists())
+        self.assertTrue(Order.objects.filter(pk__in=[pending.pk, recent.pk]).count() == 2)
+        archived = ArchivedOrder.objects.get(pk=paid.pk)
+        self.assertEqual(archived.merchant_trade_no, paid.merchant_trade_no)
+        self.assertEqual(archived.items.get().quantity, 2)
+        self.assertFalse(OrderVendor.objects.filter(order_id=paid.pk).exists())
+
+        self.apple.refresh_from_db()
+        self.assertEqual(self.apple.sales_count, 3)
+        self.assertEqual(self.apple.total_sales, 3)
+        self.assertEqual(Product.recalculate_sales_counts(), [])
+
+    def test_history_reads_across_archive(self):
+        """測試訂單紀錄可合併讀取封存訂單"""
+        old = self._old_order(Order.STATUS_PAID)
+        archive.archive_orders(days=365)
+        services.create_order(self.user, [{'product_id': self.apple.id, 'quantity': 1}])
+
+        self.assertEqual(_order_history_payload(self.user, None, 1)['total_orders'], 1)
+        payload = _order_history_payload(self.user, None, 1, include_archived=True)
+        self.assertEqual(payload['total_orders'], 2)
+        self.assertEqual(payload['orders'][-1].pk, old.pk)
+        self.assertTrue(payload['orders'][-1].is_archived)
+        self.assertEqual(payload['orders'][-1].items.get().product, self.apple)
+
+
+@override_settings(HASH_KEY='testkey', HASH_IV='testiv')
+class PaymentNotifyTest(OrderServiceTestCase):
+    def _notify(self, order, rtn_code='1'):
+        data = {'MerchantTradeNo': order.merchant_trade_no, 'RtnCode': rtn_code, 'RtnMsg': 'ok'}
+        data['CheckMacValue'] = generate_check_mac_value(data, 'testkey', 'testiv')
+        return self.client.post('/api/v1/payment/notify/', data)
+
+    def test_notify_only_stores_event(self):
+        """測試付款通知只寫入收件匣即回覆，不處理訂單"""
+        order, _ = services.create_order(self.user, [{'product_id': self.apple.id, 'quantity': 2}])
+
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(self._notify(order).content, b'1|OK')
+        statements = [q['sql'] for q in ctx.captured_queries if 'SAVEPOINT' not in q['sql']]
+        self.assertEqual(len(statements), 1)
+        self.assertTrue(statements[0].startswith('INSERT'))
+
+        order.refresh_from_db()
+        self.assertEqual(order.status, Order.STATUS_PENDING)
+        self.assertEqual(PaymentEvent.objects.get().status, PaymentEvent.STATUS_PENDING)
+
+    def test_duplicate_paid_notify_applied_once(self):
+        """測試重複的付款成功通知只套用一次，銷售數量不重複累加"""
+        order, _ = services.create_order(self.user, [{'product_id': self.apple.id, 'quantity': 2}])
+        self._notify(order)
+        self._notify(order)
+
+        self.assertEqual(process_payment_events(), 2)
+        self.assertEqual(
+            list(PaymentEvent.objects.order_by('pk').values_list('status', 'result')),
+            [(PaymentEvent.STATUS_PROCESSED, 'paid'), (PaymentEvent.STATUS_PROCESSED, 'duplicate')],
+        )
+        order.refresh_from_db()
+        self.apple.refresh_from_db()
+        self.assertEqual(order.status, Order.STATUS_PAID)
+        self.assertEqual(self.apple.sales_count, 2)
+        self.assertEqual(order.vendor_links.get().status, Order.STATUS_PAID)
+        self.assertEqual(order.items.get().reservation.status, StockReservation.STATUS_CONSUMED)
+
+    def test_failed_notify_does_not_override_paid(self):
+        """測試付款失敗通知不會覆蓋已付款訂單"""
+        order, _ = services.create_order(self.user, [{'product_id': self.apple.id, 'quantity': 1}])
+        self._notify(order)
+        self._notify(order, rtn_code='10300066')
+        process_payment_events()
+
+        order.refresh_from_db()
+        self.assertEqual(order.status, Order.STATUS_PAID)
+
+    def test_replayed_notify_after_refund_ignored(self):
+        """測試退款後重送的付款通知不會把訂單轉回已付款"""
+        order, _ = services.create_order(self.user, [{'product_id': self.apple.id, 'quantity': 2}])
+        self._notify(order)
+        process_payment_events()
+        self.assertEqual(services.apply_order_refunds({order.merchant_trade_no: order.total_amount}), [order.pk])
+
+        self._notify(order)
+        process_payment_events()
+        self.assertEqual(services.mark_orders_paid([order.merchant_trade_no]), [])
+
+        order.refresh_from_db()
+        self.apple.refresh_from_db()
+        self.assertEqual(order.status, Order.STATUS_REFUNDED)
+        self.assertEqual(self.apple.sales_count, 0)
+        self.assertEqual(PaymentEvent.objects.order_by('pk').last().result, 'duplicate')
+
+    def test_event_retried_after_error(self):
+        """測試處理失敗的事件保留待重試並記錄錯誤"""
+        order, _ = services.create_order(self.user, [{'product_id': self.apple.id, 'quantity': 1}])
+        self._notify(order)
+
+        with mock.patch('api.v1.payment.services.mark_order_paid', side_effect=RuntimeError('db down')):
+            process_payment_events()
+        event = PaymentEvent.objects.get()
+        self.assertEqual((event.status, event.attempts, event.error), (PaymentEvent.STATUS_PENDING, 1, 'db down'))
+
+        process_payment_events()
+        event.refresh_from_db()
+        self.assertEqual(event.status, PaymentEvent.STATUS_PROCESSED)
+        order.refresh_from_db()
+        self.assertEqual(order.status, Order.STATUS_PAID)
+
+    def test_claimed_events_skipped_until_timeout(self):
+        """測試其他 worker 已取出的事件不會重複處理，逾時後才重新取出"""
+        order, _ = services.create_order(self.user, [{'product_id': self.apple.id, 'quantity': 1}])
+        self._notify(order)
+        PaymentEvent.objects.update(claimed_at=timezone.now(), attempts=1)
+
+        self.assertEqual(process_payment_events(), 0)
+
+        PaymentEvent.objects.update(claimed_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(process_payment_events(), 1)
+        event = PaymentEvent.objects.get()
+        self.assertEqual((event.status, event.attempts), (PaymentEvent.STATUS_PROCESSED, 2))
+
+    def test_failed_event_does_not_roll_back_batch(self):
+        """測試同一批中處理失敗的事件不影響其他已提交的事件"""
+        first, _ = services.create_order(self.user, [{'product_id': self.apple.id, 'quantity': 1}])
+        second, _ = services.create_order(self.user, [{'product_id': self.apple.id, 'quantity': 1}])
+        self._notify(first)
+        self._notify(second)
+
+        def mark_paid(merchant_trade_no):
+            if merchant_trade_no == second.merchant_trade_no:
+                raise RuntimeError('db down')
+            return services.mark_order_paid(merchant_trade_no)
+
+        with mock.patch('api.v1.payment.services.mark_order_paid', side_effect=mark_paid):
+            self.assertEqual(process_payment_events(), 2)
+
+        self.assertEqual(
+            list(PaymentEvent.objects.order_by('pk').values_list('status', 'claimed_at')),
+            [(PaymentEvent.STATUS_PROCESSED, mock.ANY), (PaymentEvent.STATUS_PENDING, None)],
+        )
+        first.refresh_from_db()
+        self.assertEqual(first.status, Order.STATUS_PAID)
@@ -8,4 +8,5 @@ urlpatterns = [
     path("create/", views.create_order, name="create_order"),
     path('result/', views.order_result, name='order_result'),
     path('history/', views.order_history, name='order_history'),
+    path('export/', views.export_orders, name='export_orders'),
 ]
@@ -1,16 +1,22 @@
 from django.shortcuts import render
 import json
 import uuid
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.shortcuts import get_object_or_404
 from django.contrib.auth.decorators import login_required
-from django.core.paginator import Paginator
-from .models import Order, OrderItem
-from api.v1.product.models import Product
+from django.core.cache import cache
+from django.core.paginator import Page, Paginator
+from django.db.models import CharField, Count, Q, Value
+from .models import ArchivedOrder, Order
+from . import services
+from .export import export_archived_lines, export_lines, iter_csv, parse_export_range
+from Shanghuyun_Platform.idempotency import idempotent
 import traceback
+from datetime import timedelta
 
 @csrf_exempt
+@idempotent('order_create')
 def create_order(request):
     """
     Create an order with multiple products.
@@ -38,61 +44,19 @@ def create_order(request):
         return JsonResponse({"error": "No items provided"}, status=400)
 
     try:
-        # Calculate total amount and validate products
-        total_amount = 0
-        products_to_add = []
-        
-        for item in items_data:
-            try:
-                product_id = int(item.get("product_id", 0))
-                quantity = int(item.get("quantity", 1))
-                
-                if quantity <= 0:
-                    return JsonResponse({"error": f"Invalid quantity for product {product_id}"}, status=400)
-                
-                product = get_object_or_404(Product, id=product_id, is_active=True)
-                
-                # Check stock availability
-                if product.stock < quantity:
-                    return JsonResponse({
-                        "error": f"Insufficient stock for {product.name}. Available: {product.stock}, Requested: {quantity}"
-                    }, status=400)
-                
-                total_amount += product.price * quantity
-                products_to_add.append((product, quantity))
-                
-            except (ValueError, TypeError):
-                return JsonResponse({"error": f"Invalid product data: {item}"}, status=400)
-
-        # Create order (first save to generate ID for merchant_trade_no)
-        order = Order.objects.create(
-            user=request.user,
-            total_amount=total_amount,
-        )
+        # 單一交易內完成：批次載入商品、條件式扣庫存、bulk_create 明細
+        order, created_items = services.create_order(request.user, items_data)
 
-        order.save()
-
-        # Create order items and update stock
-        order_items = []
-        for product, qty in products_to_add:
-            oi = OrderItem.objects.create(
-                order=order,
-                product=product,
-                quantity=qty,
-                price=product.price
-            )
-            print(product.price)
-            
-            # Update product stock
-            product.stock -= qty
-            product.save()
-            order_items.append({
-                "product_id": oi.product.id,
-                "name": oi.product.name,
+        order_items = [
+            {
+                "product_id": oi.product_id,
+                "name": oi.product_name,
                 "quantity": oi.quantity,
                 "price": float(oi.price),
                 "total": float(oi.price * oi.quantity)
-            })
+            }
+            for oi in created_items
+        ]
 
         return JsonResponse({
             "success": True,
@@ -104,6 +68,12 @@ def create_order(request):
             "message": "Order created successfully"
         })
 
+    except services.InsufficientStockError as e:
+        return JsonResponse({"error": str(e), "failed_items": e.failures}, status=400)
+
+    except services.OrderLineError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
     except Exception as e:
         # If order creation fails, rollback might be needed
         print(traceback.format_exc())
@@ -115,7 +85,9 @@ def order_result(request):
 
     if order_id:
         try:
-            order = get_object_or_404(Order, id=int(order_id))
+            order_id = int(order_id)
+            # 舊訂單可能已被封存，熱表找不到時改查封存表
+            order = Order.objects.filter(id=order_id).first() or get_object_or_404(ArchivedOrder, id=order_id)
             # 確保只有訂單的所有者或管理員可以查看
             if request.user.is_authenticated and (order.user == request.user or request.user.is_staff):
                 pass  # 允許查看
@@ -130,36 +102,145 @@ def order_result(request):
     return render(request, "order/order_result.html", context)
 
 
+HISTORY_PAGE_SIZE = 10
+HISTORY_CACHE_TIMEOUT = 300
+HISTORY_STATUSES = ('pending', 'paid', 'failed', 'refunded', 'processing', 'shipped', 'completed', 'cancelled')
+
+
+def _history_stats(orders, status_filter):
+    return orders.aggregate(
+        all_orders=Count('id'),
+        pending_orders=Count('id', filter=Q(status='pending')),
+        completed_orders=Count('id', filter=Q(status='completed')),
+        filtered_orders=Count('id', filter=Q(status=status_filter or '')),
+    )
+
+
+def _merged_history_page(orders, archived, page_obj):
+    """
+    以 UNION 只取當頁的 (id, created_at, 來源)，再分別從熱表與封存表預先載入該頁訂單，
+    依建立時間合併排序。
+    """
+    keys = orders.values_list('id', 'created_at', Value('hot', output_field=CharField())).union(
+        archived.values_list('id', 'created_at', Value('archive', output_field=CharField())),
+        all=True,
+    ).order_by('-created_at', '-id')[page_obj.start_index() - 1:page_obj.end_index()]
+    keys = list(keys)
+
+    hot = orders.filter(pk__in=[pk for pk, _, source in keys if source == 'hot']).prefetch_related('items').in_bulk()
+    cold = archived.filter(pk__in=[pk for pk, _, source in keys if source == 'archive']).prefetch_related(
+        'items'
+    ).in_bulk()
+    return [(hot if source == 'hot' else cold)[pk] for pk, _, source in keys]
+
+
+def _order_history_payload(user, status_filter, page_number, include_archived=False):
+    """
+    統計數據以單一條件聚合查詢取得，當頁訂單連同明細（含商品快照）一併預先載入。
+    include_archived=True 時一併讀取封存表，統計數據與分頁皆涵蓋兩張表。
+    """
+    orders = Order.objects.filter(user=user)
+    stats = _history_stats(orders, status_filter)
+    if include_archived:
+        archived = ArchivedOrder.objects.filter(user=user)
+        archived_stats = _history_stats(archived, status_filter)
+        stats = {key: value + archived_stats[key] for key, value in stats.items()}
+
+    if status_filter:
+        orders = orders.filter(status=status_filter)
+        if include_archived:
+            archived = archived.filter(status=status_filter)
+        total_orders = stats['filtered_orders']
+    else:
+        total_orders = stats['all_orders']
+
+    orders = orders.order_by('-created_at')
+    paginator = Paginator(orders, HISTORY_PAGE_SIZE)
+    paginator.count = total_orders  # 已由聚合查詢取得，避免再一次 COUNT
+    page_obj = paginator.get_page(page_number)
+
+    if include_archived:
+        page_orders = _merged_history_page(orders.order_by(), archived, page_obj) if total_orders else []
+    else:
+        page_orders = list(page_obj.object_list.prefetch_related('items'))
+
+    return {
+        'total_orders': total_orders,
+        'pending_orders': stats['pending_orders'],
+        'completed_orders': stats['completed_orders'],
+        'number': page_obj.number,
+        'orders': page_orders,
+    }
+
+
 @login_required
 def order_history(request):
     """用戶訂單紀錄"""
-    # 獲取用戶的所有訂單，按創建時間倒序排列
-    orders = Order.objects.filter(user=request.user).order_by('-created_at')
-    
-    # 分頁處理
-    paginator = Paginator(orders, 10)  # 每頁顯示10個訂單
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
-    
+    try:
+        page_number = int(request.GET.get('page', 1))
+    except (TypeError, ValueError):
+        page_number = 1
+
     # 狀態篩選
     status_filter = request.GET.get('status')
-    if status_filter and status_filter != 'all':
-        orders = orders.filter(status=status_filter)
-        paginator = Paginator(orders, 10)
-        page_obj = paginator.get_page(page_number)
-    
-    # 統計數據
-    total_orders = orders.count()
-    pending_orders = Order.objects.filter(user=request.user, status='pending').count()
-    completed_orders = Order.objects.filter(user=request.user, status='completed').count()
-    
+    if status_filter == 'all':
+        status_filter = None
+
+    # archived=1 時一併顯示已封存的舊訂單
+    include_archived = request.GET.get('archived') == '1'
+
+    # 只快取已知狀態，避免任意參數產生大量快取鍵
+    cache_key = None
+    if status_filter is None or status_filter in HISTORY_STATUSES:
+        cache_key = services.order_history_cache_key(
+            request.user.pk, status_filter or 'all', page_number, include_archived
+        )
+        payload = cache.get(cache_key)
+    else:
+        payload = None
+
+    if payload is None:
+        payload = _order_history_payload(request.user, status_filter, page_number, include_archived)
+        if cache_key:
+            cache.set(cache_key, payload, HISTORY_CACHE_TIMEOUT)
+
+    paginator = Paginator(Order.objects.none(), HISTORY_PAGE_SIZE)
+    paginator.count = payload['total_orders']
+    page_obj = Page(payload['orders'], payload['number'], paginator)
+
     context = {
         'page_obj': page_obj,
         'orders': page_obj.object_list,
-        'total_orders': total_orders,
-        'pending_orders': pending_orders,
-        'completed_orders': completed_orders,
+        'total_orders': payload['total_orders'],
+        'pending_orders': payload['pending_orders'],
+        'completed_orders': payload['completed_orders'],
         'current_status': status_filter or 'all',
+        'include_archived': include_archived,
     }
     
     return render(request, "order/order_history.html", context)
+
+
+@login_required
+def export_orders(request):
+    """
+    串流匯出訂單明細 CSV（管理員/員工匯出全部，商家僅匯出自己的商品）
+    GET 參數：start、end（YYYY-MM-DD，預設最近 30 天）
+    """
+    if not (request.user.is_superuser or request.user.is_staff
+            or hasattr(request.user, 'vendor_profile')):
+        return JsonResponse({"error": "Permission denied"}, status=403)
+
+    try:
+        start, end = parse_export_range(request.GET.get('start'), request.GET.get('end'))
+    except ValueError:
+        return JsonResponse({"error": "Invalid date range, expected YYYY-MM-DD"}, status=400)
+
+    response = StreamingHttpResponse(
+        # 封存的訂單較舊，先輸出
+        iter_csv(export_archived_lines(request.user, start, end), export_lines(request.user, start, end)),
+        content_type='text/csv; charset=utf-8',
+    )
+    filename = f"orders_{start:%Y%m%d}_{(end - timedelta(days=1)):%Y%m%d}.csv"
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
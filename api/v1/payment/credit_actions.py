@@ -0,0 +1,166 @@
+"""
+批次信用卡請款 / 退款（例如商品召回後的大量退刷）。
+
+作業分三步：enqueue_credit_actions 匯入動作、run_credit_actions 分批送出、結果批次寫回訂單。
+每批先在交易內標記為 sending 再送出，程序中斷後重跑只會處理 pending 的動作，不會重複退款。
+"""
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+from functools import lru_cache
+import logging
+import threading
+import time
+import requests
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from api.v1.order.services import apply_order_refunds
+from .models import CreditAction
+from .services import ecpay_url, get_payment_sdk
+
+logger = logging.getLogger(__name__)
+
+# 成功後需寫回訂單退款金額的動作
+REFUND_ACTIONS = (CreditAction.ACTION_REFUND, CreditAction.ACTION_ABANDON)
+
+
+class RateLimiter(object):
+    """每個 key（商店代號）各自一個 token bucket，跨執行緒共用"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or max(1, int(rate))
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                tokens, updated = self._buckets.get(key, (self.burst, now))
+                tokens = min(self.burst, tokens + (now - updated) * self.rate)
+                if tokens >= 1:
+                    self._buckets[key] = (tokens - 1, now)
+                    return
+                self._buckets[key] = (tokens, now)
+                wait = (1 - tokens) / self.rate
+            time.sleep(wait)
+
+
+@lru_cache(maxsize=4)
+def get_rate_limiter(rate=None):
+    """取得全程序共用的限流器（預設 CREDIT_ACTION_RATE_PER_SECOND 次 / 秒 / 商店）"""
+    return RateLimiter(rate or settings.CREDIT_ACTION_RATE_PER_SECOND)
+
+
+def enqueue_credit_actions(batch, actions):
+    """
+    匯入一批動作（每筆為 (merchant_trade_no, trade_no, action, amount)），回傳該批次的動作總數。
+    同一批次重複匯入的動作會被忽略，可安全重跑。
+    """
+    rows = []
+    for merchant_trade_no, trade_no, action, amount in actions:
+        if action not in CreditAction.ACTIONS:
+            raise ValueError(f"Unknown credit action {action!r} for {merchant_trade_no}")
+        rows.append(CreditAction(
+            batch=batch,
+            merchant_trade_no=merchant_trade_no,
+            trade_no=trade_no,
+            action=action,
+            amount=Decimal(amount),
+        ))
+    CreditAction.objects.bulk_create(rows, batch_size=500, ignore_conflicts=True)
+    return CreditAction.objects.filter(batch=batch).count()
+
+
+def mark_stale_actions_unknown(batch, stale_minutes=10):
+    """
+    上次執行中斷而停在 sending 的動作可能已送達綠界，改為 unknown 不再自動送出，回傳筆數。
+    只處理送出超過 stale_minutes 分鐘的動作，避免影響仍在執行中的其他 worker。
+    """
+    return CreditAction.objects.filter(
+        batch=batch,
+        status=CreditAction.STATUS_SENDING,
+        sent_at__lt=timezone.now() - timedelta(minutes=stale_minutes),
+    ).update(status=CreditAction.STATUS_UNKNOWN, rtn_msg="執行中斷，請至綠界後台確認")
+
+
+def _claim(batch, chunk_size):
+    """取出一批待送出的動作並標記為 sending（提交後才送出）"""
+    with transaction.atomic():
+        actions = list(
+            CreditAction.objects.select_for_update(skip_locked=True)
+            .filter(batch=batch, status=CreditAction.STATUS_PENDING)
+            .order_by("pk")[:chunk_size]
+        )
+        CreditAction.objects.filter(pk__in=[action.pk for action in actions]).update(
+            status=CreditAction.STATUS_SENDING, sent_at=timezone.now()
+        )
+    return actions
+
+
+def _send(sdk, limiter, action):
+    """送出單筆動作（在 worker 執行緒執行，不可存取資料庫），回傳 (status, rtn_code, rtn_msg)"""
+    limiter.acquire(sdk.MerchantID)
+    try:
+        result = sdk.credit_do_action(
+            action_url=ecpay_url('/CreditDetail/DoAction'),
+            client_parameters={
+                'MerchantTradeNo': action.merchant_trade_no,
+                'TradeNo': action.trade_no,
+                'Action': action.action,
+                'TotalAmount': int(action.amount),
+            },
+        )
+    except requests.exceptions.ConnectTimeout:
+        # 連線尚未建立，請求確定沒有送出
+        return CreditAction.STATUS_FAILED, "", "連線逾時，未送出"
+    except Exception as exc:
+        logger.warning("ECPay DoAction failed for %s", action.merchant_trade_no, exc_info=True)
+        return CreditAction.STATUS_UNKNOWN, "", str(exc)[:200]
+
+    rtn_code = result.get('RtnCode', '')
+    status = CreditAction.STATUS_SUCCEEDED if rtn_code == '1' else CreditAction.STATUS_FAILED
+    return status, rtn_code[:10], result.get('RtnMsg', '')[:200]
+
+
+def _record(actions):
+    """以一次 bulk_update 保存結果，並在同一交易內把成功的退刷批次寫回訂單"""
+    refunds = defaultdict(Decimal)
+    for action in actions:
+        if action.status == CreditAction.STATUS_SUCCEEDED and action.action in REFUND_ACTIONS:
+            refunds[action.merchant_trade_no] += action.amount
+    with transaction.atomic():
+        CreditAction.objects.bulk_update(actions, ["status", "rtn_code", "rtn_msg", "completed_at"])
+        if refunds:
+            apply_order_refunds(refunds)
+
+
+def run_credit_actions(batch, workers=4, chunk_size=50, sdk=None, limiter=None, stale_minutes=10):
+    """
+    分批送出批次中待處理的動作，回傳本次各結果的筆數 {'sent', 'succeeded', 'failed', 'unknown'}。
+
+    每批最多 workers 個執行緒並行，另依商店代號限流；每批結果提交後才取下一批，
+    中斷時最多只有一批停在 sending，重跑時改為 unknown。
+    """
+    sdk = sdk or get_payment_sdk()
+    limiter = limiter or get_rate_limiter()
+    mark_stale_actions_unknown(batch, stale_minutes)
+
+    counts = {'sent': 0, CreditAction.STATUS_SUCCEEDED: 0, CreditAction.STATUS_FAILED: 0,
+              CreditAction.STATUS_UNKNOWN: 0}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            actions = _claim(batch, chunk_size)
+            if not actions:
+                return counts
+            results = executor.map(lambda action: _send(sdk, limiter, action), actions)
+            now = timezone.now()
+            for action, (status, rtn_code, rtn_msg) in zip(actions, results):
+                action.status, action.rtn_code, action.rtn_msg = status, rtn_code, rtn_msg
+                action.completed_at = now
+                counts[status] += 1
+            counts['sent'] += len(actions)
+            _record(actions)
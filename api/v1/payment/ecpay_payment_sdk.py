@@ -1,12 +1,14 @@
 # coding: utf-8
-import collections
+import codecs
 import hashlib
-import copy
-import requests
+import hmac
 import json
 import pprint
 from decimal import Decimal
+from functools import lru_cache
+from html import escape
 from urllib.parse import quote_plus, parse_qsl, parse_qs
+from .transport import get_transport
 
 
 """
@@ -197,6 +199,174 @@ UnionPay = {
     'Hidden': 2,  # 不可使用銀聯卡, 綠界會將交易頁面隱藏銀聯選項
 }
 
+_SAFE_CHARACTERS = '-_.!*()'
+_HASHES = {1: hashlib.sha256, 0: hashlib.md5}  # EncryptType -> 雜湊函式
+
+
+def _sort_key(item):
+    return item[0].lower()
+
+
+# ASCII 字元的 quote_plus(...).lower() 結果對照表，str.translate 在 C 層一次完成
+_ASCII_ENCODING = {i: quote_plus(chr(i), safe=_SAFE_CHARACTERS).lower() for i in range(128)}
+
+
+def _encode(value):
+    if value.isascii():
+        return value.translate(_ASCII_ENCODING).encode('ascii')
+    return quote_plus(value, safe=_SAFE_CHARACTERS).lower().encode('utf-8')
+
+
+class CheckMacValueSigner(object):
+    """
+    CheckMacValue 簽章器。
+
+    quote_plus 與 lower 皆為逐字元轉換，可分段編碼後串接，
+    因此 HashKey 前綴在建構時就先編碼並餵入雜湊，每次簽章只需 copy() 後處理參數本身。
+    輸出與 BasePayment 原本的實作逐位元組相同。
+    """
+
+    def __init__(self, hash_key, hash_iv):
+        prefix = _encode('HashKey=%s&' % hash_key)
+        self._suffix = _encode('HashIV=%s' % hash_iv)
+        self._primed = {encrypt_type: new(prefix) for encrypt_type, new in _HASHES.items()}
+
+    def sign(self, params, encrypt_type=None, merchant_id=None):
+        """
+        計算 CheckMacValue。params 不會被複製或修改；其中有值的 CheckMacValue 不列入計算。
+        encrypt_type 預設取 params 的 EncryptType（1: SHA256、0: MD5），merchant_id 會覆蓋 params 的 MerchantID。
+        """
+        if encrypt_type is None:
+            encrypt_type = int(params.get('EncryptType', 1))
+        primed = self._primed.get(encrypt_type)
+        if primed is None:
+            return ''
+
+        items = params.items()
+        drop_check = bool(params.get('CheckMacValue'))
+        override = merchant_id is not None and params.get('MerchantID') != merchant_id
+        if drop_check or override:
+            # 只有需要排除或覆蓋欄位時才建立新的清單
+            items = [
+                item for item in items
+                if not (drop_check and item[0] == 'CheckMacValue') and not (override and item[0] == 'MerchantID')
+            ]
+            if override:
+                items.append(('MerchantID', merchant_id))
+
+        digest = primed.copy()
+        digest.update(_encode(''.join(['%s=%s&' % item for item in sorted(items, key=_sort_key)])))
+        digest.update(self._suffix)
+        return digest.hexdigest().upper()
+
+    def verify(self, params, encrypt_type=None, merchant_id=None):
+        """以固定時間比對 params 內的 CheckMacValue"""
+        received = params.get('CheckMacValue')
+        if not received:
+            return False
+        expected = self.sign(params, encrypt_type=encrypt_type, merchant_id=merchant_id)
+        return hmac.compare_digest(expected, received.upper())
+
+    def verify_many(self, rows, encrypt_type=None):
+        """批次驗證（例如對帳檔的每一列），回傳與 rows 對應的 bool 清單"""
+        verify = self.verify
+        return [verify(row, encrypt_type=encrypt_type) for row in rows]
+
+
+@lru_cache(maxsize=16)
+def get_signer(hash_key, hash_iv):
+    """依 HashKey / HashIV 取得共用的簽章器"""
+    return CheckMacValueSigner(hash_key, hash_iv)
+
+
+def _default_dict(pattern):
+    default_dict = dict()
+    for k, v in pattern.items():
+        if v['type'] is str:
+            default_dict.setdefault(k, '')
+        elif v['type'] is int:
+            default_dict.setdefault(k, -1)
+        else:
+            raise Exception('unsupported type!')
+    for k, v in pattern.items():
+        if v.get('default'):
+            default_dict[k] = v.get('default')
+    return default_dict
+
+
+class ParameterSchema(object):
+    """
+    預先編譯的參數規格。
+
+    將多個 pattern dict 攤平成預設值範本與檢查清單，只在 import 時走訪一次；
+    每次呼叫只需複製範本並依序檢查，結果與 create_default_dict / check_required_parameter /
+    filter_parameter 逐一處理 pattern 相同。
+    """
+
+    def __init__(self, *patterns):
+        self.patterns = patterns
+        self.defaults = {}
+        checks = []
+        optional_str = []
+        optional_int = []
+        for pattern in patterns:
+            self.defaults.update(_default_dict(pattern))
+            for k, v in pattern.items():
+                if v.get('type') not in (str, int):
+                    continue
+                if v.get('required'):
+                    checks.append((k, v['type'] is str, v.get('max')))
+                elif v.get('required') is False:
+                    (optional_str if v['type'] is str else optional_int).append(k)
+        self._checks = tuple(dict.fromkeys(checks))
+        self._optional_str = tuple(dict.fromkeys(optional_str))
+        self._optional_int = tuple(dict.fromkeys(optional_int))
+
+    def prepare(self, client_parameters, merchant_id):
+        """合併預設值與呼叫端參數、檢查必填欄位並移除未填的選填欄位"""
+        parameters = self.defaults.copy()
+        parameters.update(client_parameters)
+        parameters['MerchantID'] = merchant_id
+
+        for k, is_str, max_length in self._checks:
+            value = parameters.get(k)
+            if value is None:
+                raise Exception('parameter %s is required.' % k)
+            if is_str:
+                if len(value) == 0:
+                    raise Exception('%s content is required.' % k)
+                if max_length is not None and len(value) > max_length:
+                    raise Exception('%s max langth is %d.' % (k, max_length))
+
+        for k in self._optional_str:
+            value = parameters.get(k)
+            if value is not None and len(value) == 0:
+                del parameters[k]
+        for k in self._optional_int:
+            value = parameters.get(k)
+            if value is not None and value < 0:
+                del parameters[k]
+        return parameters
+
+
+def iter_text_lines(chunks, encoding='big5'):
+    """
+    將位元組區塊逐步解碼並切成行（保留換行），多位元組字元跨區塊時也能正確解碼。
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    pending = ''
+    for chunk in chunks:
+        pending += decoder.decode(chunk)
+        lines = pending.splitlines(True)
+        # 最後一段可能不完整，留到下一個區塊
+        pending = lines.pop() if lines and not lines[-1].endswith(('\n', '\r')) else ''
+        for line in lines:
+            yield line
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending
+
+
 class BasePayment(object):
 
     def merge(self, x, y):
@@ -226,18 +396,7 @@ class BasePayment(object):
 
     # 先用 required.dict 設定預設值並產生新 new.required.dict
     def create_default_dict(self, parameters):
-        default_dict = dict()
-        for k, v in parameters.items():
-            if v['type'] is str:
-                default_dict.setdefault(k, '')
-            elif v['type'] is int:
-                default_dict.setdefault(k, -1)
-            else:
-                raise Exception('unsupported type!')
-        for k, v in parameters.items():
-            if v.get('default'):
-                default_dict[k] = v.get('default')
-        return default_dict
+        return _default_dict(parameters)
 
     # 將 merge.dict 內的無用參數消除
     def filter_parameter(self, parameters, pattern):
@@ -255,39 +414,10 @@ class BasePayment(object):
                         del parameters[k]
 
     def generate_check_value(self, params):
-        _params = copy.deepcopy(params)
+        return get_signer(self.HashKey, self.HashIV).sign(params, merchant_id=self.MerchantID)
 
-        if _params.get('CheckMacValue'):
-            _params.pop('CheckMacValue')
-
-        encrypt_type = int(_params.get('EncryptType', 1))
-
-        _params.update({'MerchantID': self.MerchantID})
-
-        ordered_params = collections.OrderedDict(
-            sorted(_params.items(), key=lambda k: k[0].lower()))
-
-        encoding_lst = []
-        encoding_lst.append('HashKey=%s&' % self.HashKey)
-        encoding_lst.append(''.join(
-            ['{}={}&'.format(key, value) for key, value in ordered_params.items()]))
-        encoding_lst.append('HashIV=%s' % self.HashIV)
-
-        safe_characters = '-_.!*()'
-
-        encoding_str = ''.join(encoding_lst)
-        encoding_str = quote_plus(
-            str(encoding_str), safe=safe_characters).lower()
-
-        check_mac_value = ''
-        if encrypt_type == 1:
-            check_mac_value = hashlib.sha256(
-                encoding_str.encode('utf-8')).hexdigest().upper()
-        elif encrypt_type == 0:
-            check_mac_value = hashlib.md5(
-                encoding_str.encode('utf-8')).hexdigest().upper()
-
-        return check_mac_value
+    def verify_check_value(self, params):
+        return get_signer(self.HashKey, self.HashIV).verify(params, merchant_id=self.MerchantID)
 
     def integrate_parameter(self, parameters, patterns):
         # 更新 MerchantID
@@ -300,22 +430,35 @@ class BasePayment(object):
         parameters['CheckMacValue'] = self.generate_check_value(parameters)
         return parameters
 
-    def send_post(self, url, params):
-        response = requests.post(url, data=params)
-        return response
+    def integrate_schema(self, schema, client_parameters):
+        """
+        以預先編譯的 ParameterSchema 產生送出的參數並計算 CheckMacValue。
+        結果只存在回傳值，不寫入 self，同一個 SDK 實例可在多個請求間共用。
+        """
+        parameters = schema.prepare(client_parameters, self.MerchantID)
+        parameters['CheckMacValue'] = self.generate_check_value(parameters)
+        return parameters
+
+    transport = None
+
+    def send_post(self, url, params, endpoint=None, stream=False):
+        # 共用連線池，並依端點套用逾時、重試與併發上限
+        return (self.transport or get_transport()).post(url, params, endpoint=endpoint, stream=stream)
 
 
 class ExtendFunction(BasePayment):
 
     def gen_html_post_form(self, action, parameters):
-        html = '<form id="data_set" action="' + action + '" method="post">'
-        for k, v in parameters.items():
-            html += '<input type="hidden" name="' + \
-                str(k) + '" value="' + str(v) + '" />'
-
-        html += '<script type="text/javascript">document.getElementById("data_set").submit();</script>'
-        html += "</form>"
-        return html
+        # 欄位值需跳脫，避免商品名稱含引號時破壞表單（瀏覽器送出時會還原，CheckMacValue 不受影響）
+        return ''.join([
+            '<form id="data_set" action="', escape(action), '" method="post">',
+            ''.join([
+                '<input type="hidden" name="%s" value="%s" />' % (escape(str(k)), escape(str(v)))
+                for k, v in parameters.items()
+            ]),
+            '<script type="text/javascript">document.getElementById("data_set").submit();</script>',
+            '</form>',
+        ])
 
 
 class CreateOrder(BasePayment):
@@ -424,56 +567,48 @@ class CreateOrder(BasePayment):
         "InvType": {'type': str, 'required': True, 'max': 2},
     }
 
-    def create_order(self, client_parameters):
-        self.__check_pattern = []
-        # 先用 required.dict 設定預設值並產生新 new.required.dict
-        default_parameters = dict()
-        default_parameters = self.create_default_dict(
-            self.__ORDER_REQUIRED_PARAMETERS)
-        self.__check_pattern.append(self.__ORDER_REQUIRED_PARAMETERS)
-
-        # 看看 client.dict 付款方式
-        # 有的話 merge.dict 合併 payment.method.dict
-        # 使用 ALL 或 ATM 付款方式
-        choose_payment = client_parameters.get('ChoosePayment')
-        if choose_payment == ChoosePayment['ALL'] or \
-                choose_payment == ChoosePayment['ATM']:
-            payment_extend_parameters = self.create_default_dict(
-                self.__ATM_EXTEND_PARAMETERS)
-            self.__check_pattern.append(self.__ATM_EXTEND_PARAMETERS)
-            # 合併
-            default_parameters = super().merge(
-                default_parameters, payment_extend_parameters)
+    __CREDIT_VARIANTS = {
+        'one_time': __CREDIT_EXTEND_PARAMETERS_3,
+        'installment': __CREDIT_EXTEND_PARAMETERS_4,
+        'periodic': __CREDIT_EXTEND_PARAMETERS_5,
+    }
 
-        # 使用 ALL 或 CVS 或 BARCODE 付款方式
-        if choose_payment == ChoosePayment['ALL'] or \
-                choose_payment == ChoosePayment['CVS'] or \
-                choose_payment == ChoosePayment['BARCODE']:
-            payment_extend_parameters = self.create_default_dict(
-                self.__CVS_BARCODE_EXTEND_PARAMETERS)
-            self.__check_pattern.append(self.__CVS_BARCODE_EXTEND_PARAMETERS)
-            # 合併
-            default_parameters = super().merge(
-                default_parameters, payment_extend_parameters)
+    __schemas = {}
 
-        # 使用 ALL 或 Credit 付款方式
-        if choose_payment == ChoosePayment['ALL'] or \
-                choose_payment == ChoosePayment['Credit']:
-            payment_extend_parameters = self.create_default_dict(
-                self.__CREDIT_EXTEND_PARAMETERS_1)
-            self.__check_pattern.append(self.__CREDIT_EXTEND_PARAMETERS_1)
-            # 合併
-            default_parameters = super().merge(
-                default_parameters, payment_extend_parameters)
+    @classmethod
+    def compile_schema(cls, choose_payment, credit_variant=None, invoice=False):
+        """
+        依付款方式、信用卡付款類型（one_time / installment / periodic）與是否開立發票，
+        取得（第一次時編譯）對應的參數規格。
+        """
+        key = (choose_payment, credit_variant, invoice)
+        schema = cls.__schemas.get(key)
+        if schema is not None:
+            return schema
 
+        patterns = [cls.__ORDER_REQUIRED_PARAMETERS]
+        # 使用 ALL 或 ATM 付款方式
+        if choose_payment in (ChoosePayment['ALL'], ChoosePayment['ATM']):
+            patterns.append(cls.__ATM_EXTEND_PARAMETERS)
+        # 使用 ALL 或 CVS 或 BARCODE 付款方式
+        if choose_payment in (ChoosePayment['ALL'], ChoosePayment['CVS'], ChoosePayment['BARCODE']):
+            patterns.append(cls.__CVS_BARCODE_EXTEND_PARAMETERS)
+        # 使用 ALL 或 Credit 付款方式
+        if choose_payment in (ChoosePayment['ALL'], ChoosePayment['Credit']):
+            patterns.append(cls.__CREDIT_EXTEND_PARAMETERS_1)
         # 使用 Credit 付款方式
         if choose_payment == ChoosePayment['Credit']:
-            payment_extend_parameters = self.create_default_dict(
-                self.__CREDIT_EXTEND_PARAMETERS_2)
-            self.__check_pattern.append(self.__CREDIT_EXTEND_PARAMETERS_2)
-            # 合併
-            default_parameters = super().merge(
-                default_parameters, payment_extend_parameters)
+            patterns.append(cls.__CREDIT_EXTEND_PARAMETERS_2)
+        if credit_variant:
+            patterns.append(cls.__CREDIT_VARIANTS[credit_variant])
+        if invoice:
+            patterns.append(cls.__INVOICE_EXTEND_PARAMETERS)
+
+        schema = cls.__schemas[key] = ParameterSchema(*patterns)
+        return schema
+
+    def create_order(self, client_parameters):
+        choose_payment = client_parameters.get('ChoosePayment')
 
         # 付款子方式 WebATM 大眾銀行跟永豐銀行已經無法使用
         if client_parameters.get('ChooseSubPayment') == ChooseSubPayment['WebATM']['TACHONG'] or \
@@ -481,21 +616,17 @@ class CreateOrder(BasePayment):
             raise Exception(
                 'ChooseSubPayment is not supported with TACHONG or SINOPAC.')
 
+        credit_variant = None
         if choose_payment == ChoosePayment['ALL'] or \
                 choose_payment == ChoosePayment['Credit']:
-            credit_extend_parameters = dict()
             # 使用 ALL 或 Credit 付款方式: 一次付清(三擇一)
             if client_parameters.get('Redeem') or \
                     client_parameters.get('UnionPay'):
-                credit_extend_parameters = self.create_default_dict(
-                    self.__CREDIT_EXTEND_PARAMETERS_3)
-                self.__check_pattern.append(self.__CREDIT_EXTEND_PARAMETERS_3)
+                credit_variant = 'one_time'
 
             # 使用 ALL 或 Credit 付款方式: 分期付款、圓夢分期付款(三擇一)
             elif client_parameters.get('CreditInstallment'):
-                credit_extend_parameters = self.create_default_dict(
-                    self.__CREDIT_EXTEND_PARAMETERS_4)
-                self.__check_pattern.append(self.__CREDIT_EXTEND_PARAMETERS_4)
+                credit_variant = 'installment'
 
             # 使用 ALL 或 Credit 付款方式: 定期定額(三擇一)
             elif client_parameters.get('PeriodAmount') or \
@@ -503,24 +634,12 @@ class CreateOrder(BasePayment):
                     client_parameters.get('Frequency') or \
                     client_parameters.get('ExecTimes') or \
                     client_parameters.get('PeriodReturnURL'):
-                credit_extend_parameters = self.create_default_dict(
-                    self.__CREDIT_EXTEND_PARAMETERS_5)
-                self.__check_pattern.append(self.__CREDIT_EXTEND_PARAMETERS_5)
-            # 合併
-            if credit_extend_parameters:
-                default_parameters = super().merge(
-                    default_parameters, credit_extend_parameters)
+                credit_variant = 'periodic'
 
-        # 看看 client.dict 有無 invoice='Y'
-        # 有的話 new.required.dict 合併 invoice.dict
-        if client_parameters.get('InvoiceMark') == 'Y':
-            invoice_parameters = self.create_default_dict(
-                self.__INVOICE_EXTEND_PARAMETERS)
-            self.__check_pattern.append(self.__INVOICE_EXTEND_PARAMETERS)
-            # 合併
-            default_parameters = super().merge(
-                default_parameters, invoice_parameters)
+        invoice = client_parameters.get('InvoiceMark') == 'Y'
 
+        # 看看 client.dict 有無 invoice='Y'
+        if invoice:
             # 該參數有值時，請帶固定長度為數字 8 碼
             customer_identifier = client_parameters.get('CustomerIdentifier')
             if customer_identifier and (len(customer_identifier) != 8):
@@ -583,17 +702,14 @@ class CreateOrder(BasePayment):
                         client_parameters.update(
                             {k: quote_plus(str(v)).lower()})
 
-        # 用 new.required.dict 與 client.dict 合併為 merge.dict
-        self.final_merge_parameters = super().merge(
-            default_parameters, client_parameters)
+        # 以預先編譯的規格合併預設值、檢查參數並產生 CheckMacValue
+        return self.integrate_schema(
+            self.compile_schema(choose_payment, credit_variant, invoice), client_parameters)
 
-        # 檢查參數, 並產生 CheckMacValue
-        self.final_merge_parameters = self.integrate_parameter(
-            self.final_merge_parameters,
-            self.__check_pattern)
 
-        # 回傳給 client
-        return self.final_merge_parameters
+# 在 import 時先編譯各付款方式的參數規格
+for _choose_payment in ChoosePayment.values():
+    CreateOrder.compile_schema(_choose_payment)
 
 
 class OrderSearch(BasePayment):
@@ -606,32 +722,20 @@ class OrderSearch(BasePayment):
         'PlatformID': {'type': str, 'required': False, 'max': 10},
     }
 
+    __SCHEMA = ParameterSchema(__ORDER_SEARCH_PARAMETERS)
+
     __url = 'https://payment.ecpay.com.tw/Cashier/QueryTradeInfo/V5'
 
     def order_search(self, action_url=__url, client_parameters={}):
-        self.__check_pattern = []
         if action_url is None:
             action_url = self.__url
-        # 先用 required.dict 設定預設值並產生新 new.required.dict
-        default_parameters = dict()
-        default_parameters = self.create_default_dict(
-            self.__ORDER_SEARCH_PARAMETERS)
-        self.__check_pattern.append(self.__ORDER_SEARCH_PARAMETERS)
-
-        # 用 new.required.dict 與 client.dict 合併為 merge.dict
-        self.final_merge_parameters = super().merge(
-            default_parameters, client_parameters)
-
-        # 檢查參數, 並產生 CheckMacValue
-        self.final_merge_parameters = self.integrate_parameter(
-            self.final_merge_parameters,
-            self.__check_pattern)
+        # 以預先編譯的規格合併預設值、檢查參數並產生 CheckMacValue
+        parameters = self.integrate_schema(self.__SCHEMA, client_parameters)
 
         # 回傳給 client
-        response = super().send_post(
-            action_url, self.final_merge_parameters)
+        response = super().send_post(action_url, parameters, endpoint='order_search')
         query = dict(parse_qsl(response.text, keep_blank_values=True))
-        if query.get('CheckMacValue') == self.generate_check_value(query):
+        if self.verify_check_value(query):
             query.pop('CheckMacValue')
             return query
         else:
@@ -647,30 +751,18 @@ class OrderSearchPeriodic(BasePayment):
         'TimeStamp': {'type': int, 'required': True, },
     }
 
+    __SCHEMA = ParameterSchema(__ORDER_SEARCH_PERIODIC_PARAMETERS)
+
     __url = 'https://payment.ecpay.com.tw/Cashier/QueryCreditCardPeriodInfo'
 
     def order_search_period(self, action_url=__url, client_parameters={}):
-        self.__check_pattern = []
         if action_url is None:
             action_url = self.__url
-        # 先用 required.dict 設定預設值並產生新 new.required.dict
-        default_parameters = dict()
-        default_parameters = self.create_default_dict(
-            self.__ORDER_SEARCH_PERIODIC_PARAMETERS)
-        self.__check_pattern.append(self.__ORDER_SEARCH_PERIODIC_PARAMETERS)
-
-        # 用 new.required.dict 與 client.dict 合併為 merge.dict
-        self.final_merge_parameters = super().merge(
-            default_parameters, client_parameters)
-
-        # 檢查參數, 並產生 CheckMacValue
-        self.final_merge_parameters = self.integrate_parameter(
-            self.final_merge_parameters,
-            self.__check_pattern)
+        # 以預先編譯的規格合併預設值、檢查參數並產生 CheckMacValue
+        parameters = self.integrate_schema(self.__SCHEMA, client_parameters)
 
         # 回傳給 client
-        response = super().send_post(
-            action_url, self.final_merge_parameters)
+        response = super().send_post(action_url, parameters, endpoint='order_search_period')
         query = json.loads(response.text)
         return query
 
@@ -687,30 +779,18 @@ class CreditDoAction(BasePayment):
         'PlatformID': {'type': str, 'required': False, 'max': 10},
     }
 
+    __SCHEMA = ParameterSchema(__CREDIT_DO_ACTION_PARAMETERS)
+
     __url = 'https://payment.ecpay.com.tw/CreditDetail/DoAction'
 
     def credit_do_action(self, action_url=__url, client_parameters={}):
-        self.__check_pattern = []
         if action_url is None:
             action_url = self.__url
-        # 先用 required.dict 設定預設值並產生新 new.required.dict
-        default_parameters = dict()
-        default_parameters = self.create_default_dict(
-            self.__CREDIT_DO_ACTION_PARAMETERS)
-        self.__check_pattern.append(self.__CREDIT_DO_ACTION_PARAMETERS)
-
-        # 用 new.required.dict 與 client.dict 合併為 merge.dict
-        self.final_merge_parameters = super().merge(
-            default_parameters, client_parameters)
-
-        # 檢查參數, 並產生 CheckMacValue
-        self.final_merge_parameters = self.integrate_parameter(
-            self.final_merge_parameters,
-            self.__check_pattern)
+        # 以預先編譯的規格合併預設值、檢查參數並產生 CheckMacValue
+        parameters = self.integrate_schema(self.__SCHEMA, client_parameters)
 
         # 回傳給 client
-        response = super().send_post(
-            action_url, self.final_merge_parameters)
+        response = super().send_post(action_url, parameters, endpoint='credit_do_action')
         query = dict(parse_qsl(response.text, keep_blank_values=True))
 
         return query
@@ -731,34 +811,37 @@ class DownloadMerchantBalance(BasePayment):
         'MediaFormated': {'type': str, 'required': True, 'max': 1},
     }
 
+    __SCHEMA = ParameterSchema(__DOWNLOAD_MERCHANT_BALANCE_PARAMETERS)
+
     __url = 'https://vendor.ecpay.com.tw/PaymentMedia/TradeNoAio'
 
     def download_merchant_balance(self, action_url=__url, client_parameters={}):
-        self.__check_pattern = []
         if action_url is None:
             action_url = self.__url
-        # 先用 required.dict 設定預設值並產生新 new.required.dict
-        default_parameters = dict()
-        default_parameters = self.create_default_dict(
-            self.__DOWNLOAD_MERCHANT_BALANCE_PARAMETERS)
-        self.__check_pattern.append(
-            self.__DOWNLOAD_MERCHANT_BALANCE_PARAMETERS)
-
-        # 用 new.required.dict 與 client.dict 合併為 merge.dict
-        self.final_merge_parameters = super().merge(
-            default_parameters, client_parameters)
-
-        # 檢查參數, 並產生 CheckMacValue
-        self.final_merge_parameters = self.integrate_parameter(
-            self.final_merge_parameters,
-            self.__check_pattern)
+        # 以預先編譯的規格合併預設值、檢查參數並產生 CheckMacValue
+        parameters = self.integrate_schema(self.__SCHEMA, client_parameters)
 
         # 回傳給 client
-        response = super().send_post(
-            action_url, self.final_merge_parameters)
+        response = super().send_post(action_url, parameters, endpoint='download_merchant_balance')
         response.encoding = 'big5'
         return response.text
 
+    def iter_merchant_balance(self, action_url=__url, client_parameters={}, chunk_size=64 * 1024):
+        """
+        串流下載對帳檔，逐行產生解碼後的文字（含換行），記憶體用量與檔案大小無關。
+        """
+        if action_url is None:
+            action_url = self.__url
+        parameters = self.integrate_schema(self.__SCHEMA, client_parameters)
+
+        response = super().send_post(action_url, parameters, endpoint='download_merchant_balance', stream=True)
+        try:
+            response.raise_for_status()
+            for line in iter_text_lines(response.iter_content(chunk_size), encoding='big5'):
+                yield line
+        finally:
+            response.close()
+
 
 class SearchSingleTransaction(BasePayment):
 
@@ -770,31 +853,18 @@ class SearchSingleTransaction(BasePayment):
         'CreditCheckCode': {'type': int, 'required': True, },
     }
 
+    __SCHEMA = ParameterSchema(__SEARCH_SINGLE_TRANSACTION_PARAMETERS)
+
     __url = 'https://payment.ecPay.com.tw/CreditDetail/QueryTrade/V2'
 
     def search_single_transaction(self, action_url=__url, client_parameters={}):
-        self.__check_pattern = []
         if action_url is None:
             action_url = self.__url
-        # 先用 required.dict 設定預設值並產生新 new.required.dict
-        default_parameters = dict()
-        default_parameters = self.create_default_dict(
-            self.__SEARCH_SINGLE_TRANSACTION_PARAMETERS)
-        self.__check_pattern.append(
-            self.__SEARCH_SINGLE_TRANSACTION_PARAMETERS)
-
-        # 用 new.required.dict 與 client.dict 合併為 merge.dict
-        self.final_merge_parameters = super().merge(
-            default_parameters, client_parameters)
-
-        # 檢查參數, 並產生 CheckMacValue
-        self.final_merge_parameters = self.integrate_parameter(
-            self.final_merge_parameters,
-            self.__check_pattern)
+        # 以預先編譯的規格合併預設值、檢查參數並產生 CheckMacValue
+        parameters = self.integrate_schema(self.__SCHEMA, client_parameters)
 
         # 回傳給 client
-        response = super().send_post(
-            action_url, self.final_merge_parameters)
+        response = super().send_post(action_url, parameters, endpoint='search_single_transaction')
         query = json.loads(response.text)
 
         return query
@@ -810,31 +880,18 @@ class DownloadDisbursementBalance(BasePayment):
         'EndDate': {'type': str, 'required': True, 'max': 10},
     }
 
+    __SCHEMA = ParameterSchema(__DOWNLOAD_DISBURSEMENT_BALANCE_PARAMETERS)
+
     __url = 'https://payment.ecPay.com.tw/CreditDetail/FundingReconDetail'
 
     def download_disbursement_balance(self, action_url=__url, client_parameters={}):
-        self.__check_pattern = []
         if action_url is None:
             action_url = self.__url
-        # 先用 required.dict 設定預設值並產生新 new.required.dict
-        default_parameters = dict()
-        default_parameters = self.create_default_dict(
-            self.__DOWNLOAD_DISBURSEMENT_BALANCE_PARAMETERS)
-        self.__check_pattern.append(
-            self.__DOWNLOAD_DISBURSEMENT_BALANCE_PARAMETERS)
-
-        # 用 new.required.dict 與 client.dict 合併為 merge.dict
-        self.final_merge_parameters = super().merge(
-            default_parameters, client_parameters)
-
-        # 檢查參數, 並產生 CheckMacValue
-        self.final_merge_parameters = self.integrate_parameter(
-            self.final_merge_parameters,
-            self.__check_pattern)
+        # 以預先編譯的規格合併預設值、檢查參數並產生 CheckMacValue
+        parameters = self.integrate_schema(self.__SCHEMA, client_parameters)
 
         # 回傳給 client
-        response = super().send_post(
-            action_url, self.final_merge_parameters)
+        response = super().send_post(action_url, parameters, endpoint='download_disbursement_balance')
         response.encoding = 'big5'
         return response.text
 
@@ -850,25 +907,14 @@ a = [CreateOrder, OrderSearch,
 
 class ECPayPaymentSdk(*a):
 
-    def __init__(self, MerchantID='', HashKey='', HashIV=''):
+    def __init__(self, MerchantID='', HashKey='', HashIV='', transport=None):
         self.MerchantID = MerchantID
         self.HashKey = HashKey
         self.HashIV = HashIV
+        self.transport = transport
 
 def generate_check_mac_value(params: dict, hash_key: str, hash_iv: str) -> str:
-    sorted_items = sorted(params.items(), key=lambda k: k[0].lower())
-    joined = "&".join(f"{k}={v}" for k, v in sorted_items)
-    raw = f"HashKey={hash_key}&{joined}&HashIV={hash_iv}"
-    safe_characters = '-_.!*()'
-    encoded = quote_plus(raw, safe=safe_characters).lower()
-    sha = hashlib.sha256(encoded.encode('utf-8')).hexdigest()
-    check_mac_value = sha.upper()
-    return check_mac_value
+    return get_signer(hash_key, hash_iv).sign(params, encrypt_type=1)
 
 def verify_check_mac_value(received_params: dict, hash_key: str, hash_iv: str) -> bool:
-    received_check = received_params.get("CheckMacValue")
-    if not received_check:
-        return False
-    params = {k: v for k, v in received_params.items() if k != "CheckMacValue"}
-    calculated = generate_check_mac_value(params, hash_key, hash_iv)
-    return calculated == received_check.upper()
\ No newline at end of file
+    return get_signer(hash_key, hash_iv).verify(received_params, encrypt_type=1)
@@ -0,0 +1,82 @@
+import collections
+import copy
+import hashlib
+import timeit
+from urllib.parse import quote_plus
+from django.core.management.base import BaseCommand
+from api.v1.payment.ecpay_payment_sdk import ECPayPaymentSdk, get_signer
+
+SAMPLE_PARAMS = {
+    'MerchantID': '3002607',
+    'MerchantTradeNo': '2510181230001234ABCDE',
+    'MerchantTradeDate': '2025/10/18 12:30:00',
+    'PaymentType': 'aio',
+    'TotalAmount': 1250,
+    'TradeDesc': '訂單付款',
+    'ItemName': '有機蘋果*2#高山茶*1#地瓜*3',
+    'ReturnURL': 'https://example.com/api/v1/payment/notify/',
+    'ChoosePayment': 'ALL',
+    'ClientBackURL': 'https://example.com/api/v1/order/result/?order_id=1',
+    'OrderResultURL': 'https://example.com/api/v1/payment/order_result/',
+    'EncryptType': 1,
+}
+
+# 綠界回呼多為純 ASCII 欄位，可走 str.translate 快速路徑
+ASCII_PARAMS = dict(SAMPLE_PARAMS, TradeDesc='order', ItemName='apple*2#tea*1')
+
+
+def _baseline(params, merchant_id, hash_key, hash_iv):
+    """改寫前的 generate_check_value（deepcopy + OrderedDict + 逐鍵 format）"""
+    _params = copy.deepcopy(params)
+    if _params.get('CheckMacValue'):
+        _params.pop('CheckMacValue')
+    _params.update({'MerchantID': merchant_id})
+    ordered_params = collections.OrderedDict(sorted(_params.items(), key=lambda k: k[0].lower()))
+    encoding_str = 'HashKey=%s&' % hash_key + ''.join(
+        ['{}={}&'.format(key, value) for key, value in ordered_params.items()]) + 'HashIV=%s' % hash_iv
+    encoding_str = quote_plus(str(encoding_str), safe='-_.!*()').lower()
+    return hashlib.sha256(encoding_str.encode('utf-8')).hexdigest().upper()
+
+
+class Command(BaseCommand):
+    help = 'CheckMacValue 簽章效能測試（改寫前實作 vs CheckMacValueSigner）'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--number',
+            type=int,
+            default=20000,
+            help='每項測試的執行次數（默認 20000）'
+        )
+
+    def handle(self, *args, **options):
+        number = options['number']
+        sdk = ECPayPaymentSdk(MerchantID='3002607', HashKey='pwFHCqoQZGmho4w6', HashIV='EkRm7iFT261dpevs')
+        signer = get_signer(sdk.HashKey, sdk.HashIV)
+        signed = dict(SAMPLE_PARAMS, CheckMacValue=sdk.generate_check_value(SAMPLE_PARAMS))
+        rows = [signed] * 100
+
+        if _baseline(SAMPLE_PARAMS, sdk.MerchantID, sdk.HashKey, sdk.HashIV) != signed['CheckMacValue']:
+            self.stderr.write(self.style.ERROR('簽章結果與改寫前實作不一致'))
+            return
+
+        cases = [
+            ('baseline sign', lambda: _baseline(SAMPLE_PARAMS, sdk.MerchantID, sdk.HashKey, sdk.HashIV), 1),
+            ('signer sign', lambda: sdk.generate_check_value(SAMPLE_PARAMS), 1),
+            ('baseline sign (ascii)', lambda: _baseline(ASCII_PARAMS, sdk.MerchantID, sdk.HashKey, sdk.HashIV), 1),
+            ('signer sign (ascii)', lambda: sdk.generate_check_value(ASCII_PARAMS), 1),
+            ('signer verify', lambda: sdk.verify_check_value(signed), 1),
+            ('signer verify_many (per row)', lambda: signer.verify_many(rows), len(rows)),
+        ]
+
+        results = {}
+        for label, func, per_call in cases:
+            calls = max(number // per_call, 1)
+            seconds = min(timeit.repeat(func, number=calls, repeat=3))
+            results[label] = seconds / (calls * per_call) * 1e6
+            self.stdout.write(f'{label:<32} {results[label]:8.2f} µs/op')
+
+        self.stdout.write(self.style.SUCCESS(
+            f"加速 {results['baseline sign'] / results['signer sign']:.2f}x，"
+            f"ASCII {results['baseline sign (ascii)'] / results['signer sign (ascii)']:.2f}x"
+        ))
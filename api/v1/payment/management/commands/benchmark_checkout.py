@@ -0,0 +1,62 @@
+import timeit
+from django.core.management.base import BaseCommand
+from api.v1.payment.ecpay_payment_sdk import CreateOrder, ECPayPaymentSdk
+
+ACTION_URL = 'https://payment-stage.ecpay.com.tw/Cashier/AioCheckOut/V5'
+ORDER_PARAMS = {
+    'MerchantTradeNo': '2510181230001ABCDE',
+    'MerchantTradeDate': '2025/10/18 12:30:00',
+    'PaymentType': 'aio',
+    'TotalAmount': 1250,
+    'TradeDesc': '訂單付款',
+    'ItemName': '有機蘋果*2#高山茶*1#地瓜*3',
+    'ReturnURL': 'https://example.com/api/v1/payment/notify/',
+    'ChoosePayment': 'ALL',
+    'ClientBackURL': 'https://example.com/api/v1/order/result/?order_id=1',
+    'OrderResultURL': 'https://example.com/api/v1/payment/order_result/',
+}
+SDK_KWARGS = {'MerchantID': '3002607', 'HashKey': 'pwFHCqoQZGmho4w6', 'HashIV': 'EkRm7iFT261dpevs'}
+
+
+def _baseline_checkout(patterns):
+    """改寫前的結帳流程：每次建立 SDK、逐一處理 pattern、字串相加組表單"""
+    sdk = ECPayPaymentSdk(**SDK_KWARGS)
+    default_parameters = {}
+    for pattern in patterns:
+        default_parameters = sdk.merge(default_parameters, sdk.create_default_dict(pattern))
+    parameters = sdk.integrate_parameter(sdk.merge(default_parameters, dict(ORDER_PARAMS)), list(patterns))
+
+    html = '<form id="data_set" action="' + ACTION_URL + '" method="post">'
+    for k, v in parameters.items():
+        html += '<input type="hidden" name="' + str(k) + '" value="' + str(v) + '" />'
+    html += '<script type="text/javascript">document.getElementById("data_set").submit();</script>'
+    html += "</form>"
+    return html
+
+
+class Command(BaseCommand):
+    help = '綠界結帳（create_order + gen_html_post_form）效能測試'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--number',
+            type=int,
+            default=5000,
+            help='每項測試的執行次數（默認 5000）'
+        )
+
+    def handle(self, *args, **options):
+        number = options['number']
+        patterns = CreateOrder.compile_schema(ORDER_PARAMS['ChoosePayment']).patterns
+        sdk = ECPayPaymentSdk(**SDK_KWARGS)
+
+        def compiled_checkout():
+            return sdk.gen_html_post_form(ACTION_URL, sdk.create_order(dict(ORDER_PARAMS)))
+
+        results = {}
+        for label, func in (('baseline', lambda: _baseline_checkout(patterns)), ('compiled', compiled_checkout)):
+            seconds = min(timeit.repeat(func, number=number, repeat=3))
+            results[label] = seconds / number * 1e6
+            self.stdout.write(f'{label:<12} {results[label]:8.2f} µs/op')
+
+        self.stdout.write(self.style.SUCCESS(f"加速 {results['baseline'] / results['compiled']:.2f}x"))
@@ -0,0 +1,49 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from api.v1.payment.simulator import ECPaySimulator
+
+
+class Command(BaseCommand):
+    help = '啟動本機綠界模擬器（將 ECPAY_PAYMENT_URL 設為模擬器網址即可離線結帳）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1', help='監聽位址（默認 127.0.0.1）')
+        parser.add_argument('--port', type=int, default=8900, help='監聽埠號（默認 8900）')
+        parser.add_argument(
+            '--delay',
+            type=float,
+            default=0.0,
+            help='收到結帳後幾秒才送出付款通知（默認 0）'
+        )
+        parser.add_argument(
+            '--failure-ratio',
+            type=float,
+            default=0.0,
+            help='付款失敗的比例 0~1（默認 0）'
+        )
+        parser.add_argument(
+            '--duplicate-ratio',
+            type=float,
+            default=0.0,
+            help='付款通知重送一次的比例 0~1（默認 0）'
+        )
+        parser.add_argument('--seed', type=int, help='隨機種子，固定後每次執行結果相同')
+
+    def handle(self, *args, **options):
+        simulator = ECPaySimulator(
+            settings.MERCHANT_ID, settings.HASH_KEY, settings.HASH_IV,
+            delay=options['delay'],
+            failure_ratio=options['failure_ratio'],
+            duplicate_ratio=options['duplicate_ratio'],
+            host=options['host'],
+            port=options['port'],
+            seed=options['seed'],
+        )
+        self.stdout.write(self.style.SUCCESS(f'綠界模擬器已啟動：ECPAY_PAYMENT_URL={simulator.url}'))
+        try:
+            simulator.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            simulator.stop()
+            self.stdout.write(f'統計：{simulator.stats}')
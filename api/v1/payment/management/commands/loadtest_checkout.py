@@ -0,0 +1,134 @@
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler, get_internal_wsgi_application
+from django.db import close_old_connections, connection
+from django.test.utils import override_settings
+from django.urls import reverse
+from django.utils import timezone
+from api.v1.order import services as order_services
+from api.v1.order.models import Order
+from api.v1.payment.services import process_payment_events
+from api.v1.payment.simulator import ECPaySimulator, parse_post_form
+from api.v1.product.models import Product
+
+LOADTEST_EMAIL = 'loadtest@example.com'
+
+
+class _QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+
+class Command(BaseCommand):
+    help = (
+        '離線端對端結帳壓測：在本機啟動網站與綠界模擬器，'
+        '建立訂單後送出結帳表單，量測從結帳到訂單轉為已付款的吞吐量（會扣用指定商品的庫存）'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('product_id', type=int, help='下單的商品 id（需有足夠庫存）')
+        parser.add_argument('--orders', type=int, default=200, help='建立的訂單數（默認 200）')
+        parser.add_argument('--concurrency', type=int, default=16, help='同時結帳的連線數（默認 16）')
+        parser.add_argument('--delay', type=float, default=0.0, help='模擬器送出付款通知前的延遲秒數')
+        parser.add_argument('--failure-ratio', type=float, default=0.0, help='模擬付款失敗的比例')
+        parser.add_argument('--duplicate-ratio', type=float, default=0.0, help='模擬付款通知重送的比例')
+        parser.add_argument('--timeout', type=int, default=300, help='等待所有訂單結束的秒數上限（默認 300）')
+
+    def _process_events(self, stop):
+        # 收件匣 worker：持續套用模擬器送來的回呼
+        try:
+            while not stop.is_set():
+                if not process_payment_events(batch_size=200):
+                    time.sleep(0.05)
+        finally:
+            close_old_connections()
+
+    def handle(self, *args, **options):
+        product = Product.objects.filter(pk=options['product_id']).first()
+        if product is None:
+            raise CommandError('商品不存在')
+        if connection.vendor == 'sqlite' and connection.settings_dict['OPTIONS'].get('transaction_mode') != 'IMMEDIATE':
+            # 預設的 DEFERRED 交易在讀轉寫時不會等待鎖，併發寫入會直接 database is locked
+            self.stderr.write(self.style.WARNING(
+                'SQLite 未設定 OPTIONS transaction_mode=IMMEDIATE，併發回呼可能出現 database is locked'
+            ))
+        user, _ = get_user_model().objects.get_or_create(email=LOADTEST_EMAIL)
+
+        orders = [
+            order_services.create_order(user, [{'product_id': product.pk, 'quantity': 1}])[0]
+            for _ in range(options['orders'])
+        ]
+
+        simulator = ECPaySimulator(
+            settings.MERCHANT_ID, settings.HASH_KEY, settings.HASH_IV,
+            delay=options['delay'],
+            failure_ratio=options['failure_ratio'],
+            duplicate_ratio=options['duplicate_ratio'],
+        ).start()
+        httpd = ThreadedWSGIServer(('127.0.0.1', 0), _QuietHandler)
+        httpd.set_app(get_internal_wsgi_application())
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        site_url = 'http://127.0.0.1:%d' % httpd.server_address[1]
+
+        stop = threading.Event()
+        worker = threading.Thread(target=self._process_events, args=(stop,), daemon=True)
+        session = requests.Session()
+
+        checkout_started = {}
+
+        def checkout(order):
+            checkout_started[order.pk] = timezone.now()
+            form = session.get(site_url + reverse('api.v1.payment:ecpay_checkout', args=[order.pk]), timeout=30)
+            form.raise_for_status()
+            action, fields = parse_post_form(form.text)
+            session.post(action, data=fields, timeout=30).raise_for_status()
+
+        with override_settings(ECPAY_PAYMENT_URL=simulator.url, ALLOWED_HOSTS=['127.0.0.1']):
+            try:
+                worker.start()
+                started = time.monotonic()
+                with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+                    list(executor.map(checkout, orders))
+                checkout_seconds = time.monotonic() - started
+
+                order_ids = [order.pk for order in orders]
+                deadline = started + options['timeout']
+                pending = Order.objects.filter(pk__in=order_ids, status=Order.STATUS_PENDING)
+                while pending.exists() and time.monotonic() < deadline:
+                    time.sleep(0.1)
+                total_seconds = time.monotonic() - started
+            finally:
+                stop.set()
+                worker.join()
+                httpd.shutdown()
+                httpd.server_close()
+                simulator.stop()
+
+        counts = {status: 0 for status in (Order.STATUS_PAID, Order.STATUS_FAILED, Order.STATUS_PENDING)}
+        latencies = []
+        for pk, status, paid_at in Order.objects.filter(pk__in=order_ids).values_list('pk', 'status', 'paid_at'):
+            counts[status] = counts.get(status, 0) + 1
+            if paid_at:
+                latencies.append((paid_at - checkout_started[pk]).total_seconds())
+
+        self.stdout.write(f'結帳 {len(orders)} 筆：{checkout_seconds:.2f} 秒（{len(orders) / checkout_seconds:.1f} 筆/秒）')
+        self.stdout.write(
+            f"已付款 {counts[Order.STATUS_PAID]}、付款失敗 {counts[Order.STATUS_FAILED]}、"
+            f"未完成 {counts[Order.STATUS_PENDING]}，共耗時 {total_seconds:.2f} 秒"
+        )
+        if latencies:
+            latencies.sort()
+            self.stdout.write(
+                f'結帳到已付款：中位數 {statistics.median(latencies) * 1000:.0f} ms、'
+                f'p95 {latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000:.0f} ms'
+            )
+        self.stdout.write(self.style.SUCCESS(
+            f"結帳到已付款吞吐量 {counts[Order.STATUS_PAID] / total_seconds:.1f} 筆/秒，模擬器統計 {simulator.stats}"
+        ))
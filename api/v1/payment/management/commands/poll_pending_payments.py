@@ -0,0 +1,67 @@
+import time
+from django.core.management.base import BaseCommand
+from api.v1.payment.services import poll_pending_orders
+
+
+class Command(BaseCommand):
+    help = '主動向綠界查詢逾時未收到付款通知的訂單，並更新付款狀態'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than',
+            type=int,
+            default=15,
+            help='查詢建立超過多少分鐘仍未付款的訂單（默認 15）'
+        )
+        parser.add_argument(
+            '--recheck-minutes',
+            type=int,
+            default=10,
+            help='同一筆訂單兩次查詢的最短間隔分鐘數（默認 10）'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=200,
+            help='每批查詢的訂單數（默認 200）'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=8,
+            help='並行查詢的執行緒數（默認 8）'
+        )
+        parser.add_argument(
+            '--loop',
+            action='store_true',
+            help='持續執行，作為背景 worker'
+        )
+        parser.add_argument(
+            '--interval',
+            type=int,
+            default=60,
+            help='--loop 模式下每輪間隔秒數（默認 60）'
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            result = poll_pending_orders(
+                older_than_minutes=options['older_than'],
+                recheck_minutes=options['recheck_minutes'],
+                batch_size=options['batch_size'],
+                workers=options['workers'],
+            )
+            if result['checked']:
+                self.stdout.write(self.style.SUCCESS(
+                    f"查詢了 {result['checked']} 筆訂單：{result['paid']} 筆已付款、{result['failed']} 筆付款失敗"
+                    f"（其中 {result['expired']} 筆超過付款期限）"
+                ))
+                if result['checked'] == options['batch_size']:
+                    # 可能還有待查詢的訂單，直接處理下一批
+                    continue
+            elif not options['loop']:
+                self.stdout.write(self.style.WARNING('沒有需要查詢的訂單'))
+
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
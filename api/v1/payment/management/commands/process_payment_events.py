@@ -0,0 +1,49 @@
+import time
+from django.core.management.base import BaseCommand
+from api.v1.payment.services import process_payment_events
+
+
+class Command(BaseCommand):
+    help = '處理綠界回呼收件匣，套用訂單付款狀態'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=100,
+            help='每批處理的事件數（默認 100）'
+        )
+        parser.add_argument(
+            '--loop',
+            action='store_true',
+            help='持續執行，作為背景 worker'
+        )
+        parser.add_argument(
+            '--interval',
+            type=int,
+            default=2,
+            help='--loop 模式下收件匣為空時的等待秒數（默認 2）'
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        total = 0
+
+        while True:
+            handled = process_payment_events(batch_size=batch_size)
+            total += handled
+            if handled == batch_size:
+                # 可能還有待處理的事件，直接處理下一批
+                continue
+
+            if not options['loop']:
+                break
+            if total:
+                self.stdout.write(self.style.SUCCESS(f'處理了 {total} 筆付款事件'))
+                total = 0
+            time.sleep(options['interval'])
+
+        if total:
+            self.stdout.write(self.style.SUCCESS(f'處理了 {total} 筆付款事件'))
+        else:
+            self.stdout.write(self.style.WARNING('沒有待處理的付款事件'))
@@ -0,0 +1,68 @@
+import csv
+import sys
+import time
+from datetime import datetime
+from django.core.management.base import BaseCommand, CommandError
+from api.v1.payment.ecpay_payment_sdk import iter_text_lines
+from api.v1.payment.reconcile import REPORT_HEADER, iter_balance_rows, reconcile
+from api.v1.payment.services import get_payment_sdk
+
+FILE_CHUNK_SIZE = 64 * 1024
+
+
+class Command(BaseCommand):
+    help = '串流比對綠界對帳檔與訂單，輸出差異報表（綠界已付款但訂單未付款 / 查無訂單、金額不符）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--begin', help='對帳起始日期 YYYY-MM-DD（從綠界下載時必填）')
+        parser.add_argument('--end', help='對帳結束日期 YYYY-MM-DD（從綠界下載時必填）')
+        parser.add_argument(
+            '--date-type',
+            default='2',
+            help='綠界 DateType：2 付款日期、4 撥款日期、6 訂單日期（默認 2）'
+        )
+        parser.add_argument('--file', help='改為比對本機已下載的對帳檔（big5 CSV）')
+        parser.add_argument('--encoding', default='big5', help='--file 的編碼（默認 big5）')
+        parser.add_argument('--output', help='差異報表輸出路徑（默認輸出到 stdout）')
+
+    def _download(self, options):
+        for key in ('begin', 'end'):
+            try:
+                datetime.strptime(options[key] or '', '%Y-%m-%d')
+            except ValueError:
+                raise CommandError(f'--{key} 需為 YYYY-MM-DD')
+        return get_payment_sdk().iter_merchant_balance(client_parameters={
+            'DateType': options['date_type'],
+            'BeginDate': options['begin'],
+            'EndDate': options['end'],
+            'MediaFormated': '1',
+        })
+
+    def _read_file(self, path, encoding):
+        with open(path, 'rb') as f:
+            yield from iter_text_lines(iter(lambda: f.read(FILE_CHUNK_SIZE), b''), encoding=encoding)
+
+    def handle(self, *args, **options):
+        lines = self._read_file(options['file'], options['encoding']) if options['file'] else self._download(options)
+
+        started = time.monotonic()
+        stats = {}
+        out = open(options['output'], 'w', encoding='utf-8-sig', newline='') if options['output'] else sys.stdout
+        try:
+            writer = csv.writer(out)
+            writer.writerow(REPORT_HEADER)
+            for d in reconcile(iter_balance_rows(lines), stats=stats):
+                writer.writerow([
+                    d.kind, d.merchant_trade_no, d.trade_no, d.ecpay_amount,
+                    d.order_id or '', d.order_amount if d.order_amount is not None else '', d.order_status or '',
+                ])
+        finally:
+            if out is not sys.stdout:
+                out.close()
+
+        message = (
+            f"對帳完成：{stats.get('rows', 0)} 筆交易（{stats.get('paid', 0)} 筆已付款），"
+            f"{stats.get('discrepancies', 0)} 筆差異，耗時 {time.monotonic() - started:.1f} 秒"
+        )
+        style = self.style.WARNING if stats.get('discrepancies') else self.style.SUCCESS
+        self.stderr.write(style(message))
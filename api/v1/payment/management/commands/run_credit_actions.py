@@ -0,0 +1,82 @@
+import csv
+from django.core.management.base import BaseCommand, CommandError
+from api.v1.payment.credit_actions import enqueue_credit_actions, get_rate_limiter, run_credit_actions
+from api.v1.payment.models import CreditAction
+
+
+class Command(BaseCommand):
+    help = '批次送出綠界信用卡請款 / 退款（可中斷後重跑，不會重複送出）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('batch', help='批次名稱，重跑時使用同一個名稱')
+        parser.add_argument(
+            '--file',
+            help='匯入動作的 CSV，欄位為 merchant_trade_no,trade_no,amount[,action]'
+        )
+        parser.add_argument(
+            '--action',
+            default=CreditAction.ACTION_REFUND,
+            choices=CreditAction.ACTIONS,
+            help='CSV 未指定 action 時使用的動作（默認 R 退刷）'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=4,
+            help='並行送出的執行緒數（默認 4）'
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=50,
+            help='每批送出的動作數（默認 50）'
+        )
+        parser.add_argument(
+            '--rate',
+            type=float,
+            help='每個商店代號每秒最多送出次數（默認 CREDIT_ACTION_RATE_PER_SECOND）'
+        )
+        parser.add_argument(
+            '--retry-failed',
+            action='store_true',
+            help='重新送出綠界回覆失敗的動作'
+        )
+
+    def _read_actions(self, path, default_action):
+        with open(path, newline='', encoding='utf-8-sig') as f:
+            for row in csv.DictReader(f):
+                yield (
+                    row['merchant_trade_no'].strip(),
+                    row['trade_no'].strip(),
+                    (row.get('action') or default_action).strip().upper(),
+                    row['amount'].strip(),
+                )
+
+    def handle(self, *args, **options):
+        batch = options['batch']
+        if options['file']:
+            try:
+                total = enqueue_credit_actions(batch, self._read_actions(options['file'], options['action']))
+            except (KeyError, ValueError, ArithmeticError) as exc:
+                raise CommandError(f'CSV 格式錯誤：{exc}')
+            self.stdout.write(f'批次 {batch} 共 {total} 筆動作')
+
+        if options['retry_failed']:
+            CreditAction.objects.filter(batch=batch, status=CreditAction.STATUS_FAILED).update(
+                status=CreditAction.STATUS_PENDING
+            )
+
+        result = run_credit_actions(
+            batch,
+            workers=options['workers'],
+            chunk_size=options['chunk_size'],
+            limiter=get_rate_limiter(options['rate']),
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"送出 {result['sent']} 筆：{result['succeeded']} 筆成功、{result['failed']} 筆失敗、"
+            f"{result['unknown']} 筆結果不明"
+        ))
+
+        unknown = CreditAction.objects.filter(batch=batch, status=CreditAction.STATUS_UNKNOWN)
+        for merchant_trade_no, action, rtn_msg in unknown.values_list('merchant_trade_no', 'action', 'rtn_msg'):
+            self.stdout.write(self.style.WARNING(f'{merchant_trade_no} {action} 需至綠界後台確認：{rtn_msg}'))
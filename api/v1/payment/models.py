@@ -1,3 +1,89 @@
 from django.db import models
 
-# Create your models here.
+
+class PaymentEvent(models.Model):
+    """
+    綠界回呼收件匣（只新增不修改原始內容）。
+
+    回呼 view 只驗證 CheckMacValue 並寫入此表後立即回覆，
+    訂單狀態由 process_payment_events worker 分批套用並記錄處理結果。
+    """
+    KIND_NOTIFY = "notify"
+    KIND_ORDER_RESULT = "order_result"
+
+    STATUS_PENDING = "pending"
+    STATUS_PROCESSED = "processed"
+    STATUS_FAILED = "failed"
+
+    kind = models.CharField(max_length=20)  # notify / order_result
+    merchant_trade_no = models.CharField(max_length=20, db_index=True)
+    rtn_code = models.CharField(max_length=10, blank=True)
+    payload = models.JSONField()  # 綠界送來的原始欄位
+    received_at = models.DateTimeField(auto_now_add=True)
+
+    status = models.CharField(max_length=10, default=STATUS_PENDING)  # pending / processed / failed
+    result = models.CharField(max_length=20, blank=True)  # paid / failed / duplicate 等處理結果
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(blank=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)  # worker 取出的時間，逾時未完成可由其他 worker 重新取出
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # worker 只掃描待處理的事件
+            models.Index(
+                fields=["id"],
+                condition=models.Q(status="pending"),
+                name="payment_event_pending_idx",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} {self.merchant_trade_no} ({self.status})"
+
+
+class CreditAction(models.Model):
+    """
+    批次信用卡請款 / 退款作業的單筆動作（綠界 CreditDetail/DoAction）。
+
+    送出前先標記為 sending 並提交，中斷後重跑時不會再次送出，
+    停在 sending 的動作改為 unknown 等待人工至綠界後台確認，避免重複退款。
+    """
+    ACTION_CAPTURE = "C"  # 關帳
+    ACTION_REFUND = "R"  # 退刷
+    ACTION_CANCEL = "E"  # 取消
+    ACTION_ABANDON = "N"  # 放棄
+    ACTIONS = (ACTION_CAPTURE, ACTION_REFUND, ACTION_CANCEL, ACTION_ABANDON)
+
+    STATUS_PENDING = "pending"
+    STATUS_SENDING = "sending"
+    STATUS_SUCCEEDED = "succeeded"
+    STATUS_FAILED = "failed"
+    STATUS_UNKNOWN = "unknown"
+
+    batch = models.CharField(max_length=50)  # 批次名稱，例如召回事件編號
+    merchant_trade_no = models.CharField(max_length=20)
+    trade_no = models.CharField(max_length=20)  # 綠界交易編號
+    action = models.CharField(max_length=1)  # C / R / E / N
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+
+    status = models.CharField(max_length=10, default=STATUS_PENDING)  # pending / sending / succeeded / failed / unknown
+    rtn_code = models.CharField(max_length=10, blank=True)
+    rtn_msg = models.CharField(max_length=200, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            # 同一批次重複匯入同一筆動作時忽略
+            models.UniqueConstraint(
+                fields=["batch", "merchant_trade_no", "action"], name="credit_action_unique"
+            ),
+        ]
+        indexes = [
+            models.Index(fields=["batch", "status"], name="credit_action_batch_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.batch} {self.action} {self.merchant_trade_no} ({self.status})"
@@ -0,0 +1,150 @@
+"""
+綠界對帳檔（download_merchant_balance）與訂單的串流對帳。
+
+對帳檔逐行解碼、以 generator 解析，每 RECONCILE_CHUNK_SIZE 筆以 in_bulk 比對一次訂單，
+整個流程的記憶體用量只與區塊大小有關。
+"""
+import csv
+from collections import namedtuple
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from itertools import islice
+from api.v1.order.models import ArchivedOrder, Order
+
+RECONCILE_CHUNK_SIZE = 2000
+
+# 對帳檔欄位名稱（依綠界匯出格式，列出可能的欄名）
+BALANCE_COLUMNS = {
+    'merchant_trade_no': ('特店訂單編號', '廠商訂單編號', 'MerchantTradeNo'),
+    'trade_no': ('綠界訂單編號', '綠界交易編號', 'TradeNo'),
+    'amount': ('交易金額', '訂單金額', 'TradeAmt'),
+    'status': ('付款狀態', '交易狀態', 'PaymentStatus'),
+}
+PAID_STATUSES = frozenset(['已付款', '付款成功', '交易成功', '1'])
+
+BalanceRow = namedtuple('BalanceRow', ['merchant_trade_no', 'trade_no', 'amount', 'status', 'paid'])
+Discrepancy = namedtuple('Discrepancy', ['kind', 'merchant_trade_no', 'trade_no', 'ecpay_amount',
+                                         'order_id', 'order_amount', 'order_status'])
+
+# 差異類型
+MISSING_ORDER = 'missing_order'  # 綠界已付款，我們沒有這筆訂單
+NOT_PAID = 'not_paid'  # 綠界已付款，訂單不是已付款狀態
+AMOUNT_MISMATCH = 'amount_mismatch'  # 金額不一致
+
+REPORT_HEADER = ['差異類型', '特店訂單編號', '綠界訂單編號', '綠界金額', '訂單ID', '訂單金額', '訂單狀態']
+
+
+def _clean(value):
+    # 綠界匯出的 CSV 會以 ="..." 包住欄位避免 Excel 轉型
+    value = value.strip()
+    if value.startswith('="') and value.endswith('"'):
+        value = value[2:-1]
+    return value.strip()
+
+
+def _amount(value):
+    try:
+        return Decimal(value.replace(',', ''))
+    except InvalidOperation:
+        return None
+
+
+def _column_index(header, names):
+    for name in names:
+        if name in header:
+            return header.index(name)
+    return None
+
+
+def iter_balance_rows(lines):
+    """
+    解析對帳檔的文字行，逐筆產生 BalanceRow。
+    第一個含有特店訂單編號欄位的列視為標題列，之前的說明列與之後的空白列、合計列略過。
+    """
+    reader = csv.reader(lines)
+    columns = None
+    for row in reader:
+        cells = [_clean(cell) for cell in row]
+        if columns is None:
+            index = _column_index(cells, BALANCE_COLUMNS['merchant_trade_no'])
+            if index is not None:
+                columns = {key: _column_index(cells, names) for key, names in BALANCE_COLUMNS.items()}
+            continue
+
+        def cell(key):
+            i = columns[key]
+            return cells[i] if i is not None and i < len(cells) else ''
+
+        merchant_trade_no = cell('merchant_trade_no')
+        if not merchant_trade_no:
+            continue
+        status = cell('status')
+        yield BalanceRow(
+            merchant_trade_no=merchant_trade_no,
+            trade_no=cell('trade_no'),
+            amount=_amount(cell('amount')),
+            status=status,
+            paid=status in PAID_STATUSES,
+        )
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _order_amount(order):
+    # 綠界金額為整數，訂單金額以四捨五入比對（與結帳時送出的 TotalAmount 相同）
+    return order.total_amount.quantize(Decimal('1'), rounding=ROUND_HALF_UP)
+
+
+def reconcile(rows, chunk_size=RECONCILE_CHUNK_SIZE, stats=None):
+    """
+    比對對帳檔與訂單，逐筆產生 Discrepancy。
+    每個區塊以 merchant_trade_no 對訂單做一次 in_bulk，查不到的再查封存表一次。
+    stats 若為 dict，會累計 rows / paid / discrepancies 筆數。
+    """
+    if stats is None:
+        stats = {}
+    for key in ('rows', 'paid', 'discrepancies'):
+        stats.setdefault(key, 0)
+
+    fields = ('id', 'merchant_trade_no', 'total_amount', 'status')
+    for chunk in _chunks(rows, chunk_size):
+        stats['rows'] += len(chunk)
+        trade_nos = [row.merchant_trade_no for row in chunk]
+        orders = Order.objects.only(*fields).in_bulk(trade_nos, field_name='merchant_trade_no')
+        missing = [no for no in trade_nos if no not in orders]
+        if missing:
+            orders.update(
+                ArchivedOrder.objects.only(*fields).in_bulk(missing, field_name='merchant_trade_no')
+            )
+
+        for row in chunk:
+            order = orders.get(row.merchant_trade_no)
+            if row.paid:
+                stats['paid'] += 1
+            kind = None
+            if order is None:
+                if row.paid:
+                    kind = MISSING_ORDER
+            elif row.paid and order.status != Order.STATUS_PAID:
+                kind = NOT_PAID
+            elif row.amount is not None and row.amount != _order_amount(order):
+                kind = AMOUNT_MISMATCH
+            if kind is None:
+                continue
+
+            stats['discrepancies'] += 1
+            yield Discrepancy(
+                kind=kind,
+                merchant_trade_no=row.merchant_trade_no,
+                trade_no=row.trade_no,
+                ecpay_amount=row.amount,
+                order_id=order.pk if order else None,
+                order_amount=order.total_amount if order else None,
+                order_status=order.status if order else None,
+            )
@@ -0,0 +1,188 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from functools import lru_cache
+import logging
+import time
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from api.v1.order.models import Order
+from api.v1.order.services import mark_order_failed, mark_order_paid, mark_orders_failed, mark_orders_paid
+from .ecpay_payment_sdk import ECPayPaymentSdk
+from .models import PaymentEvent
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=4)
+def _payment_sdk(merchant_id, hash_key, hash_iv):
+    return ECPayPaymentSdk(MerchantID=merchant_id, HashKey=hash_key, HashIV=hash_iv)
+
+
+def get_payment_sdk():
+    """
+    取得全程序共用的綠界 SDK 實例（依目前的商店設定快取）。
+    SDK 不在實例上保存每次呼叫的參數，可在多個請求 / 執行緒間共用。
+    """
+    return _payment_sdk(str(settings.MERCHANT_ID), str(settings.HASH_KEY), str(settings.HASH_IV))
+
+
+def ecpay_url(path):
+    """綠界金流網址（ECPAY_PAYMENT_URL，未設定時依 DEBUG 選擇測試或正式環境）"""
+    base_url = settings.ECPAY_PAYMENT_URL or (
+        'https://payment-stage.ecpay.com.tw' if settings.DEBUG else 'https://payment.ecpay.com.tw'
+    )
+    return base_url.rstrip('/') + path
+
+
+def record_payment_event(kind, data):
+    """將已驗證的綠界回呼原樣寫入收件匣"""
+    return PaymentEvent.objects.create(
+        kind=kind,
+        merchant_trade_no=data.get("MerchantTradeNo", "")[:20],
+        rtn_code=data.get("RtnCode", "")[:10],
+        payload=data,
+    )
+
+
+def apply_payment_event(event):
+    """
+    依事件套用訂單狀態，回傳處理結果。
+    狀態轉換皆為條件式 UPDATE，同一筆付款的 notify / OrderResult 重複處理不會有副作用。
+    """
+    if event.rtn_code == "1":  # 交易成功
+        order = mark_order_paid(event.merchant_trade_no)
+        return "paid" if order else "duplicate"
+    order = mark_order_failed(event.merchant_trade_no)
+    return "failed" if order else "duplicate"
+
+
+def _claim_payment_events(batch_size):
+    """
+    在短交易內取出一批待處理的事件：記錄 claimed_at 並累加 attempts 後立即提交。
+    取出後逾時未完成的事件（worker 中斷）會被重新取出。
+    """
+    now = timezone.now()
+    claimable = PaymentEvent.objects.filter(status=PaymentEvent.STATUS_PENDING).filter(
+        Q(claimed_at__isnull=True)
+        | Q(claimed_at__lt=now - timedelta(seconds=settings.PAYMENT_EVENT_CLAIM_TIMEOUT_SECONDS))
+    )
+    with transaction.atomic():
+        pks = list(
+            claimable.select_for_update(skip_locked=True)
+            .order_by("pk").values_list("pk", flat=True)[:batch_size]
+        )
+        claimable.filter(pk__in=pks).update(claimed_at=now, attempts=F("attempts") + 1)
+    return list(PaymentEvent.objects.filter(pk__in=pks, claimed_at=now).order_by("pk"))
+
+
+def process_payment_events(batch_size=100):
+    """
+    取出一批待處理的事件並逐筆套用，回傳本批取出的事件數。
+
+    取出與每筆事件的處理各自是獨立的短交易，處理中不會長時間占住寫入鎖而擋住回呼寫入收件匣。
+    處理失敗時該事件的交易回滾、記錄錯誤並留待下一輪重試，
+    超過 PAYMENT_EVENT_MAX_ATTEMPTS 次才標記為 failed。多個 worker 以 skip_locked 與 claimed_at 分攤。
+    """
+    events = _claim_payment_events(batch_size)
+    for event in events:
+        try:
+            with transaction.atomic():
+                result = apply_payment_event(event)
+                PaymentEvent.objects.filter(pk=event.pk).update(
+                    status=PaymentEvent.STATUS_PROCESSED, result=result, error="",
+                    processed_at=timezone.now(),
+                )
+        except Exception as exc:
+            logger.exception("Payment event %s failed (attempt %s)", event.pk, event.attempts)
+            PaymentEvent.objects.filter(pk=event.pk).update(
+                status=(
+                    PaymentEvent.STATUS_FAILED
+                    if event.attempts >= settings.PAYMENT_EVENT_MAX_ATTEMPTS
+                    else PaymentEvent.STATUS_PENDING
+                ),
+                error=str(exc),
+                claimed_at=None,
+                processed_at=timezone.now(),
+            )
+    return len(events)
+
+
+# 綠界 QueryTradeInfo 的 TradeStatus
+TRADE_STATUS_PAID = "1"
+TRADE_STATUS_FAILED = "10200095"
+
+
+def stale_pending_orders(older_than_minutes, recheck_minutes, now=None):
+    """
+    建立超過 older_than_minutes 分鐘仍未付款、且最近 recheck_minutes 分鐘內未查詢過的訂單。
+    以 (status, created_at) 索引篩選，最舊的優先；超過付款期限的訂單由 poll_pending_orders 轉為 failed 後就不再出現。
+    """
+    now = now or timezone.now()
+    return Order.objects.filter(
+        status=Order.STATUS_PENDING,
+        created_at__lt=now - timedelta(minutes=older_than_minutes),
+    ).filter(
+        Q(payment_checked_at__isnull=True)
+        | Q(payment_checked_at__lt=now - timedelta(minutes=recheck_minutes))
+    ).order_by("created_at")
+
+
+def _query_trade(sdk, merchant_trade_no):
+    """查詢單筆交易狀態（在 worker 執行緒執行，不可存取資料庫），失敗時回傳 None"""
+    try:
+        result = sdk.order_search(
+            action_url=ecpay_url('/Cashier/QueryTradeInfo/V5'),
+            client_parameters={'MerchantTradeNo': merchant_trade_no, 'TimeStamp': int(time.time())},
+        )
+    except Exception:
+        logger.warning("ECPay QueryTradeInfo failed for %s", merchant_trade_no, exc_info=True)
+        return None
+    return result.get('TradeStatus')
+
+
+def poll_pending_orders(older_than_minutes=15, recheck_minutes=10, batch_size=200, workers=8, sdk=None,
+                        deadline_minutes=None):
+    """
+    向綠界查詢一批逾時未收到付款通知的訂單，並以批次轉換套用結果。
+
+    查詢以最多 workers 個執行緒並行（連線數另受 Transport 的併發上限約束），
+    查詢過的訂單記錄 payment_checked_at，重跑時會略過最近查過的訂單。
+    建立超過 deadline_minutes（預設 ORDER_PAYMENT_DEADLINE_MINUTES）的訂單已過繳費期限，
+    綠界回報未付款、查無交易或查詢失敗時都標記為 failed，之後不再查詢。
+    回傳 {'checked': 查詢筆數, 'paid': 轉為已付款筆數, 'failed': 轉為失敗筆數, 'expired': 其中逾期轉為失敗的筆數}。
+    """
+    sdk = sdk or get_payment_sdk()
+    now = timezone.now()
+    deadline = now - timedelta(
+        minutes=settings.ORDER_PAYMENT_DEADLINE_MINUTES if deadline_minutes is None else deadline_minutes
+    )
+    rows = list(
+        stale_pending_orders(older_than_minutes, recheck_minutes, now=now)
+        .values_list("pk", "merchant_trade_no", "created_at")[:batch_size]
+    )
+    if not rows:
+        return {'checked': 0, 'paid': 0, 'failed': 0, 'expired': 0}
+
+    trade_nos = [trade_no for _, trade_no, _ in rows]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        statuses = list(executor.map(lambda trade_no: _query_trade(sdk, trade_no), trade_nos))
+
+    paid, failed, expired = [], [], []
+    for (_, trade_no, created_at), status in zip(rows, statuses):
+        if status == TRADE_STATUS_PAID:
+            paid.append(trade_no)
+        elif status == TRADE_STATUS_FAILED:
+            failed.append(trade_no)
+        elif created_at < deadline:
+            expired.append(trade_no)
+
+    Order.objects.filter(pk__in=[pk for pk, _, _ in rows]).update(payment_checked_at=now)
+    expired_count = len(mark_orders_failed(expired)) if expired else 0
+    return {
+        'checked': len(rows),
+        'paid': len(mark_orders_paid(paid)) if paid else 0,
+        'failed': (len(mark_orders_failed(failed)) if failed else 0) + expired_count,
+        'expired': expired_count,
+    }
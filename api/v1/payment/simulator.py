@@ -0,0 +1,229 @@
+"""
+本機綠界模擬器，用於端對端結帳壓測與測試（不連線到綠界）。
+
+接受 ecpay_checkout 產生的 AioCheckOut 表單並驗證 CheckMacValue，
+依設定的延遲、重送與失敗比例送出已簽章的付款通知（ReturnURL）與 OrderResultURL 回呼，
+並回答 QueryTradeInfo 查詢。以 ECPAY_PAYMENT_URL 指向模擬器即可使用。
+"""
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlencode
+import logging
+import random
+import threading
+import time
+import requests
+from django.utils import timezone
+from .ecpay_payment_sdk import get_signer
+from .services import TRADE_STATUS_FAILED, TRADE_STATUS_PAID
+
+logger = logging.getLogger(__name__)
+
+AIO_CHECKOUT_PATH = '/Cashier/AioCheckOut/V5'
+QUERY_TRADE_INFO_PATH = '/Cashier/QueryTradeInfo/V5'
+
+RTN_CODE_PAID = '1'
+RTN_CODE_FAILED = '10100058'  # 付款失敗
+
+
+class _PostFormParser(HTMLParser):
+
+    def __init__(self):
+        super().__init__()
+        self.action = None
+        self.fields = {}
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'form':
+            self.action = attrs.get('action')
+        elif tag == 'input' and attrs.get('name'):
+            self.fields[attrs['name']] = attrs.get('value', '')
+
+
+def parse_post_form(html):
+    """解析 gen_html_post_form 產生的表單，回傳 (action, 欄位)，模擬瀏覽器自動送出"""
+    parser = _PostFormParser()
+    parser.feed(html)
+    return parser.action, parser.fields
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        params = dict(parse_qsl(self.rfile.read(length).decode('utf-8'), keep_blank_values=True))
+        path = self.path.split('?', 1)[0]
+        if path == AIO_CHECKOUT_PATH:
+            status, body = self.server.simulator.checkout(params)
+        elif path == QUERY_TRADE_INFO_PATH:
+            status, body = self.server.simulator.query_trade_info(params)
+        else:
+            status, body = 404, 'Not Found'
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ECPaySimulator(object):
+    """
+    模擬綠界全方位金流與查詢 API。
+
+    delay 為付款完成到送出回呼的秒數，failure_ratio 為付款失敗的比例，
+    duplicate_ratio 為付款通知重送一次的比例（綠界未收到 1|OK 時會重送）。
+    stats 記錄收到的結帳數與回呼結果，可用於壓測報表。
+    """
+
+    def __init__(self, merchant_id, hash_key, hash_iv, delay=0.0, failure_ratio=0.0, duplicate_ratio=0.0,
+                 host='127.0.0.1', port=0, callback_workers=8, seed=None):
+        self.merchant_id = str(merchant_id)
+        self.signer = get_signer(hash_key, hash_iv)
+        self.delay = delay
+        self.failure_ratio = failure_ratio
+        self.duplicate_ratio = duplicate_ratio
+        self.trades = {}
+        self.stats = {'checkouts': 0, 'rejected': 0, 'notified': 0, 'duplicates': 0, 'callback_errors': 0}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._session = requests.Session()
+        self._callbacks = ThreadPoolExecutor(max_workers=callback_workers)
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.simulator = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._callbacks.shutdown(wait=True)
+        self._session.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _sign(self, params):
+        params['CheckMacValue'] = self.signer.sign(params, encrypt_type=1)
+        return params
+
+    def _valid(self, params):
+        return params.get('MerchantID') == self.merchant_id and self.signer.verify(params)
+
+    def checkout(self, params):
+        """收到 AioCheckOut 表單：驗證後立即決定付款結果，回呼交由背景執行緒送出"""
+        if not self._valid(params):
+            self._count('rejected')
+            return 400, 'CheckMacValue Error'
+        merchant_trade_no = params.get('MerchantTradeNo', '')
+
+        with self._lock:
+            if merchant_trade_no in self.trades:
+                self.stats['rejected'] += 1
+                return 400, 'MerchantTradeNo 重複'
+            self.stats['checkouts'] += 1
+            trade = {
+                'TradeNo': '%s%06d' % (timezone.localtime().strftime('%y%m%d%H%M'), len(self.trades) + 1),
+                'TradeAmt': params.get('TotalAmount', '0'),
+                'TradeDate': timezone.localtime().strftime('%Y/%m/%d %H:%M:%S'),
+                'paid': self._random.random() >= self.failure_ratio,
+                'completed': False,
+            }
+            self.trades[merchant_trade_no] = trade
+            duplicate = self._random.random() < self.duplicate_ratio
+
+        self._callbacks.submit(self._complete, merchant_trade_no, params, duplicate)
+        return 200, '<html><body><h2>模擬付款中</h2><p>%s</p></body></html>' % merchant_trade_no
+
+    def _callback_params(self, merchant_trade_no, checkout):
+        trade = self.trades[merchant_trade_no]
+        return self._sign({
+            'MerchantID': self.merchant_id,
+            'MerchantTradeNo': merchant_trade_no,
+            'StoreID': checkout.get('StoreID', ''),
+            'RtnCode': RTN_CODE_PAID if trade['paid'] else RTN_CODE_FAILED,
+            'RtnMsg': '交易成功' if trade['paid'] else '付款失敗',
+            'TradeNo': trade['TradeNo'],
+            'TradeAmt': trade['TradeAmt'],
+            'PaymentDate': timezone.localtime().strftime('%Y/%m/%d %H:%M:%S'),
+            'PaymentType': 'Credit_CreditCard',
+            'PaymentTypeChargeFee': '0',
+            'TradeDate': trade['TradeDate'],
+            'SimulatePaid': '1',
+            'CustomField1': checkout.get('CustomField1', ''),
+            'CustomField2': checkout.get('CustomField2', ''),
+            'CustomField3': checkout.get('CustomField3', ''),
+            'CustomField4': checkout.get('CustomField4', ''),
+        })
+
+    def _post(self, url, params):
+        try:
+            response = self._session.post(url, data=params, timeout=(3.05, 15))
+        except requests.RequestException:
+            logger.warning('Simulator callback to %s failed', url, exc_info=True)
+            self._count('callback_errors')
+            return None
+        if response.status_code >= 400:
+            self._count('callback_errors')
+        return response
+
+    def _complete(self, merchant_trade_no, checkout, duplicate):
+        if self.delay:
+            time.sleep(self.delay)
+        params = self._callback_params(merchant_trade_no, checkout)
+        self.trades[merchant_trade_no]['completed'] = True
+
+        response = self._post(checkout['ReturnURL'], params)
+        if response is not None and response.text == '1|OK':
+            self._count('notified')
+        if duplicate:
+            self._post(checkout['ReturnURL'], params)
+            self._count('duplicates')
+        if checkout.get('OrderResultURL'):
+            self._post(checkout['OrderResultURL'], params)
+
+    def query_trade_info(self, params):
+        """回答 QueryTradeInfo：回呼送出前視為未付款（TradeStatus 0）"""
+        if not self._valid(params):
+            return 400, 'CheckMacValue Error'
+        merchant_trade_no = params.get('MerchantTradeNo', '')
+        trade = self.trades.get(merchant_trade_no)
+        if trade is None or not trade['completed']:
+            trade_status = '0'
+        else:
+            trade_status = TRADE_STATUS_PAID if trade['paid'] else TRADE_STATUS_FAILED
+        result = self._sign({
+            'MerchantID': self.merchant_id,
+            'MerchantTradeNo': merchant_trade_no,
+            'TradeNo': trade['TradeNo'] if trade else '',
+            'TradeAmt': trade['TradeAmt'] if trade else '0',
+            'TradeDate': trade['TradeDate'] if trade else '',
+            'PaymentType': 'Credit_CreditCard' if trade else '',
+            'TradeStatus': trade_status,
+        })
+        return 200, urlencode(result)
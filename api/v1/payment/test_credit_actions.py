@@ -0,0 +1,120 @@
+import threading
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlencode
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from api.v1.order import services as order_services
+from api.v1.order.models import Order, OrderVendor
+from api.v1.payment.credit_actions import RateLimiter, enqueue_credit_actions, run_credit_actions
+from api.v1.payment.ecpay_payment_sdk import ECPayPaymentSdk
+from api.v1.payment.models import CreditAction
+from api.v1.product.models import Product
+from api.v1.vendor.models import Vendor
+
+User = get_user_model()
+
+
+class _FakeDoAction(BaseHTTPRequestHandler):
+    """本機綠界替身：記錄收到的 DoAction，server.rejected 中的訂單回覆失敗"""
+
+    def do_POST(self):
+        params = dict(parse_qsl(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8')))
+        self.server.received.append((params['MerchantTradeNo'], params['Action'], params['TotalAmount']))
+        rejected = params['MerchantTradeNo'] in self.server.rejected
+        body = urlencode({
+            'MerchantID': params['MerchantID'],
+            'MerchantTradeNo': params['MerchantTradeNo'],
+            'TradeNo': params['TradeNo'],
+            'RtnCode': '10100001' if rejected else '1',
+            'RtnMsg': '此交易無法退刷' if rejected else 'Succeeded',
+        }).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class CreditActionRunnerTest(TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _FakeDoAction)
+        self.server.received = []
+        self.server.rejected = set()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.settings_override = override_settings(
+            ECPAY_PAYMENT_URL='http://127.0.0.1:%d' % self.server.server_address[1]
+        )
+        self.settings_override.enable()
+        self.sdk = ECPayPaymentSdk(MerchantID='3002607', HashKey='testkey', HashIV='testiv')
+        self.limiter = RateLimiter(1000)
+
+        user = User.objects.create_user(email='buyer@example.com', password='testpass123')
+        vendor = Vendor.objects.create(
+            user=User.objects.create_user(email='vendor@example.com', password='testpass123'), name='測試小農'
+        )
+        self.apple = Product.objects.create(vendor=vendor, name='蘋果', price=100, stock=10)
+        self.orders = []
+        for _ in range(3):
+            order, _ = order_services.create_order(user, [{'product_id': self.apple.id, 'quantity': 2}])
+            self.orders.append(order)
+        order_services.mark_orders_paid([order.merchant_trade_no for order in self.orders])
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _enqueue(self, amounts):
+        return enqueue_credit_actions('recall-01', [
+            (order.merchant_trade_no, f'T{order.pk}', CreditAction.ACTION_REFUND, amount)
+            for order, amount in zip(self.orders, amounts)
+        ])
+
+    def test_refunds_written_back_in_bulk(self):
+        """測試批次退刷：全額退款的訂單轉為 refunded，部分退款只累加退款金額"""
+        full, partial, rejected = self.orders
+        self.server.rejected = {rejected.merchant_trade_no}
+        self._enqueue([200, 50, 200])
+
+        result = run_credit_actions('recall-01', workers=3, chunk_size=2, sdk=self.sdk, limiter=self.limiter)
+
+        self.assertEqual(result, {'sent': 3, 'succeeded': 2, 'failed': 1, 'unknown': 0})
+        self.assertEqual(
+            {order.pk: (order.status, order.refunded_amount) for order in Order.objects.all()},
+            {
+                full.pk: (Order.STATUS_REFUNDED, 200),
+                partial.pk: (Order.STATUS_PAID, 50),
+                rejected.pk: (Order.STATUS_PAID, 0),
+            },
+        )
+        self.assertEqual(OrderVendor.objects.get(order=full).status, Order.STATUS_REFUNDED)
+        self.apple.refresh_from_db()
+        self.assertEqual(self.apple.sales_count, 4)  # 全額退款的 2 件扣回
+        self.assertEqual(
+            CreditAction.objects.get(merchant_trade_no=rejected.merchant_trade_no).rtn_msg, '此交易無法退刷'
+        )
+
+    def test_rerun_never_resends(self):
+        """測試重跑與重複匯入不會重複退款，中斷時停在 sending 的動作改為 unknown"""
+        self._enqueue([200, 200, 200])
+        interrupted = CreditAction.objects.get(merchant_trade_no=self.orders[0].merchant_trade_no)
+        CreditAction.objects.filter(pk=interrupted.pk).update(
+            status=CreditAction.STATUS_SENDING, sent_at=timezone.now() - timedelta(minutes=30)
+        )
+
+        run_credit_actions('recall-01', sdk=self.sdk, limiter=self.limiter)
+        self.assertEqual(self._enqueue([200, 200, 200]), 3)
+        result = run_credit_actions('recall-01', sdk=self.sdk, limiter=self.limiter)
+
+        self.assertEqual(result['sent'], 0)
+        self.assertEqual(
+            sorted(no for no, _, _ in self.server.received),
+            sorted(order.merchant_trade_no for order in self.orders[1:]),
+        )
+        interrupted.refresh_from_db()
+        self.assertEqual(interrupted.status, CreditAction.STATUS_UNKNOWN)
+        self.assertEqual(Order.objects.get(pk=self.orders[0].pk).status, Order.STATUS_PAID)
@@ -0,0 +1,118 @@
+import threading
+from unittest import mock
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlencode
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from api.v1.order import services as order_services
+from api.v1.order.models import Order, StockReservation
+from api.v1.payment.ecpay_payment_sdk import ECPayPaymentSdk, generate_check_mac_value
+from api.v1.payment.services import _query_trade, poll_pending_orders
+from api.v1.product.models import Product
+from api.v1.vendor.models import Vendor
+
+User = get_user_model()
+
+
+class _FakeQueryTradeInfo(BaseHTTPRequestHandler):
+    """本機綠界替身：依 server.statuses 回覆已簽章的 QueryTradeInfo 結果"""
+
+    def do_POST(self):
+        params = dict(parse_qsl(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8')))
+        self.server.queried.append(params['MerchantTradeNo'])
+        result = {
+            'MerchantID': params['MerchantID'],
+            'MerchantTradeNo': params['MerchantTradeNo'],
+            'TradeStatus': self.server.statuses.get(params['MerchantTradeNo'], '0'),
+        }
+        result['CheckMacValue'] = generate_check_mac_value(result, 'testkey', 'testiv')
+        body = urlencode(result).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class PollPendingOrdersTest(TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _FakeQueryTradeInfo)
+        self.server.queried = []
+        self.server.statuses = {}
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.settings_override = override_settings(
+            ECPAY_PAYMENT_URL='http://127.0.0.1:%d' % self.server.server_address[1]
+        )
+        self.settings_override.enable()
+        self.sdk = ECPayPaymentSdk(MerchantID='3002607', HashKey='testkey', HashIV='testiv')
+
+        user = User.objects.create_user(email='buyer@example.com', password='testpass123')
+        vendor = Vendor.objects.create(
+            user=User.objects.create_user(email='vendor@example.com', password='testpass123'), name='測試小農'
+        )
+        self.apple = Product.objects.create(vendor=vendor, name='蘋果', price=100, stock=10)
+        self.orders = []
+        for _ in range(3):
+            order, _ = order_services.create_order(user, [{'product_id': self.apple.id, 'quantity': 1}])
+            self.orders.append(order)
+        Order.objects.update(created_at=timezone.now() - timedelta(minutes=30))
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_results_applied_in_bulk(self):
+        """測試並行查詢後批次套用已付款 / 付款失敗"""
+        paid, failed, unpaid = self.orders
+        self.server.statuses = {paid.merchant_trade_no: '1', failed.merchant_trade_no: '10200095'}
+
+        result = poll_pending_orders(sdk=self.sdk, workers=3)
+
+        self.assertEqual(result, {'checked': 3, 'paid': 1, 'failed': 1, 'expired': 0})
+        self.assertEqual(
+            dict(Order.objects.values_list('pk', 'status')),
+            {paid.pk: Order.STATUS_PAID, failed.pk: Order.STATUS_FAILED, unpaid.pk: Order.STATUS_PENDING},
+        )
+        self.apple.refresh_from_db()
+        self.assertEqual(self.apple.sales_count, 1)
+        self.assertEqual(self.apple.stock, 8)  # 失敗訂單的保留已歸還
+        self.assertEqual(
+            StockReservation.objects.get(order_item__order=paid).status, StockReservation.STATUS_CONSUMED
+        )
+
+    def test_recently_checked_orders_skipped(self):
+        """測試重跑時略過最近查詢過的訂單，新建立的訂單不查詢"""
+        poll_pending_orders(sdk=self.sdk)
+        self.assertEqual(poll_pending_orders(sdk=self.sdk)['checked'], 0)
+        self.assertEqual(len(self.server.queried), 3)
+
+        Order.objects.update(payment_checked_at=timezone.now() - timedelta(minutes=20))
+        Order.objects.filter(pk=self.orders[0].pk).update(created_at=timezone.now())
+        self.assertEqual(poll_pending_orders(sdk=self.sdk)['checked'], 2)
+
+    def test_orders_past_deadline_marked_failed(self):
+        """測試超過付款期限仍未付款或查詢失敗的訂單標記為失敗，之後不再查詢"""
+        unpaid, unknown, paid = self.orders
+        Order.objects.update(created_at=timezone.now() - timedelta(days=10))
+        self.server.statuses = {paid.merchant_trade_no: '1'}
+
+        def query(sdk, merchant_trade_no):
+            if merchant_trade_no == unknown.merchant_trade_no:
+                return None  # 查詢失敗
+            return _query_trade(sdk, merchant_trade_no)
+
+        with mock.patch('api.v1.payment.services._query_trade', side_effect=query):
+            result = poll_pending_orders(sdk=self.sdk, deadline_minutes=8 * 24 * 60)
+
+        self.assertEqual(result, {'checked': 3, 'paid': 1, 'failed': 2, 'expired': 2})
+        self.assertEqual(
+            dict(Order.objects.values_list('pk', 'status')),
+            {unpaid.pk: Order.STATUS_FAILED, unknown.pk: Order.STATUS_FAILED, paid.pk: Order.STATUS_PAID},
+        )
+        Order.objects.update(payment_checked_at=None)
+        self.assertEqual(poll_pending_orders(sdk=self.sdk)['checked'], 0)
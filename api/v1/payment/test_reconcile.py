@@ -0,0 +1,57 @@
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from api.v1.order.models import Order
+from api.v1.payment.ecpay_payment_sdk import iter_text_lines
+from api.v1.payment.reconcile import AMOUNT_MISMATCH, MISSING_ORDER, NOT_PAID, iter_balance_rows, reconcile
+
+User = get_user_model()
+
+BALANCE_FILE = (
+    '查詢期間：2025-10-01 ~ 2025-10-31\r\n'
+    '交易日期,特店訂單編號,綠界訂單編號,交易金額,付款狀態\r\n'
+    '2025/10/01,="T0001",="2510010000001",250,已付款\r\n'
+    '2025/10/02,="T0002",="2510020000002",100,已付款\r\n'
+    '2025/10/03,="T0003",="2510030000003",120,已付款\r\n'
+    '2025/10/04,="T0004",="2510040000004",80,已付款\r\n'
+    '2025/10/05,="T0005",="2510050000005",60,未付款\r\n'
+    '\r\n'
+    '合計,,,610,\r\n'
+).encode('big5')
+
+
+class ReconcileTest(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(email='buyer@example.com', password='testpass123')
+        for trade_no, amount, status in [
+            ('T0001', 250, Order.STATUS_PAID),
+            ('T0002', 100, Order.STATUS_PENDING),
+            ('T0003', 150, Order.STATUS_PAID),
+            ('T0005', 60, Order.STATUS_PENDING),
+        ]:
+            Order.objects.create(user=user, merchant_trade_no=trade_no, total_amount=amount, status=status)
+
+    def _lines(self):
+        # 以很小的區塊切割，驗證跨區塊的中文字與換行
+        chunks = (BALANCE_FILE[i:i + 7] for i in range(0, len(BALANCE_FILE), 7))
+        return iter_text_lines(chunks, encoding='big5')
+
+    def test_parse_rows(self):
+        """測試逐段解碼並略過說明列、空白列與合計列"""
+        rows = list(iter_balance_rows(self._lines()))
+        self.assertEqual([row.merchant_trade_no for row in rows], ['T0001', 'T0002', 'T0003', 'T0004', 'T0005'])
+        self.assertEqual(rows[0].trade_no, '2510010000001')
+        self.assertTrue(rows[0].paid)
+        self.assertFalse(rows[4].paid)
+
+    def test_discrepancies(self):
+        """測試差異報表：綠界已付款但訂單未付款、金額不符、查無訂單"""
+        stats = {}
+        # 每 2 筆一個區塊：3 次訂單查詢，查不到的再查一次封存表
+        with self.assertNumQueries(4):
+            report = list(reconcile(iter_balance_rows(self._lines()), chunk_size=2, stats=stats))
+
+        self.assertEqual(
+            [(d.kind, d.merchant_trade_no) for d in report],
+            [(NOT_PAID, 'T0002'), (AMOUNT_MISMATCH, 'T0003'), (MISSING_ORDER, 'T0004')],
+        )
+        self.assertEqual(stats, {'rows': 5, 'paid': 4, 'discrepancies': 3})
@@ -0,0 +1,63 @@
+from django.test import SimpleTestCase
+from api.v1.payment.ecpay_payment_sdk import CreateOrder, ECPayPaymentSdk
+
+BASE_PARAMS = {
+    'MerchantTradeNo': '2510181230001ABCDE',
+    'MerchantTradeDate': '2025/10/18 12:30:00',
+    'PaymentType': 'aio',
+    'TotalAmount': 250,
+    'TradeDesc': '訂單付款',
+    'ItemName': '蘋果*2#梨子*1',
+    'ReturnURL': 'https://example.com/api/v1/payment/notify/',
+    'ChoosePayment': 'ALL',
+    'ClientBackURL': 'https://example.com/api/v1/order/result/?order_id=1',
+}
+
+
+def legacy_create_order(sdk, client_parameters, patterns):
+    """改寫前的流程：逐一 pattern 建立預設值、合併、檢查、過濾後簽章"""
+    default_parameters = {}
+    for pattern in patterns:
+        default_parameters = sdk.merge(default_parameters, sdk.create_default_dict(pattern))
+    return sdk.integrate_parameter(sdk.merge(default_parameters, client_parameters), list(patterns))
+
+
+class CompiledSchemaTest(SimpleTestCase):
+    def setUp(self):
+        self.sdk = ECPayPaymentSdk(MerchantID='3002607', HashKey='pwFHCqoQZGmho4w6', HashIV='EkRm7iFT261dpevs')
+
+    def test_create_order_matches_legacy(self):
+        """測試預先編譯的規格與逐一處理 pattern 的結果相同"""
+        cases = [
+            ({}, (None, False)),
+            ({'ChoosePayment': 'ATM', 'ExpireDate': 3}, (None, False)),
+            ({'ChoosePayment': 'CVS', 'Desc_1': '說明'}, (None, False)),
+            ({'ChoosePayment': 'Credit', 'CreditInstallment': '3,6'}, ('installment', False)),
+            ({'ChoosePayment': 'Credit', 'Redeem': 'Y'}, ('one_time', False)),
+            ({'ChoosePayment': 'WebATM', 'Remark': ''}, (None, False)),
+        ]
+        for extra, (credit_variant, invoice) in cases:
+            params = dict(BASE_PARAMS, **extra)
+            with self.subTest(params=params):
+                schema = CreateOrder.compile_schema(params['ChoosePayment'], credit_variant, invoice)
+                self.assertEqual(
+                    self.sdk.create_order(dict(params)),
+                    legacy_create_order(self.sdk, dict(params), schema.patterns),
+                )
+
+    def test_validation_errors_unchanged(self):
+        """測試必填與長度檢查的錯誤訊息不變"""
+        with self.assertRaisesMessage(Exception, 'ItemName content is required.'):
+            self.sdk.create_order(dict(BASE_PARAMS, ItemName=''))
+        with self.assertRaisesMessage(Exception, 'TradeDesc max langth is 200.'):
+            self.sdk.create_order(dict(BASE_PARAMS, TradeDesc='x' * 201))
+
+    def test_sdk_keeps_no_call_state(self):
+        """測試呼叫後不在實例上保存參數，可跨請求共用"""
+        self.sdk.create_order(dict(BASE_PARAMS))
+        self.assertFalse(hasattr(self.sdk, 'final_merge_parameters'))
+
+    def test_html_form_escapes_values(self):
+        """測試表單欄位值經過跳脫"""
+        html = self.sdk.gen_html_post_form('https://example.com/', {'ItemName': '"特價" <茶>'})
+        self.assertIn('value="&quot;特價&quot; &lt;茶&gt;"', html)
@@ -0,0 +1,105 @@
+import collections
+import copy
+import hashlib
+from decimal import Decimal
+from urllib.parse import quote_plus
+from django.test import SimpleTestCase
+from api.v1.payment.ecpay_payment_sdk import (
+    CheckMacValueSigner, ECPayPaymentSdk, generate_check_mac_value, verify_check_mac_value,
+)
+
+HASH_KEY = 'pwFHCqoQZGmho4w6'
+HASH_IV = 'EkRm7iFT261dpevs'
+KNOWN_VECTOR = 'A2CA1184D5827C49C033606BD9A0B4D40A3AA506D6358A4E73E1A4908C0C5FC6'
+
+
+def legacy_generate_check_value(params, merchant_id, hash_key, hash_iv):
+    """改寫前 BasePayment.generate_check_value 的實作，作為黃金比對基準"""
+    _params = copy.deepcopy(params)
+    if _params.get('CheckMacValue'):
+        _params.pop('CheckMacValue')
+    encrypt_type = int(_params.get('EncryptType', 1))
+    _params.update({'MerchantID': merchant_id})
+    ordered_params = collections.OrderedDict(sorted(_params.items(), key=lambda k: k[0].lower()))
+    encoding_str = 'HashKey=%s&' % hash_key + ''.join(
+        ['{}={}&'.format(key, value) for key, value in ordered_params.items()]) + 'HashIV=%s' % hash_iv
+    encoding_str = quote_plus(str(encoding_str), safe='-_.!*()').lower()
+    if encrypt_type == 1:
+        return hashlib.sha256(encoding_str.encode('utf-8')).hexdigest().upper()
+    if encrypt_type == 0:
+        return hashlib.md5(encoding_str.encode('utf-8')).hexdigest().upper()
+    return ''
+
+
+def legacy_generate_check_mac_value(params, hash_key, hash_iv):
+    """改寫前模組層級 generate_check_mac_value 的實作"""
+    joined = "&".join(f"{k}={v}" for k, v in sorted(params.items(), key=lambda k: k[0].lower()))
+    raw = f"HashKey={hash_key}&{joined}&HashIV={hash_iv}"
+    encoded = quote_plus(raw, safe='-_.!*()').lower()
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest().upper()
+
+
+CASES = [
+    {
+        'MerchantID': '3002607',
+        'MerchantTradeNo': '2510181230001234ABCDE',
+        'MerchantTradeDate': '2025/10/18 12:30:00',
+        'PaymentType': 'aio',
+        'TotalAmount': 1250,
+        'TradeDesc': '訂單付款',
+        'ItemName': '有機蘋果*2#高山茶 (150g)*1#A&B~C*3',
+        'ReturnURL': 'https://example.com/api/v1/payment/notify/?a=1&b= 2',
+        'ChoosePayment': 'ALL',
+        'EncryptType': 1,
+    },
+    {'MerchantID': '3002607', 'MerchantTradeNo': 'X1', 'TimeStamp': 1700000000, 'EncryptType': 0},
+    {'MerchantID': '9999999', 'RtnCode': '1', 'RtnMsg': 'Succeeded', 'TradeAmt': Decimal('100'),
+     'CheckMacValue': 'ABCDEF', 'CustomField1': '', 'Remark': "!*()'_-.~"},
+    {'merchantTradeNo': 'lower', 'ITEMNAME': 'upper', 'CheckMacValue': '', 'Note': '中文 + 空白'},
+    {'MerchantTradeNo': 'no-merchant', 'EncryptType': '2'},
+]
+
+
+class CheckMacValueSignerGoldenTest(SimpleTestCase):
+    def test_sdk_output_identical_to_legacy(self):
+        """測試 SDK 簽章與改寫前實作逐位元組相同"""
+        sdk = ECPayPaymentSdk(MerchantID='3002607', HashKey=HASH_KEY, HashIV=HASH_IV)
+        for params in CASES:
+            with self.subTest(params=params):
+                before = copy.deepcopy(params)
+                self.assertEqual(
+                    sdk.generate_check_value(params),
+                    legacy_generate_check_value(params, '3002607', HASH_KEY, HASH_IV),
+                )
+                self.assertEqual(params, before)
+
+    def test_module_functions_identical_to_legacy(self):
+        """測試模組層級簽章與改寫前實作相同"""
+        for params in CASES:
+            params = {k: v for k, v in params.items() if k != 'CheckMacValue'}
+            with self.subTest(params=params):
+                self.assertEqual(
+                    generate_check_mac_value(params, HASH_KEY, HASH_IV),
+                    legacy_generate_check_mac_value(params, HASH_KEY, HASH_IV),
+                )
+
+    def test_known_vector(self):
+        """測試固定向量，避免參考實作與新實作一起被改壞"""
+        self.assertEqual(
+            generate_check_mac_value({'MerchantID': '3002607', 'RtnCode': '1'}, HASH_KEY, HASH_IV),
+            KNOWN_VECTOR,
+        )
+
+    def test_verify(self):
+        """測試驗證與批次驗證"""
+        params = {'MerchantTradeNo': 'T1', 'RtnCode': '1'}
+        signed = dict(params, CheckMacValue=generate_check_mac_value(params, HASH_KEY, HASH_IV).lower())
+        tampered = dict(signed, RtnCode='0')
+
+        self.assertTrue(verify_check_mac_value(signed, HASH_KEY, HASH_IV))
+        self.assertFalse(verify_check_mac_value(tampered, HASH_KEY, HASH_IV))
+        self.assertFalse(verify_check_mac_value(params, HASH_KEY, HASH_IV))
+        self.assertEqual(
+            CheckMacValueSigner(HASH_KEY, HASH_IV).verify_many([signed, tampered, params], encrypt_type=1),
+            [True, False, False],
+        )
@@ -0,0 +1,89 @@
+import time
+from datetime import timedelta
+import requests
+from django.contrib.auth import get_user_model
+from django.test import LiveServerTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from api.v1.order import services as order_services
+from api.v1.order.models import Order
+from api.v1.payment.models import PaymentEvent
+from api.v1.payment.services import poll_pending_orders, process_payment_events
+from api.v1.payment.simulator import ECPaySimulator, parse_post_form
+from api.v1.product.models import Product
+from api.v1.vendor.models import Vendor
+
+User = get_user_model()
+
+
+class ECPaySimulatorTest(LiveServerTestCase):
+    """以模擬器跑完整的結帳 → 付款通知 → 訂單已付款流程"""
+
+    def setUp(self):
+        user = User.objects.create_user(email='buyer@example.com', password='testpass123')
+        vendor = Vendor.objects.create(
+            user=User.objects.create_user(email='vendor@example.com', password='testpass123'), name='測試小農'
+        )
+        self.apple = Product.objects.create(vendor=vendor, name='蘋果', price=100, stock=10)
+        self.order, _ = order_services.create_order(user, [{'product_id': self.apple.id, 'quantity': 1}])
+
+    def _simulator(self, **kwargs):
+        simulator = ECPaySimulator('3002607', 'testkey', 'testiv', seed=1, **kwargs).start()
+        self.addCleanup(simulator.stop)
+        settings_override = override_settings(
+            MERCHANT_ID='3002607', HASH_KEY='testkey', HASH_IV='testiv', ECPAY_PAYMENT_URL=simulator.url
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        return simulator
+
+    def _checkout_form(self):
+        response = requests.get(
+            self.live_server_url + reverse('api.v1.payment:ecpay_checkout', args=[self.order.pk]), timeout=10
+        )
+        return parse_post_form(response.text)
+
+    def _wait_for_events(self, count):
+        deadline = time.monotonic() + 10
+        while PaymentEvent.objects.count() < count and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(PaymentEvent.objects.count(), count)
+
+    def test_checkout_to_paid_with_duplicate_notify(self):
+        """測試重送的付款通知只讓訂單轉為已付款一次"""
+        self._simulator(duplicate_ratio=1.0)
+        action, fields = self._checkout_form()
+        self.assertEqual(requests.post(action, data=fields, timeout=10).status_code, 200)
+
+        self._wait_for_events(3)  # notify ×2 + OrderResult
+        process_payment_events()
+
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, Order.STATUS_PAID)
+        self.apple.refresh_from_db()
+        self.assertEqual(self.apple.sales_count, 1)
+
+    def test_tampered_form_rejected(self):
+        """測試 CheckMacValue 不符的結帳表單被拒絕且不送出回呼"""
+        simulator = self._simulator()
+        action, fields = self._checkout_form()
+        fields['TotalAmount'] = '1'
+
+        self.assertEqual(requests.post(action, data=fields, timeout=10).status_code, 400)
+        self.assertEqual(simulator.stats['rejected'], 1)
+        self.assertEqual(simulator.trades, {})
+
+    def test_query_trade_info(self):
+        """測試付款失敗時主動查詢也能取得結果"""
+        simulator = self._simulator(failure_ratio=1.0, delay=0.2)
+        action, fields = self._checkout_form()
+        requests.post(action, data=fields, timeout=10)
+        Order.objects.update(created_at=timezone.now() - timedelta(minutes=30))
+
+        self.assertEqual(poll_pending_orders()['failed'], 0)  # 回呼送出前仍是未付款
+        self._wait_for_events(2)
+        self.assertTrue(simulator.trades[self.order.merchant_trade_no]['completed'])
+        Order.objects.update(payment_checked_at=None)
+
+        self.assertEqual(poll_pending_orders()['failed'], 1)
+        self.assertEqual(Order.objects.get(pk=self.order.pk).status, Order.STATUS_FAILED)
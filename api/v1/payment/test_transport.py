@@ -0,0 +1,105 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+import requests
+from django.test import SimpleTestCase
+from api.v1.payment.ecpay_payment_sdk import ECPayPaymentSdk
+from api.v1.payment.transport import EndpointPolicy, Transport
+
+
+class _StandIn(BaseHTTPRequestHandler):
+    """本機綠界替身：依 server.plan 決定每次請求的回應"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with server.lock:
+            server.calls += 1
+            server.ports.add(self.client_address[1])
+            server.active += 1
+            server.peak = max(server.peak, server.active)
+            status, delay, body = server.plan[min(server.calls, len(server.plan)) - 1]
+        time.sleep(delay)
+        with server.lock:
+            server.active -= 1
+        payload = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+class TransportTest(SimpleTestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _StandIn)
+        self.server.lock = threading.Lock()
+        self.server.calls = self.server.active = self.server.peak = 0
+        self.server.ports = set()
+        self.server.plan = [(200, 0, 'RtnCode=1')]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+        self.transport = Transport(retries=2, backoff=0.01, policies={
+            'slow': EndpointPolicy(timeout=(1, 0.2), idempotent=True),
+        })
+
+    def tearDown(self):
+        self.transport.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connection_reused(self):
+        """測試連續請求共用 keep-alive 連線"""
+        for _ in range(3):
+            self.assertEqual(self.transport.post(self.url, {'a': 1}, endpoint='order_search').text, 'RtnCode=1')
+        self.assertEqual(len(self.server.ports), 1)
+
+    def test_idempotent_endpoint_retries_5xx(self):
+        """測試查詢類端點遇到 5xx 會重試"""
+        self.server.plan = [(503, 0, ''), (200, 0, 'ok')]
+        self.assertEqual(self.transport.post(self.url, {}, endpoint='order_search').text, 'ok')
+        self.assertEqual(self.server.calls, 2)
+
+    def test_credit_action_not_retried(self):
+        """測試請退款不重送"""
+        self.server.plan = [(503, 0, ''), (200, 0, 'ok')]
+        self.assertEqual(self.transport.post(self.url, {}, endpoint='credit_do_action').status_code, 503)
+        self.assertEqual(self.server.calls, 1)
+
+    def test_read_timeout_is_bounded(self):
+        """測試卡住的連線在逾時後放棄，不會無限等待"""
+        self.server.plan = [(200, 1, 'late')]
+        started = time.monotonic()
+        with self.assertRaises(requests.exceptions.ReadTimeout):
+            self.transport.post(self.url, {}, endpoint='slow')
+        self.assertEqual(self.server.calls, 3)
+        self.assertLess(time.monotonic() - started, 2)
+
+    def test_concurrency_limited(self):
+        """測試同時進行的請求數不超過上限"""
+        transport = Transport(max_concurrency=2)
+        self.server.plan = [(200, 0.1, 'ok')]
+        threads = [
+            threading.Thread(target=transport.post, args=(self.url, {}), kwargs={'endpoint': 'order_search'})
+            for _ in range(6)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        transport.close()
+        self.assertEqual(self.server.calls, 6)
+        self.assertLessEqual(self.server.peak, 2)
+
+    def test_sdk_uses_transport(self):
+        """測試 SDK 後台呼叫經由 Transport 並帶上端點名稱"""
+        sdk = ECPayPaymentSdk(MerchantID='3002607', HashKey='k', HashIV='v', transport=self.transport)
+        with mock.patch.object(self.transport, 'post', wraps=self.transport.post) as post:
+            sdk.credit_do_action(action_url=self.url, client_parameters={
+                'MerchantTradeNo': 'T1', 'TradeNo': '2510180000001', 'Action': 'R', 'TotalAmount': 100,
+            })
+        self.assertEqual(post.call_args.kwargs['endpoint'], 'credit_do_action')
@@ -0,0 +1,95 @@
+# coding: utf-8
+"""
+綠界後台 API（查詢、請退款、對帳檔下載）的 HTTP 傳輸層。
+
+共用一個 requests.Session（keep-alive 連線池），每個端點有自己的逾時與重試策略，
+並以 semaphore 限制同時進行的請求數，避免單一卡住的連線拖住整個 worker。
+"""
+import random
+import threading
+import time
+from collections import namedtuple
+import requests
+from requests.adapters import HTTPAdapter
+
+# timeout 為 (連線逾時, 讀取逾時) 秒數；idempotent 的端點才會在讀取逾時或 5xx 時重試
+EndpointPolicy = namedtuple('EndpointPolicy', ['timeout', 'idempotent'])
+
+DEFAULT_POLICY = EndpointPolicy(timeout=(3.05, 15), idempotent=False)
+ENDPOINT_POLICIES = {
+    'order_search': EndpointPolicy(timeout=(3.05, 10), idempotent=True),
+    'order_search_period': EndpointPolicy(timeout=(3.05, 10), idempotent=True),
+    'search_single_transaction': EndpointPolicy(timeout=(3.05, 10), idempotent=True),
+    # 請款 / 退款不可重送，只在連線未建立時重試
+    'credit_do_action': EndpointPolicy(timeout=(3.05, 20), idempotent=False),
+    # 對帳檔可能很大，讀取逾時較長
+    'download_merchant_balance': EndpointPolicy(timeout=(3.05, 120), idempotent=True),
+    'download_disbursement_balance': EndpointPolicy(timeout=(3.05, 120), idempotent=True),
+}
+
+RETRY_STATUSES = frozenset([500, 502, 503, 504])
+
+
+class Transport(object):
+
+    def __init__(self, pool_size=10, max_concurrency=10, retries=2, backoff=0.5, policies=None):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.retries = retries
+        self.backoff = backoff
+        self.policies = dict(ENDPOINT_POLICIES, **(policies or {}))
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+
+    def policy(self, endpoint):
+        return self.policies.get(endpoint, DEFAULT_POLICY)
+
+    def _sleep(self, attempt):
+        # 指數退避加上隨機抖動，避免多個 worker 同時重試
+        time.sleep(self.backoff * (2 ** attempt) + random.uniform(0, self.backoff))
+
+    def post(self, url, data, endpoint=None, stream=False):
+        """
+        以共用連線池送出 POST。
+
+        連線逾時（請求尚未送出）一律重試；讀取逾時、連線中斷與 5xx 只有 idempotent 端點才重試。
+        重試用盡時拋出最後的例外，或回傳最後一次的回應。
+        stream=True 時只在取得回應標頭前受併發上限約束，內容由呼叫端逐段讀取。
+        """
+        policy = self.policy(endpoint)
+        attempt = 0
+        while True:
+            try:
+                with self._slots:
+                    response = self.session.post(url, data=data, timeout=policy.timeout, stream=stream)
+            except requests.exceptions.ConnectTimeout:
+                if attempt >= self.retries:
+                    raise
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+                if not policy.idempotent or attempt >= self.retries:
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUSES or not policy.idempotent \
+                        or attempt >= self.retries:
+                    return response
+                response.close()
+            self._sleep(attempt)
+            attempt += 1
+
+    def close(self):
+        self.session.close()
+
+
+_default_transport = None
+_default_lock = threading.Lock()
+
+
+def get_transport():
+    """取得全程序共用的 Transport"""
+    global _default_transport
+    if _default_transport is None:
+        with _default_lock:
+            if _default_transport is None:
+                _default_transport = Transport()
+    return _default_transport
@@ -1,8 +1,12 @@
 from django.conf import settings
 from django.shortcuts import get_object_or_404, redirect
 from django.http import HttpResponse, JsonResponse, HttpResponseBadRequest, HttpResponseServerError
-from .ecpay_payment_sdk import ECPayPaymentSdk, verify_check_mac_value
+from .ecpay_payment_sdk import verify_check_mac_value
 from api.v1.order.models import Order
+from api.v1.order.services import renew_order_reservations
+from django.db import DatabaseError
+from .models import PaymentEvent
+from .services import ecpay_url, get_payment_sdk, record_payment_event
 from django.views.decorators.csrf import csrf_exempt
 from decimal import Decimal, ROUND_HALF_UP
 import logging
@@ -15,13 +19,13 @@ logger = logging.getLogger(__name__)
 def ecpay_checkout(request, order_id):
     order = get_object_or_404(Order, id=order_id)
 
-    item_names = "#".join([f"{item.product.name}*{item.quantity}" for item in order.items.all()])
+    if order.status != Order.STATUS_PENDING:
+        return HttpResponseBadRequest("此訂單無法付款。")
+    # 保留逾期已釋放庫存時需重新保留，庫存不足就不送去付款，避免超賣
+    if not renew_order_reservations(order):
+        return HttpResponse("商品庫存不足，此訂單已無法付款，請重新下單。", status=409)
 
-    ecpay_payment_sdk = ECPayPaymentSdk(
-        MerchantID=str(settings.MERCHANT_ID),
-        HashKey=str(settings.HASH_KEY),
-        HashIV=str(settings.HASH_IV),
-    )
+    ecpay_payment_sdk = get_payment_sdk()
 
     total_amount = int(Decimal(order.total_amount).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
 
@@ -35,7 +39,7 @@ def ecpay_checkout(request, order_id):
         'PaymentType': 'aio',
         'TotalAmount': total_amount,
         'TradeDesc': '訂單付款',
-        'ItemName': item_names,
+        'ItemName': order.get_item_name(),  # 建單時已預先組好
         'ReturnURL': return_url,
         'ChoosePayment': 'ALL',
         'ClientBackURL': client_back_url,
@@ -45,10 +49,7 @@ def ecpay_checkout(request, order_id):
     try:
         final_order_params = ecpay_payment_sdk.create_order(order_params)
 
-        if settings.DEBUG:
-            action_url = 'https://payment-stage.ecpay.com.tw/Cashier/AioCheckOut/V5' # 測試環境
-        else:
-            action_url = 'https://payment.ecpay.com.tw/Cashier/AioCheckOut/V5' # 正式環境
+        action_url = ecpay_url('/Cashier/AioCheckOut/V5')  # DEBUG 時為測試環境
         
         html = ecpay_payment_sdk.gen_html_post_form(action_url, final_order_params)
         return HttpResponse(html)
@@ -63,37 +64,24 @@ def ecpay_notify_url(request):
         return HttpResponseBadRequest("Only POST")
 
     data = request.POST.dict()
-    logger.info("ECPay notify received: %s", data)
+    logger.debug("ECPay notify received: %s", data)
 
     # 1. 驗證檢查碼
     if not verify_check_mac_value(data, settings.HASH_KEY, settings.HASH_IV):
         logger.warning("ECPay notify: checkmac validation failed.")
         return HttpResponse("CheckMacValue error", status=400)
 
-    # 2. 取得欄位（範例欄位名，依綠界定義）
-    merchant_trade_no = data.get("MerchantTradeNo")
-    rtn_code = data.get("RtnCode")  # 1 代表交易成功
-    rtn_msg = data.get("RtnMsg")
-
-    # 3. 找到訂單並更新狀態
+    # 2. 寫入收件匣後立即回覆，訂單狀態由 process_payment_events worker 套用
     try:
-        order = get_object_or_404(Order, merchant_trade_no=merchant_trade_no)
-    except Exception:
-        logger.exception("ECPay notify: 訂單找不到 MerchantTradeNo=%s", merchant_trade_no)
-        return HttpResponse("Order not found", status=404)
+        record_payment_event(PaymentEvent.KIND_NOTIFY, data)
+    except DatabaseError:
+        # 未成功寫入時不回覆 1|OK，讓綠界稍後重送，避免遺失付款通知
+        logger.exception("ECPay notify: cannot store MerchantTradeNo=%s", data.get("MerchantTradeNo"))
+        return HttpResponse("0|Error", status=500)
 
-    # 你需要根據 rtn_code 更新：成功->已付款、失敗->付款失敗 等
-    if rtn_code == "1":  # 請確認官方文件的成功判斷值
-        order.status = Order.STATUS_PAID
-        order.paid_at = timezone.now()
-        order.save()
-        logger.info("Order %s marked as paid via ECPay", order.id)
-        return HttpResponse("1|OK")
-    else:
-        order.status = Order.STATUS_FAILED
-        order.save()
-        logger.info("Order %s payment failed: %s", order.id, rtn_msg)
-        return HttpResponse("0|Fail", status=200)
+    logger.info("ECPay notify stored: MerchantTradeNo=%s RtnCode=%s",
+                data.get("MerchantTradeNo"), data.get("RtnCode"))
+    return HttpResponse("1|OK")
 
 @csrf_exempt
 def ecpay_order_result(request):
@@ -108,12 +96,15 @@ def ecpay_order_result(request):
     merchant_trade_no = data.get("MerchantTradeNo")
 
     try:
-        order = get_object_or_404(Order, merchant_trade_no=merchant_trade_no)
-    except Exception:
-        logger.exception("ECPay notify: 訂單找不到 MerchantTradeNo=%s", merchant_trade_no)
+        record_payment_event(PaymentEvent.KIND_ORDER_RESULT, data)
+    except DatabaseError:
+        # 付款結果仍會由 notify 送達，頁面照常顯示
+        logger.exception("ECPay order result: cannot store MerchantTradeNo=%s", merchant_trade_no)
+
+    order_id = Order.objects.filter(merchant_trade_no=merchant_trade_no).values_list("id", flat=True).first()
+    if order_id is None:
+        logger.warning("ECPay order result: 訂單找不到 MerchantTradeNo=%s", merchant_trade_no)
         return HttpResponse("Order not found", status=404)
-
-    order_id = order.id
     rtn_code = data.get("RtnCode")
     rtn_msg = data.get("RtnMsg", "交易結果未知")
 
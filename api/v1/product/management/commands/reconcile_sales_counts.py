@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from api.v1.product.models import Product
+
+
+class Command(BaseCommand):
+    help = '以已付款訂單重新計算所有商品的銷售數量'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='僅顯示有偏差的商品，不實際寫入',
+        )
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+
+        if dry_run:
+            self.stdout.write(self.style.WARNING('這是預覽模式，不會實際更改數據庫'))
+
+        changes = Product.recalculate_sales_counts(dry_run=dry_run)
+
+        for product, old_count, new_count in changes:
+            self.stdout.write(f'商品: {product.name} (#{product.pk})  {old_count} -> {new_count}')
+
+        if not changes:
+            self.stdout.write(self.style.SUCCESS('所有商品銷售數量皆正確'))
+        elif dry_run:
+            self.stdout.write(self.style.WARNING(f'共 {len(changes)} 個商品需要修正'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'成功修正了 {len(changes)} 個商品的銷售數量'))
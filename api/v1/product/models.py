@@ -1,5 +1,7 @@
+from collections import defaultdict
 from django.db import models
-from django.db.models import Sum
+from django.db.models import Case, F, IntegerField, Sum, Value, When
+from django.db.models.functions import Greatest
 from api.v1.vendor.models import Vendor
 from wagtail.images.models import Image
 
@@ -32,18 +34,71 @@ class Product(models.Model):
 
     @property
     def total_sales(self):
-        """計算總銷售量 - 只計算已付款的訂單"""
-        from api.v1.order.models import OrderItem, Order
-        return OrderItem.objects.filter(
+        """計算總銷售量 - 只計算已付款的訂單（含已封存訂單）"""
+        from api.v1.order.models import ArchivedOrderItem, OrderItem, Order
+        hot = OrderItem.objects.filter(
             product=self,
             order__status=Order.STATUS_PAID  # 只計算已付款的訂單
         ).aggregate(total=Sum('quantity'))['total'] or 0
+        archived = ArchivedOrderItem.objects.filter(
+            product=self,
+            order__status=Order.STATUS_PAID
+        ).aggregate(total=Sum('quantity'))['total'] or 0
+        return hot + archived
 
     def update_sales_count(self):
         """更新銷售數量 - 只計算已付款的訂單"""
         self.sales_count = self.total_sales
         self.save(update_fields=['sales_count'])
 
+    @classmethod
+    def apply_sales_delta(cls, quantities):
+        """
+        依 {product_id: 增減數量} 一次更新多個商品的銷售數量（單一 UPDATE）
+        """
+        quantities = {pk: qty for pk, qty in quantities.items() if qty}
+        if not quantities:
+            return
+        delta = Case(
+            *[When(pk=pk, then=Value(qty)) for pk, qty in quantities.items()],
+            default=Value(0),
+            output_field=IntegerField(),
+        )
+        cls.objects.filter(pk__in=list(quantities)).update(
+            sales_count=Greatest(F('sales_count') + delta, Value(0))
+        )
+
+    @classmethod
+    def recalculate_sales_counts(cls, dry_run=False, batch_size=500):
+        """
+        以單一分組查詢重新計算所有商品的銷售數量，只寫回有偏差的商品。
+        回傳 [(product, 舊數量, 新數量), ...]
+        """
+        from api.v1.order.models import ArchivedOrderItem, OrderItem, Order
+        totals = defaultdict(int)
+        for model in (OrderItem, ArchivedOrderItem):
+            rows = (
+                model.objects.filter(order__status=Order.STATUS_PAID)
+                .values_list('product_id')
+                .annotate(total=Sum('quantity'))
+                .order_by()
+            )
+            for product_id, total in rows:
+                totals[product_id] += total
+
+        drifted = []
+        changes = []
+        for product in cls.objects.only('pk', 'name', 'sales_count').order_by('pk').iterator(chunk_size=2000):
+            expected = totals.get(product.pk, 0)
+            if product.sales_count != expected:
+                changes.append((product, product.sales_count, expected))
+                product.sales_count = expected
+                drifted.append(product)
+
+        if drifted and not dry_run:
+            cls.objects.bulk_update(drifted, ['sales_count'], batch_size=batch_size)
+        return changes
+
     @property
     def is_in_stock(self):
         """檢查是否有庫存"""
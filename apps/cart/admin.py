@@ -7,7 +7,8 @@ class CartAdmin(admin.ModelAdmin):
     list_display = ('user', 'total_items', 'total_price', 'created_at', 'updated_at')
     list_filter = ('created_at', 'updated_at')
     search_fields = ('user__email', 'user__username')
-    readonly_fields = ('created_at', 'updated_at')
+    readonly_fields = ('item_count', 'subtotal', 'created_at', 'updated_at')
+    actions = ('recalculate_totals',)
     
     def total_items(self, obj):
         return obj.total_items
@@ -17,6 +18,11 @@ class CartAdmin(admin.ModelAdmin):
         return f"NT$ {obj.total_price:,.0f}"
     total_price.short_description = '總價格'
 
+    @admin.action(description='重新計算商品總數與小計')
+    def recalculate_totals(self, request, queryset):
+        count = Cart.recalculate_totals(queryset)
+        self.message_user(request, f'已重新計算 {count} 個購物車')
+
 
 @admin.register(CartItem)
 class CartItemAdmin(admin.ModelAdmin):
@@ -25,6 +31,20 @@ class CartItemAdmin(admin.ModelAdmin):
     search_fields = ('cart__user__email', 'product__name')
     readonly_fields = ('created_at', 'updated_at', 'total_price_display')
     
+    # 後台直接修改明細時，重新彙總該購物車的計數欄位
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        Cart.recalculate_totals(Cart.objects.filter(pk=obj.cart_id))
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        Cart.recalculate_totals(Cart.objects.filter(pk=obj.cart_id))
+
+    def delete_queryset(self, request, queryset):
+        cart_ids = list(queryset.values_list('cart_id', flat=True).distinct())
+        super().delete_queryset(request, queryset)
+        Cart.recalculate_totals(Cart.objects.filter(pk__in=cart_ids))
+
     def cart_user(self, obj):
         return obj.cart.user.email
     cart_user.short_description = '用戶'
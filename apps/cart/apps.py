@@ -5,3 +5,6 @@ class CartConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'apps.cart'
     verbose_name = '購物車'
+
+    def ready(self):
+        import apps.cart.signals
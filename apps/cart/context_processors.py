@@ -0,0 +1,13 @@
+from django.utils.functional import SimpleLazyObject
+from .models import SessionCart, get_cart_state
+
+
+def _cart_count(request):
+    if request.user.is_authenticated:
+        return get_cart_state(request.user.pk)[2]
+    return SessionCart(request).get_total_items()
+
+
+def cart(request):
+    """頁面直接嵌入購物車數量（只有模板用到時才讀取），不需再呼叫 cart_count"""
+    return {'cart_count': SimpleLazyObject(lambda: _cart_count(request))}
@@ -1,38 +1,61 @@
 from django.core.management.base import BaseCommand
-from django.utils import timezone
-from datetime import timedelta
-from apps.cart.models import Cart
+from apps.cart.retention import purge_carts
 
 
 class Command(BaseCommand):
-    help = '清理超過指定天數的空購物車'
+    help = '分批清理過期的空購物車、久未更新的購物車商品與已過期的 session（未登入購物車）'
 
     def add_arguments(self, parser):
         parser.add_argument(
             '--days',
             type=int,
-            default=30,
-            help='清理超過多少天的空購物車（默認 30 天）'
+            help='清理超過多少天的空購物車（默認 CART_RETENTION_DAYS）'
+        )
+        parser.add_argument(
+            '--item-days',
+            type=int,
+            help='清理超過多少天未更新的購物車商品（默認 CART_ITEM_RETENTION_DAYS）'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='每批刪除的筆數（默認 500）'
+        )
+        parser.add_argument(
+            '--sleep',
+            type=float,
+            default=0.1,
+            help='每批之間暫停的秒數，讓結帳等寫入優先（默認 0.1）'
+        )
+        parser.add_argument(
+            '--skip-sessions',
+            action='store_true',
+            help='不清理已過期的 session'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='只列出符合條件的筆數，不實際刪除'
         )
 
     def handle(self, *args, **options):
-        days = options['days']
-        cutoff_date = timezone.now() - timedelta(days=days)
-        
-        # 查找空的且超過指定天數的購物車
-        empty_carts = Cart.objects.filter(
-            updated_at__lt=cutoff_date,
-            items__isnull=True
-        ).distinct()
-        
-        count = empty_carts.count()
-        
-        if count > 0:
-            empty_carts.delete()
-            self.stdout.write(
-                self.style.SUCCESS(f'成功清理了 {count} 個空購物車')
-            )
+        result = purge_carts(
+            days=options['days'],
+            item_days=options['item_days'],
+            batch_size=options['batch_size'],
+            sleep=options['sleep'],
+            dry_run=options['dry_run'],
+            sessions=not options['skip_sessions'],
+        )
+
+        summary = (
+            f"{result['carts']} 個空購物車、{result['cart_items']} 筆購物車商品、"
+            f"{result['sessions']} 個過期 session"
+        )
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING(f'[dry-run] 將清理 {summary}'))
+        elif any(result.values()):
+            self.stdout.write(self.style.SUCCESS(f'成功清理了 {summary}'))
         else:
-            self.stdout.write(
-                self.style.WARNING('沒有找到需要清理的空購物車')
-            )
+            self.stdout.write(self.style.WARNING('沒有找到需要清理的購物車資料'))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from apps.cart.models import Cart
+
+
+class Command(BaseCommand):
+    help = '由購物車明細重新彙總每個購物車的商品總數與小計（修復計數欄位用）'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user',
+            help='只修復指定 email 用戶的購物車'
+        )
+
+    def handle(self, *args, **options):
+        carts = Cart.objects.all()
+        if options['user']:
+            carts = carts.filter(user__email=options['user'])
+        count = Cart.recalculate_totals(carts)
+        self.stdout.write(self.style.SUCCESS(f'已重新計算 {count} 個購物車的總數'))
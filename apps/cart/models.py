@@ -1,9 +1,18 @@
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
 from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
 from api.v1.product.models import Product
+from .storage import get_cart_storage
 from decimal import Decimal
 
 
+class CartOperationError(ValueError):
+    """購物車批次操作無效（整批不套用）"""
+
+
 class Cart(models.Model):
     """購物車模型"""
     user = models.OneToOneField(
@@ -12,12 +21,21 @@ class Cart(models.Model):
         related_name='cart',
         verbose_name='用戶'
     )
+    # 由 add_item / update_item_quantity / remove_item / clear 在同一交易內維護，讀取總數不需掃描明細
+    item_count = models.PositiveIntegerField('商品總數', default=0)
+    subtotal = models.DecimalField('小計', max_digits=12, decimal_places=2, default=0)
+    # 每次異動遞增，作為 cart_count 快取與 ETag 的版本
+    version = models.PositiveBigIntegerField('版本', default=0)
     created_at = models.DateTimeField('創建時間', auto_now_add=True)
     updated_at = models.DateTimeField('更新時間', auto_now=True)
 
     class Meta:
         verbose_name = '購物車'
         verbose_name_plural = '購物車'
+        indexes = [
+            # 清理過期購物車時依最後更新時間掃描
+            models.Index(fields=['updated_at'], name='cart_updated_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user.email} 的購物車"
@@ -25,55 +43,214 @@ class Cart(models.Model):
     @property
     def total_items(self):
         """購物車商品總數量"""
-        return sum(item.quantity for item in self.items.all())
+        return self.item_count
 
     @property
     def total_price(self):
         """購物車總價格"""
-        return sum(item.total_price for item in self.items.all())
+        return self.subtotal
 
     @property
     def is_empty(self):
         """檢查購物車是否為空"""
-        return not self.items.exists()
+        return self.item_count == 0
+
+    def _apply_delta(self, quantity, amount):
+        """以條件式 UPDATE 累加總數並遞增版本，讀回最新值（併發修改時不會覆蓋彼此）"""
+        Cart.objects.filter(pk=self.pk).update(
+            item_count=F('item_count') + quantity,
+            subtotal=F('subtotal') + amount,
+            version=F('version') + 1,
+            updated_at=timezone.now(),
+        )
+        self.refresh_from_db(fields=['item_count', 'subtotal', 'version', 'updated_at'])
+        refresh_cart_state([self.user_id])
+
+    @classmethod
+    def recalculate_totals(cls, carts=None):
+        """
+        由明細重新彙總 item_count / subtotal（修復用，例如直接刪除 CartItem 之後），
+        以單一 UPDATE 子查詢完成，回傳更新的購物車數。
+        """
+        items = CartItem.objects.filter(cart=OuterRef('pk')).order_by().values('cart')
+        count = items.annotate(total=Sum('quantity')).values('total')
+        amount = items.annotate(
+            total=Sum(F('price') * F('quantity'), output_field=models.DecimalField(max_digits=12, decimal_places=2))
+        ).values('total')
+        carts = carts if carts is not None else cls.objects.all()
+        user_ids = list(carts.values_list('user_id', flat=True))
+        updated = carts.update(
+            item_count=Coalesce(Subquery(count), 0),
+            subtotal=Coalesce(Subquery(amount), Value(Decimal('0'))),
+            version=F('version') + 1,
+        )
+        refresh_cart_state(user_ids)
+        return updated
+
+    def _increment(self, product, quantity):
+        """
+        以 quantity = quantity + n 的 UPDATE 累加，沒有這筆明細時才 INSERT；
+        併發新增同一商品時 INSERT 違反唯一限制，改為再累加一次，不會遺失數量。
+        回傳 (明細, 商品數增減, 金額增減)。
+        """
+        items = CartItem.objects.filter(cart=self, product=product)
+        if not items.update(quantity=F('quantity') + quantity, updated_at=timezone.now()):
+            try:
+                with transaction.atomic():
+                    item = CartItem.objects.create(
+                        cart=self, product=product, quantity=quantity, price=product.price
+                    )
+                return item, quantity, item.price * quantity
+            except IntegrityError:
+                items.update(quantity=F('quantity') + quantity, updated_at=timezone.now())
+        item = items.get()
+        return item, quantity, item.price * quantity
+
+    def _set_quantity(self, product, quantity):
+        """設定數量（<= 0 時移除），回傳 (商品數增減, 金額增減)，沒有這筆明細時回傳 None"""
+        try:
+            item = self.items.select_for_update().get(product=product)
+        except CartItem.DoesNotExist:
+            return None
+        delta = max(quantity, 0) - item.quantity
+        if quantity <= 0:
+            item.delete()
+        else:
+            CartItem.objects.filter(pk=item.pk).update(quantity=quantity, updated_at=timezone.now())
+        return delta, item.price * delta
 
     def add_item(self, product, quantity=1):
         """添加商品到購物車"""
-        cart_item, created = CartItem.objects.get_or_create(
-            cart=self,
-            product=product,
-            defaults={'quantity': quantity, 'price': product.price}
-        )
-        if not created:
-            cart_item.quantity += quantity
-            cart_item.save()
+        with transaction.atomic():
+            cart_item, count_delta, amount_delta = self._increment(product, quantity)
+            self._apply_delta(count_delta, amount_delta)
         return cart_item
 
     def remove_item(self, product):
         """從購物車移除商品"""
-        try:
-            item = self.items.get(product=product)
-            item.delete()
-            return True
-        except CartItem.DoesNotExist:
-            return False
+        return self.update_item_quantity(product, 0)
 
     def update_item_quantity(self, product, quantity):
         """更新商品數量"""
-        try:
-            item = self.items.get(product=product)
-            if quantity <= 0:
-                item.delete()
-            else:
-                item.quantity = quantity
-                item.save()
-            return True
-        except CartItem.DoesNotExist:
-            return False
+        with transaction.atomic():
+            delta = self._set_quantity(product, quantity)
+            if delta is None:
+                return False
+            self._apply_delta(*delta)
+        return True
+
+    def apply_operations(self, operations):
+        """
+        在同一個交易內套用多個操作（(op, product, quantity)，op 為 add / update / remove），
+        總數只在最後更新一次。更新不在購物車內的商品時拋出 CartOperationError，整批回滾；
+        移除不在購物車內的商品視為已完成。
+        """
+        count_delta, amount_delta = 0, Decimal('0')
+        with transaction.atomic():
+            for op, product, quantity in operations:
+                if op == 'add':
+                    _, count, amount = self._increment(product, quantity)
+                else:
+                    delta = self._set_quantity(product, quantity if op == 'update' else 0)
+                    if delta is None:
+                        if op == 'update' and quantity > 0:
+                            raise CartOperationError(f'購物車中沒有 {product.name}')
+                        continue
+                    count, amount = delta
+                count_delta += count
+                amount_delta += amount
+            self._apply_delta(count_delta, amount_delta)
+
+    def merge_items(self, quantities):
+        """
+        合併 {product_id: 數量}（例如登入前的購物車）：商品以一次查詢載入，
+        與既有數量相加並以庫存為上限後，一次 bulk_create(update_conflicts=True) 寫入所有明細。
+        回傳合併的明細數。
+        """
+        with transaction.atomic():
+            products = Product.objects.filter(
+                pk__in=list(quantities), is_active=True
+            ).only('id', 'price', 'stock').in_bulk()
+            existing = {
+                product_id: (quantity, price) for product_id, quantity, price in
+                self.items.select_for_update().filter(product_id__in=list(products))
+                .values_list('product_id', 'quantity', 'price')
+            }
+            items = []
+            count_delta, amount_delta = 0, Decimal('0')
+            for product_id, product in products.items():
+                old_quantity, price = existing.get(product_id, (0, product.price))
+                quantity = min(old_quantity + quantities[product_id], product.stock)
+                if quantity > 0:
+                    items.append(CartItem(cart=self, product=product, quantity=quantity, price=price))
+                    count_delta += quantity - old_quantity
+                    amount_delta += price * (quantity - old_quantity)
+            if items:
+                # 既有明細只更新數量，保留加入時的單價
+                CartItem.objects.bulk_create(
+                    items,
+                    update_conflicts=True,
+                    unique_fields=['cart', 'product'],
+                    update_fields=['quantity', 'updated_at'],
+                )
+                self._apply_delta(count_delta, amount_delta)
+        return len(items)
 
     def clear(self):
         """清空購物車"""
-        self.items.all().delete()
+        with transaction.atomic():
+            self.items.all().delete()
+            Cart.objects.filter(pk=self.pk).update(
+                item_count=0, subtotal=0, version=F('version') + 1, updated_at=timezone.now()
+            )
+            self.refresh_from_db(fields=['item_count', 'subtotal', 'version', 'updated_at'])
+            refresh_cart_state([self.user_id])
+
+
+def cart_state_cache_key(user_id):
+    return f'cart_state_v2_{user_id}'
+
+
+def _load_cart_states(user_ids):
+    states = {user_id: (None, 0, 0) for user_id in user_ids}
+    for user_id, *state in Cart.objects.filter(user_id__in=user_ids).values_list(
+        'user_id', 'pk', 'version', 'item_count'
+    ):
+        states[user_id] = tuple(state)
+    return states
+
+
+def get_cart_state(user_id):
+    """
+    (購物車 id, 版本, 商品總數)，優先從快取讀取；購物車未變更時不查詢資料庫。
+    購物車被刪除後重建時版本會從 0 開始，需搭配購物車 id 才能識別。
+    尚未建立購物車時為 (None, 0, 0)。
+
+    快取未命中時以 cache.add 寫入，不會覆蓋 refresh_cart_state 在交易提交後寫入的較新狀態。
+    """
+    key = cart_state_cache_key(user_id)
+    state = cache.get(key)
+    if state is None:
+        state = _load_cart_states([user_id])[user_id]
+        cache.add(key, state, settings.CART_STATE_CACHE_SECONDS)
+    return state
+
+
+def refresh_cart_state(user_ids):
+    """
+    購物車異動後，在交易提交時由資料庫讀出最新狀態寫入快取（一次查詢）。
+    快取為各 process 獨立的 LocMem 時，其他 process 最多延遲 CART_STATE_CACHE_SECONDS 才看到異動。
+    """
+    user_ids = [user_id for user_id in set(user_ids) if user_id is not None]
+    if not user_ids:
+        return
+
+    def write():
+        cache.set_many(
+            {cart_state_cache_key(user_id): state for user_id, state in _load_cart_states(user_ids).items()},
+            settings.CART_STATE_CACHE_SECONDS,
+        )
+    transaction.on_commit(write)
 
 
 class CartItem(models.Model):
@@ -98,6 +275,9 @@ class CartItem(models.Model):
         verbose_name = '購物車商品'
         verbose_name_plural = '購物車商品'
         unique_together = ('cart', 'product')
+        indexes = [
+            models.Index(fields=['updated_at'], name='cart_item_updated_idx'),
+        ]
 
     def __str__(self):
         return f"{self.product.name} x {self.quantity}"
@@ -115,14 +295,11 @@ class CartItem(models.Model):
 
 
 class SessionCart:
-    """基於 Session 的購物車（未登入用戶）"""
+    """未登入用戶的購物車，儲存位置由 CART_STORAGE 決定（session / cookie / cache）"""
     
     def __init__(self, request):
-        self.session = request.session
-        cart = self.session.get('cart')
-        if not cart:
-            cart = self.session['cart'] = {}
-        self.cart = cart
+        self.storage = get_cart_storage(request)
+        self.cart = self.storage.load()
 
     def add(self, product, quantity=1, override_quantity=False):
         """添加商品到購物車"""
@@ -139,8 +316,8 @@ class SessionCart:
         self.save()
 
     def save(self):
-        """保存購物車到 session"""
-        self.session.modified = True
+        """保存購物車"""
+        self.storage.save(self.cart)
 
     def remove(self, product):
         """從購物車移除商品"""
@@ -150,35 +327,33 @@ class SessionCart:
             self.save()
 
     def get_total_price(self):
-        """計算總價格"""
-        return sum(Decimal(item['price']) * item['quantity'] 
-                  for item in self.cart.values())
+        """計算總價格（同一個請求內只計算一次）"""
+        return self.storage.totals()[1]
 
     def get_total_items(self):
         """計算總數量"""
-        return sum(item['quantity'] for item in self.cart.values())
+        return self.storage.totals()[0]
 
     def clear(self):
         """清空購物車"""
-        if 'cart' in self.session:
-            del self.session['cart']
-        self.cart = {}
-        self.save()
+        self.storage.clear()
+        self.cart = self.storage.load()
 
     def __iter__(self):
-        """迭代購物車項目"""
-        product_ids = self.cart.keys()
-        products = Product.objects.filter(id__in=product_ids)
-        cart = self.cart.copy()
-        
-        for product in products:
-            cart[str(product.id)]['product'] = product
-        
-        for item in cart.values():
-            item['price'] = Decimal(item['price'])
-            item['total_price'] = item['price'] * item['quantity']
-            yield item
+        """迭代購物車項目（每次產生新的 dict，不修改儲存的內容）"""
+        products = Product.objects.in_bulk([int(product_id) for product_id in self.cart])
+        for product_id, data in self.cart.items():
+            product = products.get(int(product_id))
+            if product is None:
+                continue  # 商品已刪除
+            price = Decimal(data['price'])
+            yield {
+                'product': product,
+                'quantity': data['quantity'],
+                'price': price,
+                'total_price': price * data['quantity'],
+            }
 
     def __len__(self):
         """購物車項目數量"""
-        return sum(item['quantity'] for item in self.cart.values())
+        return self.get_total_items()
@@ -0,0 +1,104 @@
+"""
+購物車資料保留期限：分批刪除過期的空購物車、久未更新的購物車商品與已過期的 session（含未登入購物車）。
+
+每批依主鍵取出一小段後在短交易內刪除，批次之間可暫停，避免長時間佔住資料庫寫入鎖、影響結帳。
+"""
+from datetime import timedelta
+import time
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+from .models import Cart, CartItem, refresh_cart_state
+
+# 資料存在資料庫 django_session 表的 session 後端
+DB_SESSION_ENGINES = (
+    'django.contrib.sessions.backends.db',
+    'django.contrib.sessions.backends.cached_db',
+)
+
+
+def expired_carts(cutoff):
+    """超過保留期限且沒有商品的購物車"""
+    return Cart.objects.filter(updated_at__lt=cutoff, item_count=0).exclude(
+        Exists(CartItem.objects.filter(cart=OuterRef('pk')))
+    )
+
+
+def stale_cart_items(cutoff):
+    """超過保留期限未更新的購物車商品"""
+    return CartItem.objects.filter(updated_at__lt=cutoff)
+
+
+def expired_sessions(now):
+    """已過期的 session（未登入購物車存在 session 時一併清除）"""
+    if settings.SESSION_ENGINE not in DB_SESSION_ENGINES:
+        return Session.objects.none()
+    return Session.objects.filter(expire_date__lt=now)
+
+
+def _delete_carts(batch):
+    with transaction.atomic():
+        # 鎖定後才刪除：仍符合條件（沒有被加入商品）的購物車才會刪除
+        rows = list(batch.select_for_update().values_list('pk', 'user_id'))
+        refresh_cart_state([user_id for _, user_id in rows])
+        return Cart.objects.filter(pk__in=[pk for pk, _ in rows]).delete()[1].get(Cart._meta.label, 0)
+
+
+def _delete_cart_items(batch):
+    with transaction.atomic():
+        rows = list(batch.select_for_update().values_list('pk', 'cart_id'))
+        deleted = CartItem.objects.filter(pk__in=[pk for pk, _ in rows]).delete()[0]
+        # 同一交易內重新彙總受影響購物車的總數
+        Cart.recalculate_totals(Cart.objects.filter(pk__in={cart_id for _, cart_id in rows}))
+        return deleted
+
+
+def _delete_sessions(batch):
+    with transaction.atomic():
+        return batch.delete()[0]
+
+
+def _purge(queryset, delete_batch, batch_size, sleep):
+    """
+    依主鍵分批處理；每批刪除時重新套用 queryset 的條件，
+    取出主鍵後才被使用者更新的資料（例如空購物車被加入商品）不會被刪除。
+    """
+    total = 0
+    while True:
+        pks = list(queryset.order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return total
+        total += delete_batch(queryset.filter(pk__in=pks))
+        if len(pks) < batch_size:
+            return total
+        if sleep:
+            time.sleep(sleep)
+
+
+def purge_carts(days=None, item_days=None, batch_size=500, sleep=0.1, dry_run=False, sessions=True):
+    """
+    依保留期限分批清理，回傳 {'carts', 'cart_items', 'sessions'} 刪除（dry_run 時為符合條件）的筆數。
+
+    days 預設 CART_RETENTION_DAYS（空購物車），item_days 預設 CART_ITEM_RETENTION_DAYS（購物車商品）。
+    先刪除過期商品，因此被清空的購物車會在下一次執行時才過期。
+    """
+    now = timezone.now()
+    cart_cutoff = now - timedelta(days=settings.CART_RETENTION_DAYS if days is None else days)
+    item_cutoff = now - timedelta(days=settings.CART_ITEM_RETENTION_DAYS if item_days is None else item_days)
+
+    jobs = [
+        ('cart_items', stale_cart_items(item_cutoff), _delete_cart_items),
+        ('carts', expired_carts(cart_cutoff), _delete_carts),
+    ]
+    if sessions:
+        jobs.append(('sessions', expired_sessions(now), _delete_sessions))
+
+    result = {'carts': 0, 'cart_items': 0, 'sessions': 0}
+    for name, queryset, delete_batch in jobs:
+        if dry_run:
+            result[name] = queryset.count()
+        else:
+            result[name] = _purge(queryset, delete_batch, batch_size, sleep)
+    return result
@@ -0,0 +1,10 @@
+from django.contrib.auth.signals import user_logged_in
+from django.dispatch import receiver
+from .views import merge_session_cart_to_user_cart
+
+
+@receiver(user_logged_in)
+def merge_cart_on_login(sender, request, user, **kwargs):
+    # allauth 的登入流程也會呼叫 django 的 login()，一般登入與社群登入都會觸發
+    if request is not None:
+        merge_session_cart_to_user_cart(request, user)
@@ -0,0 +1,184 @@
+"""
+未登入用戶購物車的儲存後端（CART_STORAGE 設定）。
+
+- session：存在 Django session（相容舊資料，每次異動都會改寫 django_session）
+- cookie：壓縮後簽章存在 cookie，不寫資料庫；超過 CART_COOKIE_MAX_BYTES 時改存快取
+- cache：存在快取，cookie 只保存簽章過的購物車代號
+
+購物車內容為 {商品 id 字串: {'quantity': 數量, 'price': 單價字串}}。
+每個請求只建立一個後端實例（get_cart_storage），cookie 由 CartStorageMiddleware 寫入回應。
+"""
+from decimal import Decimal
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.utils.crypto import get_random_string
+
+CART_COOKIE_NAME = 'cart'
+CART_ID_COOKIE_NAME = 'cart_id'
+CART_COOKIE_SALT = 'apps.cart.storage'
+
+
+class CartStorage(object):
+
+    def __init__(self, request):
+        self.request = request
+        self._cart = None
+        self._totals = None
+
+    def load(self):
+        """讀取購物車（同一個請求只讀取一次）"""
+        if self._cart is None:
+            self._cart = self._read() or {}
+        return self._cart
+
+    def save(self, cart):
+        self._cart = cart
+        self._totals = None
+        self._write(cart)
+
+    def clear(self):
+        self._cart = {}
+        self._totals = None
+        self._delete()
+
+    def totals(self):
+        """(總數量, 總價) 在同一個請求內只計算一次，異動後重新計算"""
+        if self._totals is None:
+            cart = self.load()
+            self._totals = (
+                sum(item['quantity'] for item in cart.values()),
+                sum(Decimal(item['price']) * item['quantity'] for item in cart.values()),
+            )
+        return self._totals
+
+    def process_response(self, response):
+        return response
+
+    def _read(self):
+        raise NotImplementedError
+
+    def _write(self, cart):
+        raise NotImplementedError
+
+    def _delete(self):
+        raise NotImplementedError
+
+
+class SessionCartStorage(CartStorage):
+    """存在 Django session（預設，相容既有的匿名購物車）"""
+
+    def _read(self):
+        return self.request.session.get('cart')
+
+    def _write(self, cart):
+        self.request.session['cart'] = cart
+        self.request.session.modified = True
+
+    def _delete(self):
+        self.request.session.pop('cart', None)
+
+
+class CacheCartStorage(CartStorage):
+    """存在快取，cookie 只保存簽章過的購物車代號"""
+
+    def __init__(self, request):
+        super().__init__(request)
+        self._cart_id = request.get_signed_cookie(CART_ID_COOKIE_NAME, default=None, salt=CART_COOKIE_SALT)
+        self._cookies = {}  # 回應時要設定（值）或刪除（None）的 cookie
+
+    def _cache_key(self):
+        return f'cart_{self._cart_id}'
+
+    def _read(self):
+        if self._cart_id:
+            return cache.get(self._cache_key())
+        return None
+
+    def _write(self, cart):
+        if not self._cart_id:
+            self._cart_id = get_random_string(32)
+            self._cookies[CART_ID_COOKIE_NAME] = self._cart_id
+        cache.set(self._cache_key(), cart, settings.CART_STORAGE_TTL)
+
+    def _delete(self):
+        if self._cart_id:
+            cache.delete(self._cache_key())
+            self._cart_id = None
+            self._cookies[CART_ID_COOKIE_NAME] = None
+
+    def process_response(self, response):
+        for name, value in self._cookies.items():
+            if value is None:
+                response.delete_cookie(name)
+            else:
+                response.set_signed_cookie(
+                    name, value, salt=CART_COOKIE_SALT, max_age=settings.CART_STORAGE_TTL,
+                    httponly=True, samesite='Lax',
+                )
+        return response
+
+
+class SignedCookieCartStorage(CacheCartStorage):
+    """
+    壓縮後簽章存在 cookie，內容為 {商品 id: [數量, 單價]}。
+    序列化後超過 CART_COOKIE_MAX_BYTES 的大購物車改存快取（同 cache 後端）。
+    """
+
+    def _read(self):
+        if self._cart_id:
+            return super()._read()
+        value = self.request.COOKIES.get(CART_COOKIE_NAME)
+        if not value:
+            return None
+        try:
+            compact = signing.loads(value, salt=CART_COOKIE_SALT, max_age=settings.CART_STORAGE_TTL)
+        except signing.BadSignature:
+            return None
+        return {
+            product_id: {'quantity': quantity, 'price': price}
+            for product_id, (quantity, price) in compact.items()
+        }
+
+    def _write(self, cart):
+        value = signing.dumps(
+            {product_id: [item['quantity'], item['price']] for product_id, item in cart.items()},
+            salt=CART_COOKIE_SALT,
+            compress=True,
+        )
+        if len(value) > settings.CART_COOKIE_MAX_BYTES:
+            self._cookies[CART_COOKIE_NAME] = None
+            super()._write(cart)
+        else:
+            super()._delete()
+            self._cookies[CART_COOKIE_NAME] = value
+
+    def _delete(self):
+        super()._delete()
+        self._cookies[CART_COOKIE_NAME] = None
+
+    def process_response(self, response):
+        value = self._cookies.pop(CART_COOKIE_NAME, False)
+        if value is None:
+            response.delete_cookie(CART_COOKIE_NAME)
+        elif value:
+            # 值本身已簽章，不需再用 set_signed_cookie
+            response.set_cookie(
+                CART_COOKIE_NAME, value, max_age=settings.CART_STORAGE_TTL, httponly=True, samesite='Lax',
+            )
+        return super().process_response(response)
+
+
+CART_STORAGES = {
+    'session': SessionCartStorage,
+    'cookie': SignedCookieCartStorage,
+    'cache': CacheCartStorage,
+}
+
+
+def get_cart_storage(request):
+    """取得此請求的購物車儲存後端（同一個請求共用一個實例）"""
+    storage = getattr(request, '_cart_storage', None)
+    if storage is None:
+        storage = request._cart_storage = CART_STORAGES[settings.CART_STORAGE](request)
+    return storage
@@ -1,41 +1,65 @@
-from django.test import TestCase, Client
+from django.test import TestCase, override_settings
+from django.contrib.sessions.models import Session
 from django.contrib.auth import get_user_model
 from django.urls import reverse
+from django.core.cache import cache
+from django.utils import timezone
+from datetime import timedelta
+from unittest import mock
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from api.v1.vendor.models import Vendor, VendorCategory
 from api.v1.product.models import Product
-from apps.cart.models import Cart, CartItem
+from apps.cart import models as cart_models
+from apps.cart.models import Cart, CartItem, cart_state_cache_key, get_cart_state, refresh_cart_state
+from apps.cart import retention
+from apps.cart.retention import purge_carts
 import json
 
 User = get_user_model()
 
 
-class CartModelTest(TestCase):
-    def setUp(self):
-        self.user = User.objects.create_user(
+class CartTestCase(TestCase):
+    """購物車測試的共用資料：顧客、商家與商品"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
             email='test@example.com',
             password='testpass123'
         )
-        self.vendor_user = User.objects.create_user(
+        cls.vendor_user = User.objects.create_user(
             email='vendor@example.com',
             password='testpass123'
         )
-        self.category = VendorCategory.objects.create(
+        cls.category = VendorCategory.objects.create(
             name='測試分類',
             slug='test-category'
         )
-        self.vendor = Vendor.objects.create(
-            user=self.vendor_user,
+        cls.vendor = Vendor.objects.create(
+            user=cls.vendor_user,
             name='測試小農',
-            category=self.category
+            category=cls.category
         )
-        self.product = Product.objects.create(
-            vendor=self.vendor,
+        cls.product = Product.objects.create(
+            vendor=cls.vendor,
             name='測試商品',
             description='測試商品描述',
             price=100.00,
-            stock=10
+            stock=10,
+            is_active=True
         )
+        cls.apple = Product.objects.create(vendor=cls.vendor, name='蘋果', price=100, stock=10, is_active=True)
+        cls.tea = Product.objects.create(vendor=cls.vendor, name='高山茶', price=300, stock=5, is_active=True)
+
+    def setUp(self):
+        cache.clear()
+
+    def login(self):
+        self.client.login(email='test@example.com', password='testpass123')
 
+
+class CartModelTest(CartTestCase):
     def test_cart_creation(self):
         """測試購物車創建"""
         cart = Cart.objects.create(user=self.user)
@@ -70,36 +94,40 @@ class CartModelTest(TestCase):
         cart.remove_item(self.product)
         self.assertTrue(cart.is_empty)
 
+    def test_counters_maintained(self):
+        """測試商品總數與小計欄位隨新增、更新、移除、清空同步更新"""
+        other = Product.objects.create(vendor=self.vendor, name='其他商品', price=30, stock=10)
+        cart = Cart.objects.create(user=self.user)
+        cart.add_item(self.product, quantity=2)
+        cart.add_item(other, quantity=1)
+        cart.add_item(self.product, quantity=1)
+        cart.update_item_quantity(other, 4)
 
-class CartViewTest(TestCase):
-    def setUp(self):
-        self.client = Client()
-        self.user = User.objects.create_user(
-            email='test@example.com',
-            password='testpass123'
-        )
-        self.vendor_user = User.objects.create_user(
-            email='vendor@example.com',
-            password='testpass123'
-        )
-        self.category = VendorCategory.objects.create(
-            name='測試分類',
-            slug='test-category'
-        )
-        self.vendor = Vendor.objects.create(
-            user=self.vendor_user,
-            name='測試小農',
-            category=self.category
-        )
-        self.product = Product.objects.create(
-            vendor=self.vendor,
-            name='測試商品',
-            description='測試商品描述',
-            price=100.00,
-            stock=10,
-            is_active=True
+        cart = Cart.objects.get(pk=cart.pk)
+        self.assertEqual((cart.item_count, cart.subtotal), (7, 420))
+
+        cart.remove_item(self.product)
+        self.assertEqual((cart.item_count, cart.subtotal), (4, 120))
+        cart.clear()
+        cart = Cart.objects.get(pk=cart.pk)
+        self.assertEqual((cart.item_count, cart.subtotal), (0, 0))
+
+    def test_recalculate_totals(self):
+        """測試由明細重新彙總計數欄位"""
+        cart = Cart.objects.create(user=self.user)
+        cart.add_item(self.product, quantity=3)
+        CartItem.objects.filter(cart=cart).update(quantity=5)
+        Cart.objects.create(user=self.vendor_user, item_count=9, subtotal=900)  # 沒有明細
+
+        self.assertEqual(Cart.recalculate_totals(), 2)
+        self.assertEqual(
+            dict(Cart.objects.values_list('user__email', 'item_count')),
+            {'test@example.com': 5, 'vendor@example.com': 0},
         )
+        self.assertEqual(Cart.objects.get(pk=cart.pk).subtotal, 500)
 
+
+class CartViewTest(CartTestCase):
     def test_cart_detail_view(self):
         """測試購物車詳情頁面"""
         response = self.client.get(reverse('cart:cart_detail'))
@@ -125,6 +153,18 @@ class CartViewTest(TestCase):
         # 檢查購物車是否有商品
         cart = Cart.objects.get(user=self.user)
         self.assertEqual(cart.total_items, 2)
+        self.assertEqual(data['total_items'], 2)
+
+    def test_cart_count_reads_one_row(self):
+        """測試購物車數量只讀取購物車的計數欄位"""
+        self.client.login(email='test@example.com', password='testpass123')
+        Cart.objects.create(user=self.user).add_item(self.product, quantity=3)
+        self.client.get(reverse('cart:cart_count'))  # 先載入 session 與用戶
+
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('cart:cart_count'))
+        self.assertEqual(response.json(), {'count': 3})
+        self.assertEqual([q['sql'] for q in ctx.captured_queries if 'cart_cartitem' in q['sql']], [])
 
     def test_add_to_cart_anonymous(self):
         """測試未登入用戶加入購物車"""
@@ -155,3 +195,332 @@ class CartViewTest(TestCase):
         self.assertEqual(response.status_code, 200)
         data = response.json()
         self.assertFalse(data['success'])
+
+
+class CartIdempotencyTest(CartTestCase):
+    def setUp(self):
+        super().setUp()
+        self.login()
+
+    def _add(self, key, quantity=2):
+        return self.client.post(
+            reverse('cart:add_to_cart'),
+            data=json.dumps({
+                'product_id': self.product.id,
+                'quantity': quantity
+            }),
+            content_type='application/json',
+            headers={'Idempotency-Key': key},
+        )
+
+    def test_retry_is_replayed(self):
+        """測試相同 Idempotency-Key 重送不會重複加入"""
+        first = self._add('retry-1')
+        second = self._add('retry-1')
+
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        cart = Cart.objects.get(user=self.user)
+        self.assertEqual(cart.total_items, 2)
+
+    def test_key_reused_with_different_body(self):
+        """測試同一個 key 搭配不同內容會被拒絕"""
+        self._add('retry-2', quantity=1)
+        response = self._add('retry-2', quantity=3)
+        self.assertEqual(response.status_code, 422)
+
+
+class CartBatchTest(CartTestCase):
+    def _batch(self, operations):
+        return self.client.post(
+            reverse('cart:batch_update_cart'),
+            data=json.dumps({'operations': operations}),
+            content_type='application/json',
+        )
+
+    def test_batch_operations_authenticated(self):
+        """測試登入用戶一次套用多個操作並回傳最新總數"""
+        self.login()
+        Cart.objects.create(user=self.user).add_item(self.tea, quantity=2)
+
+        response = self._batch([
+            {'op': 'add', 'product_id': self.apple.id, 'quantity': 1},
+            {'op': 'add', 'product_id': self.apple.id, 'quantity': 1},
+            {'op': 'add', 'product_id': self.apple.id, 'quantity': 1},
+            {'op': 'update', 'product_id': self.tea.id, 'quantity': 1},
+        ])
+
+        self.assertEqual(response.json()['total_items'], 4)
+        self.assertEqual(response.json()['total_price'], 600)
+        cart = Cart.objects.get(user=self.user)
+        self.assertEqual(dict(cart.items.values_list('product__name', 'quantity')), {'蘋果': 3, '高山茶': 1})
+
+        response = self._batch([{'op': 'remove', 'product_id': self.tea.id}])
+        self.assertEqual((response.json()['total_items'], response.json()['total_price']), (3, 300))
+
+    def test_batch_operations_anonymous(self):
+        """測試未登入用戶的批次操作"""
+        response = self._batch([
+            {'op': 'add', 'product_id': self.apple.id, 'quantity': 2},
+            {'op': 'add', 'product_id': self.tea.id, 'quantity': 1},
+            {'op': 'remove', 'product_id': self.apple.id},
+        ])
+        self.assertEqual((response.json()['total_items'], response.json()['total_price']), (1, 300))
+
+    def test_invalid_batch_applies_nothing(self):
+        """測試任一操作不合法時整批不套用"""
+        self.login()
+        response = self._batch([
+            {'op': 'add', 'product_id': self.apple.id, 'quantity': 1},
+            {'op': 'add', 'product_id': self.tea.id, 'quantity': 6},
+        ])
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(CartItem.objects.exists())
+
+    def test_update_missing_item_rejects_batch(self):
+        """測試更新不在購物車內的商品時整批回滾並回傳 400"""
+        self.login()
+        response = self._batch([
+            {'op': 'add', 'product_id': self.apple.id, 'quantity': 1},
+            {'op': 'update', 'product_id': self.tea.id, 'quantity': 2},
+        ])
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(CartItem.objects.exists())
+        self.assertEqual(Cart.objects.get(user=self.user).item_count, 0)
+
+        self.client.logout()
+        response = self._batch([
+            {'op': 'add', 'product_id': self.apple.id, 'quantity': 1},
+            {'op': 'update', 'product_id': self.tea.id, 'quantity': 2},
+        ])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get(reverse('cart:cart_count')).json(), {'count': 0})
+
+    def test_add_increments_existing_item(self):
+        """測試重複加入同一商品以累加方式更新同一筆明細"""
+        cart = Cart.objects.create(user=self.user)
+        cart.add_item(self.apple, quantity=1)
+        stale = Cart.objects.get(pk=cart.pk)  # 另一個請求載入的同一個購物車
+        stale.add_item(self.apple, quantity=2)
+        item = cart.add_item(self.apple, quantity=3)
+
+        self.assertEqual(item.quantity, 6)
+        self.assertEqual(CartItem.objects.count(), 1)
+        self.assertEqual((cart.item_count, cart.subtotal), (6, 600))
+
+
+class AnonymousCartStorageTest(CartTestCase):
+    def _add(self, product, quantity=1):
+        return self.client.post(
+            reverse('cart:add_to_cart'),
+            data=json.dumps({'product_id': product.id, 'quantity': quantity}),
+            content_type='application/json',
+        )
+
+    def _count(self):
+        return self.client.get(reverse('cart:cart_count')).json()['count']
+
+    @override_settings(CART_STORAGE='cookie')
+    def test_cookie_storage(self):
+        """測試 cookie 後端不寫入 session 資料表"""
+        response = self._add(self.apple, 2)
+        self.assertIn('cart', response.cookies)
+        self._add(self.tea)
+
+        self.assertEqual(self._count(), 3)
+        self.assertFalse(Session.objects.exists())
+
+        self.client.post(reverse('cart:clear_cart'))
+        self.assertEqual(self._count(), 0)
+
+    @override_settings(CART_STORAGE='cookie', CART_COOKIE_MAX_BYTES=10)
+    def test_large_cookie_cart_spills_to_cache(self):
+        """測試超過 cookie 大小上限的購物車改存快取"""
+        response = self._add(self.apple, 2)
+        self.assertIn('cart_id', response.cookies)
+        self.assertEqual(self._count(), 2)
+        self.assertFalse(Session.objects.exists())
+
+    @override_settings(CART_STORAGE='cache')
+    def test_cache_storage_rejects_forged_id(self):
+        """測試 cache 後端的購物車代號需簽章"""
+        self._add(self.apple, 2)
+        self.assertEqual(self._count(), 2)
+
+        self.client.cookies['cart_id'] = 'forged'
+        self.assertEqual(self._count(), 0)
+
+    def test_session_storage(self):
+        """測試預設的 session 後端維持相容"""
+        self._add(self.apple, 2)
+        self.assertEqual(self.client.session['cart'], {str(self.apple.id): {'quantity': 2, 'price': '100.00'}})
+        self.assertEqual(self._count(), 2)
+
+
+class CartMergeTest(CartTestCase):
+    def test_merge_on_login(self):
+        """測試登入時合併未登入的購物車，數量以庫存為上限"""
+        Cart.objects.create(user=self.user).add_item(self.tea, quantity=4)
+        for product, quantity in ((self.apple, 2), (self.tea, 3)):
+            self.client.post(
+                reverse('cart:add_to_cart'),
+                data=json.dumps({'product_id': product.id, 'quantity': quantity}),
+                content_type='application/json',
+            )
+
+        self.login()
+
+        cart = Cart.objects.get(user=self.user)
+        self.assertEqual(dict(cart.items.values_list('product__name', 'quantity')), {'蘋果': 2, '高山茶': 5})
+        self.assertEqual((cart.item_count, cart.subtotal), (7, 1700))
+        self.assertNotIn('cart', self.client.session)
+
+    def test_merge_query_count_independent_of_size(self):
+        """測試合併的查詢數不隨商品數增加"""
+        products = [
+            Product.objects.create(vendor=self.vendor, name=f'商品{i}', price=10, stock=5, is_active=True)
+            for i in range(20)
+        ]
+        cart = Cart.objects.create(user=self.user)
+        cart.add_item(products[0], quantity=1)
+
+        with CaptureQueriesContext(connection) as ctx:
+            merged = cart.merge_items({product.id: 2 for product in products})
+        queries = [q for q in ctx.captured_queries if 'SAVEPOINT' not in q['sql']]
+
+        self.assertEqual(merged, 20)
+        self.assertEqual(len(queries), 5)  # 商品、既有明細、upsert、更新總數、讀回總數
+        self.assertEqual(cart.item_count, 41)
+
+
+class CartCountTest(CartTestCase):
+    def setUp(self):
+        super().setUp()
+        self.login()
+
+    def _add(self, quantity):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                reverse('cart:add_to_cart'),
+                data=json.dumps({'product_id': self.apple.id, 'quantity': quantity}),
+                content_type='application/json',
+            )
+
+    def test_unchanged_cart_served_from_cache(self):
+        """測試購物車未變更時由快取回應，並支援 ETag / 304"""
+        self._add(2)
+        first = self.client.get(reverse('cart:cart_count'))
+        self.assertEqual(first.json(), {'count': 2})
+
+        with CaptureQueriesContext(connection) as ctx:
+            second = self.client.get(reverse('cart:cart_count'), headers={'If-None-Match': first['ETag']})
+        self.assertEqual(second.status_code, 304)
+        self.assertEqual([q['sql'] for q in ctx.captured_queries if 'cart_cart' in q['sql']], [])
+
+    def test_version_changes_on_update(self):
+        """測試購物車異動後版本遞增，舊的 ETag 不再命中"""
+        self._add(2)
+        etag = self.client.get(reverse('cart:cart_count'))['ETag']
+        self._add(1)
+
+        response = self.client.get(reverse('cart:cart_count'), headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'count': 3})
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(Cart.objects.get(user=self.user).version, 2)
+
+    def test_recreated_cart_does_not_match_old_etag(self):
+        """測試購物車被刪除後重建，版本相同時舊的 ETag 也不會命中"""
+        self._add(2)
+        etag = self.client.get(reverse('cart:cart_count'))['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            Cart.objects.filter(user=self.user).delete()
+            refresh_cart_state([self.user.pk])
+        self._add(1)
+        self.assertEqual(Cart.objects.get(user=self.user).version, 1)
+
+        response = self.client.get(reverse('cart:cart_count'), headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'count': 1})
+
+    def test_commit_writes_new_state(self):
+        """測試購物車異動提交後直接寫入最新狀態，下次讀取不需查詢資料庫"""
+        self._add(2)
+        self.client.get(reverse('cart:cart_count'))
+        self._add(1)
+
+        with CaptureQueriesContext(connection) as ctx:
+            state = get_cart_state(self.user.pk)
+        self.assertEqual(ctx.captured_queries, [])
+        cart = Cart.objects.get(user=self.user)
+        self.assertEqual(state, (cart.pk, 2, 3))
+
+    def test_stale_reader_does_not_overwrite_committed_state(self):
+        """測試快取未命中的讀取較晚寫入時，不會覆蓋其他請求提交後寫入的較新狀態"""
+        self._add(2)
+        cache.clear()
+        key = cart_state_cache_key(self.user.pk)
+        newer = (Cart.objects.get(user=self.user).pk, 5, 9)
+        load = cart_models._load_cart_states
+
+        def racing_load(user_ids):
+            states = load(user_ids)
+            cache.set(key, newer)  # 另一個請求在此時提交並寫入新狀態
+            return states
+
+        with mock.patch.object(cart_models, '_load_cart_states', side_effect=racing_load):
+            get_cart_state(self.user.pk)
+        self.assertEqual(cache.get(key), newer)
+
+
+class CartRetentionTest(CartTestCase):
+    def setUp(self):
+        super().setUp()
+        old = timezone.now() - timedelta(days=120)
+
+        self.empty = Cart.objects.create(user=User.objects.create_user(email='a@example.com', password='x'))
+        self.active = Cart.objects.create(user=User.objects.create_user(email='b@example.com', password='x'))
+        self.active.add_item(self.apple, quantity=1)
+        self.active.add_item(self.tea, quantity=2)
+        Cart.objects.filter(pk=self.empty.pk).update(updated_at=old)
+        CartItem.objects.filter(product=self.apple).update(updated_at=old)
+
+        Session.objects.create(session_key='expired', session_data='', expire_date=old)
+        Session.objects.create(session_key='valid', session_data='', expire_date=timezone.now() + timedelta(days=1))
+
+    def test_dry_run(self):
+        """測試 dry-run 只回報筆數不刪除"""
+        result = purge_carts(dry_run=True)
+        self.assertEqual(result, {'carts': 1, 'cart_items': 1, 'sessions': 1})
+        self.assertEqual(Cart.objects.count(), 2)
+        self.assertEqual(CartItem.objects.count(), 2)
+
+    def test_purge_in_batches(self):
+        """測試分批刪除過期資料並修正受影響購物車的總數"""
+        result = purge_carts(batch_size=1, sleep=0)
+
+        self.assertEqual(result, {'carts': 1, 'cart_items': 1, 'sessions': 1})
+        self.assertEqual(list(Cart.objects.values_list('pk', flat=True)), [self.active.pk])
+        self.active.refresh_from_db()
+        self.assertEqual((self.active.item_count, self.active.subtotal), (2, 600))
+        self.assertEqual(list(Session.objects.values_list('pk', flat=True)), ['valid'])
+
+    def test_rows_changed_after_selection_are_kept(self):
+        """測試取出主鍵後才被加入商品的購物車與被更新的商品不會被刪除"""
+        delete_carts, delete_cart_items = retention._delete_carts, retention._delete_cart_items
+
+        def touch_then_delete_carts(batch):
+            self.empty.add_item(self.apple, quantity=1)
+            return delete_carts(batch)
+
+        def touch_then_delete_items(batch):
+            CartItem.objects.filter(product=self.apple).update(updated_at=timezone.now())
+            return delete_cart_items(batch)
+
+        with mock.patch.object(retention, '_delete_carts', side_effect=touch_then_delete_carts), \
+                mock.patch.object(retention, '_delete_cart_items', side_effect=touch_then_delete_items):
+            result = purge_carts(sleep=0, sessions=False)
+
+        self.assertEqual(result, {'carts': 0, 'cart_items': 0, 'sessions': 0})
+        self.assertEqual(Cart.objects.count(), 2)
+        self.assertEqual(CartItem.objects.count(), 3)
@@ -7,6 +7,7 @@ urlpatterns = [
     path('', views.cart_detail, name='cart_detail'),
     path('add/', views.add_to_cart, name='add_to_cart'),
     path('update/', views.update_cart, name='update_cart'),
+    path('batch/', views.batch_update_cart, name='batch_update_cart'),
     path('remove/', views.remove_from_cart, name='remove_from_cart'),
     path('clear/', views.clear_cart, name='clear_cart'),
     path('count/', views.cart_count, name='cart_count'),
@@ -1,11 +1,13 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
-from django.http import JsonResponse
+from django.http import HttpResponseNotModified, JsonResponse
 from django.views.decorators.http import require_POST
 from django.contrib import messages
 from django.urls import reverse
+from django.utils.cache import patch_vary_headers
 from api.v1.product.models import Product
-from .models import Cart, SessionCart
+from .models import Cart, CartOperationError, SessionCart, get_cart_state
+from Shanghuyun_Platform.idempotency import idempotent
 import json
 
 
@@ -44,6 +46,7 @@ def cart_detail(request):
 
 
 @require_POST
+@idempotent('cart_add')
 def add_to_cart(request):
     """添加商品到購物車"""
     try:
@@ -83,6 +86,7 @@ def add_to_cart(request):
 
 
 @require_POST
+@idempotent('cart_update')
 def update_cart(request):
     """更新購物車商品數量"""
     try:
@@ -119,6 +123,91 @@ def update_cart(request):
         })
 
 
+CART_OPERATIONS = ('add', 'update', 'remove')
+MAX_BATCH_OPERATIONS = 50
+
+
+
+def _parse_operations(body):
+    """
+    解析批次操作，商品以一次查詢載入，回傳 [(op, product, quantity)]。
+    格式：{"operations": [{"op": "add", "product_id": 1, "quantity": 2}, ...]}
+    """
+    try:
+        raw = json.loads(body).get('operations')
+    except (ValueError, AttributeError):
+        raise CartOperationError('無效的 JSON 格式')
+    if not isinstance(raw, list) or not raw:
+        raise CartOperationError('請提供 operations')
+    if len(raw) > MAX_BATCH_OPERATIONS:
+        raise CartOperationError(f'一次最多 {MAX_BATCH_OPERATIONS} 個操作')
+
+    parsed = []
+    for entry in raw:
+        try:
+            op = entry['op']
+            product_id = int(entry['product_id'])
+            quantity = int(entry.get('quantity', 1 if op == 'add' else 0))
+        except (KeyError, TypeError, ValueError):
+            raise CartOperationError('操作格式錯誤')
+        if op not in CART_OPERATIONS:
+            raise CartOperationError(f'不支援的操作：{op}')
+        if op == 'add' and quantity <= 0:
+            raise CartOperationError('加入數量需大於 0')
+        parsed.append((op, product_id, quantity))
+
+    products = Product.objects.in_bulk({product_id for _, product_id, _ in parsed})
+    operations = []
+    for op, product_id, quantity in parsed:
+        product = products.get(product_id)
+        if product is None or (op == 'add' and not product.is_active):
+            raise CartOperationError(f'商品不存在：{product_id}')
+        if op != 'remove' and product.stock < quantity:
+            raise CartOperationError(f'{product.name} 庫存不足，目前僅有 {product.stock} 件')
+        operations.append((op, product, quantity))
+    return operations
+
+
+@require_POST
+@idempotent('cart_batch')
+def batch_update_cart(request):
+    """在同一個請求與交易內套用多個加入 / 更新 / 移除操作（例如數量按鈕連點）"""
+    try:
+        operations = _parse_operations(request.body)
+    except CartOperationError as e:
+        return JsonResponse({'success': False, 'message': str(e)}, status=400)
+
+    cart = get_cart(request)
+    if request.user.is_authenticated:
+        try:
+            cart.apply_operations(operations)
+        except CartOperationError as e:
+            return JsonResponse({'success': False, 'message': str(e)}, status=400)
+        total_items = cart.total_items
+        total_price = float(cart.total_price)
+    else:
+        # 先檢查整批操作，任一無效時不套用任何操作
+        for op, product, quantity in operations:
+            if op == 'update' and quantity > 0 and str(product.id) not in cart.cart:
+                return JsonResponse({'success': False, 'message': f'購物車中沒有 {product.name}'}, status=400)
+        for op, product, quantity in operations:
+            if op == 'add':
+                cart.add(product, quantity)
+            elif op == 'update' and quantity > 0:
+                cart.add(product, quantity, override_quantity=True)
+            else:
+                cart.remove(product)
+        total_items = cart.get_total_items()
+        total_price = float(cart.get_total_price())
+
+    return JsonResponse({
+        'success': True,
+        'message': '購物車已更新',
+        'total_items': total_items,
+        'total_price': total_price
+    })
+
+
 @require_POST
 def remove_from_cart(request):
     """從購物車移除商品"""
@@ -180,32 +269,41 @@ def clear_cart(request):
 
 
 def cart_count(request):
-    """獲取購物車商品數量（AJAX）"""
-    cart = get_cart(request)
-    
+    """
+    獲取購物車商品數量（AJAX）
+    登入用戶的數量與版本從快取讀取，購物車未變更時回傳 304，不查詢資料庫
+    """
     if request.user.is_authenticated:
-        count = cart.total_items
+        cart_id, version, count = get_cart_state(request.user.pk)
+        etag = f'"cart-{request.user.pk}-{cart_id or 0}-{version}"'
     else:
-        count = cart.get_total_items()
-    
-    return JsonResponse({'count': count})
+        count = SessionCart(request).get_total_items()
+        etag = f'"cart-anonymous-{count}"'
+
+    if etag in request.headers.get('If-None-Match', ''):
+        response = HttpResponseNotModified()
+    else:
+        response = JsonResponse({'count': count})
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    patch_vary_headers(response, ['Cookie'])
+    return response
 
 
-def merge_session_cart_to_user_cart(request):
-    """將 session 購物車合併到用戶購物車（登入時調用）"""
-    if not request.user.is_authenticated:
+def merge_session_cart_to_user_cart(request, user=None):
+    """將未登入時的購物車合併到用戶購物車（登入時由 user_logged_in signal 呼叫）"""
+    user = user or request.user
+    if not user.is_authenticated:
         return
     
     session_cart = SessionCart(request)
     if not session_cart.cart:
         return
     
-    user_cart, created = Cart.objects.get_or_create(user=request.user)
-    
-    for item in session_cart:
-        product = item['product']
-        quantity = item['quantity']
-        user_cart.add_item(product, quantity)
+    user_cart, created = Cart.objects.get_or_create(user=user)
+    user_cart.merge_items({
+        int(product_id): item['quantity'] for product_id, item in session_cart.cart.items()
+    })
     
     # 清空 session 購物車
     session_cart.clear()
@@ -1,6 +1,7 @@
 from wagtail_modeladmin.options import ModelAdmin, modeladmin_register
 from wagtail_modeladmin.helpers import PermissionHelper
-from api.v1.order.models import Order
+from api.v1.order.models import ArchivedOrder, Order
+from api.v1.order.export import scoped_archived_orders, scoped_orders
 
 
 class OrderPermissionHelper(PermissionHelper):
@@ -24,21 +25,15 @@ class OrderAdmin(ModelAdmin):
     menu_label = "訂單管理"
     menu_icon = "list-ul"  # FontAwesome icon
     list_display = ("id", "user", "total_amount", "status", "created_at")
+    list_filter = ("status", "stock_shortfall")
     search_fields = ("id", "user__email", "user__username")
     permission_helper_class = OrderPermissionHelper
 
     def get_queryset(self, request):
         qs = super().get_queryset(request)
-        # 僅顯示已付款訂單
-        qs = qs.filter(status="paid")
-
-        # 管理員/員工可見全部已付款訂單
-        if request.user.is_superuser or request.user.is_staff:
-            return qs
-
-        # 商家僅能看到含有自己商品的訂單
-        # Order -> OrderItem (related_name="items") -> Product -> Vendor -> User
-        return qs.filter(items__product__vendor__user=request.user).distinct()
+        # 僅顯示已付款訂單；管理員/員工可見全部，商家僅能看到含有自己商品的訂單
+        # 透過 OrderVendor 索引 (vendor, status, created_at) 查詢，不需 join OrderItem / Product 與 distinct
+        return scoped_orders(request.user, qs)
 
     def has_add_permission(self, request):
         return request.user.is_superuser or request.user.is_staff
@@ -50,4 +45,28 @@ class OrderAdmin(ModelAdmin):
         return request.user.is_superuser or request.user.is_staff
 
 
+class ArchivedOrderPermissionHelper(OrderPermissionHelper):
+    """封存訂單為唯讀資料"""
+
+    def user_can_create(self, user):
+        return False
+
+    def user_can_edit_obj(self, user, obj):
+        return False
+
+
+class ArchivedOrderAdmin(ModelAdmin):
+    model = ArchivedOrder
+    menu_label = "封存訂單"
+    menu_icon = "folder-inverse"
+    list_display = ("id", "user", "total_amount", "status", "created_at", "archived_at")
+    search_fields = ("id", "merchant_trade_no", "user__email")
+    inspect_view_enabled = True
+    permission_helper_class = ArchivedOrderPermissionHelper
+
+    def get_queryset(self, request):
+        return scoped_archived_orders(request.user, super().get_queryset(request))
+
+
 modeladmin_register(OrderAdmin)
+modeladmin_register(ArchivedOrderAdmin)